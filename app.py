@@ -1,34 +1,389 @@
+import argparse
+import glob
+import json
+import os
+import shutil
 import sys
+import time
 
-import pkg.extract as e
-import pkg.load as l
 import pkg.logger as logger
-import pkg.transform as t
 
+# The stages (and pandas, SQLAlchemy and requests with them) are imported by
+# the commands that use them, so e.g. status starts in milliseconds and a
+# host that only extracts doesn't need the database settings.
 
-def main():
+# Arguments of the previous command line (python app.py DEBUG PROFILE
+# DAEMON), still accepted
+LEGACY_ARGS = {"DEBUG": "--debug", "PROFILE": "--profile", "DAEMON": "daemon"}
+
+
+def get_parser():
+    """Returns the command line parser
+
+    Returns:
+        argparse.ArgumentParser: parser of app.py's arguments
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="app.py",
+        description="Downloads, transforms and loads the cultural venues sources. "
+        "Without a command, runs the whole pipeline once (run).",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="log at DEBUG level, with the spans of the stages and functions",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record the memory used by each stage (see pkg/profiling.py)",
+    )
+
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    cmd = commands.add_parser("extract", help="download the sources")
+    cmd.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="folder where the csv files are copied (<category>.csv)",
+    )
+
+    cmd = commands.add_parser("transform", help="transform downloaded sources")
+    cmd.add_argument(
+        "-i", "--input", required=True, help="folder with <category>.csv files (see extract)"
+    )
+    cmd.add_argument(
+        "-o", "--output", required=True, help="folder where the tables are saved"
+    )
+
+    cmd = commands.add_parser("load", help="load transformed tables")
+    cmd.add_argument(
+        "-i", "--input", required=True, help="folder with the tables (see transform)"
+    )
+    cmd.add_argument("--sink", help="storage backend (see LOAD_SINK)")
+
+    commands.add_parser(
+        "run", help="extract, transform and load, unless no source has changed"
+    )
+
+    cmd = commands.add_parser("daemon", help="run the pipeline on an interval")
+    cmd.add_argument(
+        "--interval", type=float, help="seconds between runs (see DAEMON_INTERVAL)"
+    )
+
+    commands.add_parser("status", help="print the status of the daemon and its last run")
+
+    cmd = commands.add_parser(
+        "archive", help="archive the downloaded files and remove the old ones"
+    )
+    cmd.add_argument(
+        "--keep-days",
+        type=int,
+        help="days the downloaded files are kept, -1 keeps them all (see ARCHIVE_KEEP_DAYS)",
+    )
+
+    cmd = commands.add_parser("snapshot", help="export an archived source as of a date")
+    cmd.add_argument("category", help="source category. Example: cine")
+    cmd.add_argument(
+        "-o", "--output", required=True, help="csv file where the snapshot is saved"
+    )
+    cmd.add_argument(
+        "--as-of", help="date (yyyy-mm-dd) of the snapshot. Defaults to the latest"
+    )
+
+    return parser
+
+
+def parse_args(argv):
+    """Parses the command line, translating the old style arguments (see
+    LEGACY_ARGS)
+
+    Args:
+        argv (list of str): arguments, without the program name
+
+    Returns:
+        argparse.Namespace: parsed arguments, command defaults to run
+    """
+
+    argv = [LEGACY_ARGS.get(arg, arg) for arg in argv]
+
+    # The options go before the command. Example: run --debug --> --debug run
+    options = [arg for arg in argv if arg in ("--debug", "--profile")]
+    others = [arg for arg in argv if arg not in options]
+
+    args = get_parser().parse_args(options + others)
+    args.command = args.command or "run"
+    return args
+
+
+def main(argv=None):
+
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    # Doesn't log anything: it must be fast and leave no files behind
+    if args.command == "status":
+        return cmd_status(args)
 
     ###### Logger setup - Start ######
-    # Check if the user has passed in a command line DEBUG argument
-    logger.debug_flg = True if sys.argv[1:2] == ["DEBUG"] else False
+    logger.debug_flg = args.debug
 
     # Set the logger for this file
     log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
-    log.info("Start Main")
+    log.info(f"Start Main ({args.command})")
 
-    # Log basic debug information like function calls and returns (log level
-    # must be set to DEBUG).
-    basic_debug = logger.Debug2Log()
-    basic_debug.set_trace()
+    # Log the start, end, arguments and elapsed time of the pipeline stages
+    # and the functions decorated with logger.traced
+    logger.set_tracing(logger.debug_flg)
 
     ###### Logger setup - End ######
 
-    csvs_dic = e.download_csvs()
-    dfs_dic = t.transform(csvs_dic)
-    l.load(dfs_dic)
+    import pkg.profiling as profiling
+
+    if args.profile:
+        profiling.start()
+
+    try:
+        COMMANDS[args.command](args, log)
+    finally:
+        profiling.write_report()
 
     log.info("End Main")
 
 
+def cmd_status(args):
+    """Prints the status written by the daemon (see scheduler.run_forever)
+    and whether a run is in progress right now"""
+
+    import pkg.scheduler as scheduler
+
+    status = {
+        "running_pid": scheduler.get_running_pid(),
+        "daemon": scheduler.read_status(),
+    }
+    print(json.dumps(status, indent=4))
+
+
+def cmd_extract(args, log):
+    """Downloads the sources and copies them to args.output"""
+
+    import pkg.extract as e
+
+    csvs_dic = e.download_csvs()
+
+    # Copied, not linked: the downloads folder must keep its own files (see
+    # extract.MANIFEST_FILE)
+    os.makedirs(args.output, exist_ok=True)
+    for category, csv_file in csvs_dic.items():
+        shutil.copyfile(csv_file, os.path.join(args.output, category + ".csv"))
+
+    log.info(f"{len(csvs_dic)} sources saved in {args.output}")
+
+
+def cmd_transform(args, log):
+    """Transforms the csv files in args.input and saves the tables in
+    args.output (see cache.save_frames)"""
+
+    import pkg.cache as c
+
+    csvs_dic = {
+        os.path.splitext(os.path.basename(fname))[0]: fname
+        for fname in sorted(glob.glob(os.path.join(args.input, "*.csv")))
+    }
+    if not csvs_dic:
+        raise FileNotFoundError(f"No csv files in {args.input}")
+
+    dfs_dic = transform(csvs_dic)
+    c.save_frames(args.output, dfs_dic)
+
+    log.info(f"{len(dfs_dic)} tables saved in {args.output}")
+
+
+def cmd_load(args, log):
+    """Loads the tables saved in args.input (see cmd_transform)"""
+
+    import pkg.cache as c
+    import pkg.load as l
+
+    l.load(c.load_frames(args.input), sink=args.sink or l.LOAD_SINK)
+
+
+def cmd_run(args, log):
+    """Runs the whole pipeline once, unless another run is in progress"""
+
+    import pkg.scheduler as scheduler
+
+    # Skip this run if another one is in progress (e.g. the previous one
+    # started by cron is still loading)
+    with scheduler.run_lock() as locked:
+        if locked:
+            run(log)
+        else:
+            log.warning("Another run is in progress, skipping this one")
+
+
+def cmd_daemon(args, log):
+    """Runs the pipeline every DAEMON_INTERVAL seconds (see
+    pkg/scheduler.py). The imports, the logging setup, the HTTP session and
+    the database connection pool are set up once for all the runs."""
+
+    import pkg.extract as e
+    import pkg.scheduler as scheduler
+
+    interval = args.interval or scheduler.DAEMON_INTERVAL
+
+    with e.get_session() as session:
+        scheduler.run_forever(lambda: run(log, session=session), interval=interval)
+
+
+def cmd_archive(args, log):
+    """Archives the downloaded files (see archive.compact)"""
+
+    import pkg.archive as a
+
+    keep_days = a.ARCHIVE_KEEP_DAYS if args.keep_days is None else args.keep_days
+    a.compact(keep_days=keep_days)
+
+
+def cmd_snapshot(args, log):
+    """Saves a source as it was archived on args.as_of (see
+    archive.read_snapshot) to args.output"""
+
+    import pkg.archive as a
+
+    df = a.read_snapshot(args.category, as_of=args.as_of)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    df.to_csv(args.output, index=False)
+
+    log.info(f"{len(df)} rows of {args.category} saved in {args.output}")
+
+
+# Function of each command (see get_parser)
+COMMANDS = {
+    "extract": cmd_extract,
+    "transform": cmd_transform,
+    "load": cmd_load,
+    "run": cmd_run,
+    "daemon": cmd_daemon,
+    "archive": cmd_archive,
+    "snapshot": cmd_snapshot,
+}
+
+
+def transform(csvs_dic):
+    """Transforms the files, or takes the result from the cache if a
+    previous run transformed the same files already (e.g. its load failed)
+
+    Args:
+        csvs_dic (dict): files to transform (key: category, value: csv file path)
+
+    Returns:
+        dict: transform's output (see transform.transform)
+    """
+
+    import pkg.cache as c
+    import pkg.transform as t
+
+    dfs_dic = c.get(csvs_dic)
+    if dfs_dic is None:
+        dfs_dic = t.transform(csvs_dic)
+        c.put(csvs_dic, dfs_dic)
+    return dfs_dic
+
+
+def run(log, session=None):
+    """Runs the extract, transform and load stages (see run_stages) and
+    writes the metrics of the run (see pkg/metrics.py)
+
+    Args:
+        log (logging.Logger): main logger
+        session (requests.Session, optional): HTTP session for the downloads. Defaults to None (a new one).
+
+    Returns:
+        dict: changed (False if transform and load were skipped) and seconds (key: stage, value: elapsed seconds)
+    """
+
+    import pkg.metrics as metrics
+
+    metrics.start_run()
+    result = "failed"
+    try:
+        out = run_stages(log, session)
+        result = "ok" if out["changed"] else "skipped"
+        return out
+    finally:
+        metrics.end_run(result)
+
+
+def run_stages(log, session=None):
+    """Runs the extract, transform and load stages
+
+    Args:
+        log (logging.Logger): main logger
+        session (requests.Session, optional): HTTP session for the downloads. Defaults to None (a new one).
+
+    Returns:
+        dict: see run
+    """
+
+    import pkg.extract as e
+    import pkg.load as l
+    import pkg.metrics as metrics
+    import pkg.profiling as profiling
+
+    seconds = {}
+
+    start = time.perf_counter()
+    with logger.span("extract"), profiling.stage("extract"):
+        csvs_dic = e.download_csvs(session=session)
+    seconds["extract"] = time.perf_counter() - start
+    metrics.record("pipeline.extract", seconds=seconds["extract"])
+
+    # Most of the days the sources don't change, in that case there's nothing
+    # new to transform or load
+    if not e.inputs_changed(csvs_dic):
+        log.info("No source has changed since the last run, skipping transform and load")
+        return {"changed": False, "seconds": seconds}
+
+    start = time.perf_counter()
+    with logger.span("transform"), profiling.stage("transform"):
+        dfs_dic = transform(csvs_dic)
+    seconds["transform"] = time.perf_counter() - start
+    metrics.record(
+        "pipeline.transform",
+        seconds=seconds["transform"],
+        rows_out=metrics.count_rows(dfs_dic),
+        bytes_read=sum(os.path.getsize(fname) for fname in csvs_dic.values()),
+    )
+
+    profiling.record_frames("load.input", dfs_dic)
+
+    start = time.perf_counter()
+    with logger.span("load"), profiling.stage("load"):
+        stats = l.load(dfs_dic)
+    seconds["load"] = time.perf_counter() - start
+    metrics.record(
+        "pipeline.load",
+        seconds=seconds["load"],
+        rows_out=sum(table["rows"] for table in stats.values()),
+        bytes_written=sum(table["bytes"] for table in stats.values()),
+    )
+
+    # Only now the files are fully processed, if transform or load fail the
+    # next run will process them again even if they don't change
+    e.mark_processed(csvs_dic)
+
+    import pkg.archive as a
+
+    if a.ARCHIVE_AFTER_RUN:
+        start = time.perf_counter()
+        with logger.span("archive"):
+            a.compact()
+        seconds["archive"] = time.perf_counter() - start
+
+    return {"changed": True, "seconds": seconds}
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,183 @@
+"""
+Synthetic sources for the benchmarks (see run.py).
+
+Writes csv files with the same raw header as each real source (spaces,
+accents and case included) and messy values like the real ones: provincias
+with and without accents or in different case, fuentes to be replaced by
+MANUAL_REPLACEMENTS and every spelling of espacio_INCAA. Scale 1 is about the
+size of the real files, and the same seed always gives the same files.
+
+Usage:
+    python -m benchmarks.generate --scale 10 --out data/benchmarks/sources
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# Raw headers of the real sources
+HEADERS = {
+    "museos_datosabiertos": "Cod_Loc,IdProvincia ,IdDepartamento ,Observaciones,categoria,subcategoria,provincia,localidad,nombre,direccion,piso,CP,cod_area,telefono,Mail,Web,Latitud,Longitud,TipoLatitudLongitud  ,Info_adicional,fuente,jurisdiccion,año_inauguracion,actualizacion",
+    "cine": "Cod_Loc,IdProvincia ,IdDepartamento ,Observaciones,Categoría,Provincia,Departamento,Localidad,Nombre,Dirección,Piso,CP,cod_area,Teléfono,Mail,Web,Información adicional,Latitud,Longitud,TipoLatitudLongitud  ,Fuente,tipo_gestion,Pantallas,Butacas,espacio_INCAA,año_actualizacion",
+    "biblioteca_popular": "Cod_Loc,IdProvincia ,IdDepartamento ,Observacion,Categoría,Subcategoria,Provincia,Departamento,Localidad,Nombre,Domicilio,Piso,CP,Cod_tel,Teléfono,Mail,Web,Información adicional,Latitud,Longitud,TipoLatitudLongitud  ,Fuente,Tipo_gestion,año_inicio,Año_actualizacion",
+}
+
+# Rows of each source at scale 1 (about the size of the real files)
+BASE_ROWS = {
+    "museos_datosabiertos": 1200,
+    "cine": 330,
+    "biblioteca_popular": 2000,
+}
+
+CATEGORIAS = {
+    "museos_datosabiertos": "Espacios de Exhibición Patrimonial",
+    "cine": "Salas de cine",
+    "biblioteca_popular": "Bibliotecas Populares",
+}
+
+# id_provincia: spellings found in the sources
+PROVINCIAS = {
+    2: ["Ciudad Autónoma de Buenos Aires", "Ciudad Autonoma de Buenos Aires"],
+    6: ["Buenos Aires", "BUENOS AIRES"],
+    14: ["Córdoba", "Cordoba", "córdoba"],
+    58: ["Neuquén ", "Neuquén", "NEUQUEN"],
+    82: ["Santa Fé", "Santa Fe"],
+    90: ["Tucumán", "Tucuman"],
+    94: [
+        "Tierra del Fuego, Antártida e Islas del Atlántico Sur",
+        "Tierra del Fuego",
+    ],
+}
+
+# Approximate center (latitud, longitud) of each provincia
+CENTERS = {
+    2: (-34.61, -58.44),
+    6: (-36.68, -60.56),
+    14: (-31.42, -64.18),
+    58: (-38.95, -68.06),
+    82: (-31.63, -60.70),
+    90: (-26.81, -65.22),
+    94: (-54.80, -68.30),
+}
+
+FUENTES = [
+    "Gob. Pcia.",
+    "GOB. PCIA.",
+    "CONABIP",
+    "INCAA / SInCA",
+    "DNPyM",
+    "Secretaría de Cultura",
+    None,
+]
+
+TELEFONOS = ["4444-5555", "(0351) 423 1234", "15 5555 1234", None]
+
+# espacio_INCAA as it comes in the cine source
+ESPACIO_INCAA = ["SI", "si", "Si ", "sí", "NO", "no", "0", None]
+
+
+def generate_source(category, rows, rng):
+    """Returns a DataFrame with the raw layout of a source
+
+    Args:
+        category (str): source category. Example: cine
+        rows (int): number of rows
+        rng (numpy.random.Generator): random generator
+
+    Returns:
+        pandas.DataFrame: source data, with the raw header as columns
+    """
+
+    id_provincia = rng.choice(list(PROVINCIAS), size=rows)
+    # Any of the spellings of each provincia
+    spelling = rng.integers(0, 6, size=rows)
+    provincia = [
+        PROVINCIAS[p][i % len(PROVINCIAS[p])] for p, i in zip(id_provincia, spelling)
+    ]
+    id_departamento = id_provincia * 1000 + rng.integers(1, 30, size=rows) * 7
+    cod_loc = id_departamento * 1000 + rng.integers(1, 40, size=rows)
+    centers = np.array([CENTERS[p] for p in id_provincia])
+    coords = centers + rng.normal(0, 0.5, size=(rows, 2))
+    nro = rng.integers(1, 5000, size=rows)
+
+    values = {
+        "cod_loc": cod_loc,
+        "idprovincia": id_provincia,
+        "iddepartamento": id_departamento,
+        "categoria": CATEGORIAS[category],
+        "categoría": CATEGORIAS[category],
+        "provincia": provincia,
+        "departamento": [f"Departamento {d % 1000}" for d in id_departamento],
+        "localidad": [f"Localidad {c % 1000}" for c in cod_loc],
+        "nombre": [
+            f"{CATEGORIAS[category].split()[0]} {n}"
+            for n in rng.integers(1, rows + 1, size=rows)
+        ],
+        "direccion": [f"Av. San Martín {n}" for n in nro],
+        "dirección": [f"Av. San Martín {n}" for n in nro],
+        "domicilio": [f"Av. San Martín {n}" for n in nro],
+        "cp": rng.choice(["C1425", "5000", "X5000ABC", None], size=rows),
+        "cod_area": rng.choice(["11", "351", "0299", None], size=rows),
+        "cod_tel": rng.choice(["11", "351", "0299", None], size=rows),
+        "telefono": rng.choice(TELEFONOS, size=rows),
+        "teléfono": rng.choice(TELEFONOS, size=rows),
+        "mail": rng.choice(["contacto@ejemplo.org.ar", "s/d", None], size=rows),
+        "web": rng.choice(["https://ejemplo.org.ar", None], size=rows),
+        "latitud": coords[:, 0].round(6),
+        "longitud": coords[:, 1].round(6),
+        "tipolatitudlongitud": "Localización precisa",
+        "fuente": rng.choice(np.array(FUENTES, dtype=object), size=rows),
+        "pantallas": rng.integers(1, 12, size=rows),
+        "butacas": rng.integers(40, 2500, size=rows),
+        "espacio_incaa": rng.choice(np.array(ESPACIO_INCAA, dtype=object), size=rows),
+    }
+
+    raw_cols = HEADERS[category].split(",")
+    return pd.DataFrame(
+        {raw: values.get(raw.strip().lower(), None) for raw in raw_cols},
+        index=pd.RangeIndex(rows),
+        columns=raw_cols,
+    )
+
+
+def generate(out_dir, scale=1, seed=0):
+    """Writes the synthetic sources of a scale, unless they already exist
+
+    Args:
+        out_dir (str): destination folder
+        scale (int, optional): size multiplier (1 is about the real size). Defaults to 1.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: written files (key: category, value: csv file path)
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+    csvs_dic = {}
+
+    for idx, category in enumerate(HEADERS):
+        fname = os.path.join(out_dir, f"{category}.csv")
+        if not os.path.exists(fname):
+            # One generator per source, so each file doesn't depend on the
+            # others
+            rng = np.random.default_rng([seed, scale, idx])
+            df = generate_source(category, BASE_ROWS[category] * scale, rng)
+            df.to_csv(fname + ".tmp", index=False, encoding="utf-8")
+            os.replace(fname + ".tmp", fname)
+        csvs_dic[category] = fname
+
+    return csvs_dic
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=os.path.join("data", "benchmarks", "sources"))
+    args = parser.parse_args()
+
+    for category, fname in generate(
+        os.path.join(args.out, f"{args.scale}x"), args.scale, args.seed
+    ).items():
+        print(category, fname)
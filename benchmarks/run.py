@@ -0,0 +1,262 @@
+"""
+Benchmarks of each stage of the pipeline over synthetic sources (see
+generate.py) at several scales:
+
+- download: download_csvs from a local HTTP server, full downloads (cold)
+  and conditional requests answered with 304 (warm)
+- transform: the whole transform and each of its steps (read_source per
+  source, standarize_data and the set_t* builders)
+- load: load.load into LOAD_SINK (sqlite by default, postgres needs the
+  POSTGRES_* settings)
+
+Every measure is repeated and the results are written as JSON to compare
+them across changes.
+
+Usage:
+    python -m benchmarks.run --scales 1 10 100 --repeat 3 --sink sqlite
+"""
+import argparse
+import datetime
+import functools
+import http.server
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(func, repeat):
+    """Runs func repeat times
+
+    Args:
+        func (function): function without arguments
+        repeat (int): number of runs
+
+    Returns:
+        tuple: seconds of each run and the result of the last one
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    return runs, result
+
+
+def get_result(scale, stage, runs, rows, size):
+    """Returns the record of a measure (see measure)"""
+    median = statistics.median(runs)
+    return {
+        "scale": scale,
+        "stage": stage,
+        "rows": rows,
+        "bytes": size,
+        "runs": runs,
+        "median_s": median,
+        "min_s": min(runs),
+        "rows_per_s": rows / median if median else None,
+    }
+
+
+def serve(directory):
+    """Serves a folder over HTTP on a free local port (Last-Modified and
+    If-Modified-Since included), in a background thread.
+
+    Returns:
+        http.server.ThreadingHTTPServer: running server
+    """
+
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_meta(args):
+    """Returns what's needed to compare runs: code version, versions of the
+    main packages, machine and arguments"""
+    import numpy as np
+    import pandas as pd
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }
+
+
+def run(args):
+    """Runs the benchmarks and returns the report"""
+
+    import benchmarks.generate as g
+    import pkg.dedup as dd
+    import pkg.extract as e
+    import pkg.load as l
+    import pkg.transform as t
+
+    # The pipeline's messages would be mixed with the results
+    for name in list(logging.root.manager.loggerDict):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    sources_dir = os.path.join(args.workdir, "sources")
+    server = serve(sources_dir)
+    results = []
+
+    try:
+        for scale in args.scales:
+            csvs_dic = g.generate(
+                os.path.join(sources_dir, f"{scale}x"), scale, args.seed
+            )
+            rows = sum(g.BASE_ROWS[cat] * scale for cat in csvs_dic)
+            size = sum(os.path.getsize(fname) for fname in csvs_dic.values())
+            print(f"Scale {scale}x: {rows} rows, {size / 2**20:.1f} MB")
+
+            if "download" in args.stages:
+                urls = {
+                    cat: f"http://127.0.0.1:{server.server_address[1]}/{scale}x/{cat}.csv"
+                    for cat in csvs_dic
+                }
+
+                e.EXTRACT_CACHE = False
+                runs, _ = measure(lambda: e.download_csvs(urls), args.repeat)
+                results.append(get_result(scale, "download.cold", runs, rows, size))
+
+                e.EXTRACT_CACHE = True
+                e.download_csvs(urls)
+                runs, _ = measure(lambda: e.download_csvs(urls), args.repeat)
+                results.append(get_result(scale, "download.not_modified", runs, rows, size))
+
+            if "transform" in args.stages or "load" in args.stages:
+                runs, out_dfs_dic = measure(lambda: t.transform(csvs_dic), args.repeat)
+                results.append(get_result(scale, "transform", runs, rows, size))
+
+            if "transform" in args.stages:
+                dfs_dic = {}
+                for cat, fname in csvs_dic.items():
+                    runs, dfs_dic[cat] = measure(
+                        lambda: t.read_source(cat, fname), args.repeat
+                    )
+                    results.append(
+                        get_result(
+                            scale,
+                            f"transform.read_source.{cat}",
+                            runs,
+                            len(dfs_dic[cat]),
+                            os.path.getsize(fname),
+                        )
+                    )
+
+                # standarize_data works in place, every run gets a fresh copy
+                runs = []
+                for _ in range(args.repeat):
+                    copy_dic = {cat: df.copy() for cat, df in dfs_dic.items()}
+                    start = time.perf_counter()
+                    std_dic = t.standarize_data(copy_dic)
+                    runs.append(time.perf_counter() - start)
+                results.append(
+                    get_result(scale, "transform.standarize_data", runs, rows, size)
+                )
+
+                t1_df = t.set_t1_registros_unificados(list(std_dic.values()))
+                builders = {
+                    "set_t1_registros_unificados": lambda: t.set_t1_registros_unificados(
+                        list(std_dic.values())
+                    ),
+                    "set_t2_registros_totales": lambda: t.set_t2_registros_totales(
+                        list(std_dic.values())
+                    ),
+                    "set_t3_totales_cine": lambda: t.set_t3_totales_cine(std_dic["cine"]),
+                    "set_t4_totales_geo": lambda: t.set_t4_totales_geo(std_dic),
+                    "deduplicate": lambda: dd.Deduplicator("tag").apply(t1_df),
+                }
+                for step, func in builders.items():
+                    runs, _ = measure(func, args.repeat)
+                    results.append(
+                        get_result(scale, f"transform.{step}", runs, rows, size)
+                    )
+
+            if "load" in args.stages:
+                runs, _ = measure(
+                    lambda: l.load(dict(out_dfs_dic), sink=args.sink), args.repeat
+                )
+                results.append(get_result(scale, f"load.{args.sink}", runs, rows, size))
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {"meta": get_meta(args), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=["download", "transform", "load"],
+        default=["download", "transform", "load"],
+    )
+    parser.add_argument("--sink", default="sqlite")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(ROOT_DIR, "data", "benchmarks"),
+        help="Folder for the sources and everything the pipeline writes (data/, logs/)",
+    )
+    parser.add_argument("--out", help="JSON report. Defaults to <workdir>/results/<date>.json")
+    args = parser.parse_args()
+
+    args.workdir = os.path.abspath(args.workdir)
+    out = args.out or os.path.join(
+        args.workdir, "results", f"{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    out = os.path.abspath(out)
+
+    # The pipeline's modules place their files (downloads, manifest, logs,
+    # sqlite database) under the working directory when imported
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    sys.path.insert(0, ROOT_DIR)
+
+    report = run(args)
+
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=4)
+
+    for result in report["results"]:
+        print(
+            f"{result['scale']:>6}x {result['stage']:<45} {result['median_s']:9.4f}s "
+            f"{(result['rows_per_s'] or 0):>12.0f} rows/s"
+        )
+    print(f"Results written to {out}")
+
+
+if __name__ == "__main__":
+    main()
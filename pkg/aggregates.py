@@ -0,0 +1,291 @@
+import os
+
+import decouple as d
+import numpy as np
+import pandas as pd
+
+import pkg.logger as logger
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Maintain registros_totales and totales_cine from the rows that changed
+# since the previous run, instead of aggregating all the rows again (see
+# MaintainedAggregate)
+AGGREGATES_INCREMENTAL = d.config("AGGREGATES_INCREMENTAL", default=False, cast=bool)
+
+# Folder of the state of each maintained aggregate: the rows it was computed
+# from (see MaintainedAggregate) and the aggregates themselves
+AGGREGATES_STATE_DIR = d.config(
+    "AGGREGATES_STATE_DIR", default=os.path.join(os.getcwd(), "data", "aggregates")
+)
+
+# Every this many refreshes the aggregates are also computed from all the
+# rows and compared with the maintained ones. 1 checks every refresh, 0
+# never.
+AGGREGATES_CHECK_EVERY = d.config("AGGREGATES_CHECK_EVERY", default=10, cast=int)
+
+# Hidden aggregate of every maintained table: rows per group. A group is
+# removed when its last row is deleted, whatever its other aggregates add up
+# to.
+ROWS_COL = "_rows"
+
+
+def get_input_cols(grain, aggregates):
+    """Columns an aggregate is computed from: the grain columns and the input
+    columns of the aggregates (see transform.aggregate_partial)"""
+    inputs = [col for col, _ in aggregates.values() if col is not None]
+    return list(dict.fromkeys(grain + inputs))
+
+
+def weighted_partial(df, weights, grain, aggregates):
+    """Aggregates df by grain, each row counted weights times. Negative
+    weights take rows out of the aggregates: the result of the deleted rows
+    of a table is the one of its inserted rows with the sign changed.
+
+    Args:
+        df (pandas.DataFrame): rows (at least the columns of get_input_cols)
+        weights (array-like): times each row is counted (int)
+        grain (list of str): columns to group by
+        aggregates (dict): key: output column, value: (input column, function). function is "size", "sum" or "count" (see transform.aggregate_partial).
+
+    Returns:
+        pandas.DataFrame: grain columns + output columns + ROWS_COL, one row per group (NaN is a group)
+    """
+
+    weights = np.asarray(weights, dtype="int64")
+    # Grouped as objects: pandas < 2 leaves out the NaN groups of
+    # categorical columns
+    frame = df[grain].astype(object)
+    frame[ROWS_COL] = weights
+
+    for out, (col, func) in aggregates.items():
+        if func == "size":
+            frame[out] = weights
+        elif func == "sum":
+            # .array keeps nullable integers as such
+            frame[out] = (df[col].fillna(0) * weights).array
+        elif func == "count":
+            frame[out] = df[col].notna().to_numpy() * weights
+        else:
+            raise ValueError(f"Aggregate {out}: {func} can't be maintained, use size, sum or count")
+
+    # Groups are kept even if their rows add up to 0: an update within a
+    # group still changes its sums
+    return merge_partials([frame], grain, aggregates, drop_empty=False)
+
+
+def merge_partials(partials, grain, aggregates, drop_empty=True):
+    """Adds up partial aggregates (see weighted_partial) group by group
+
+    Args:
+        partials (list of pandas.DataFrame): partial aggregates
+        grain (list of str): grain columns
+        aggregates (dict): see weighted_partial
+        drop_empty (bool, optional): leave out the groups left without rows. Defaults to True.
+
+    Returns:
+        pandas.DataFrame: grain columns + output columns + ROWS_COL
+    """
+
+    sums = list(aggregates) + [ROWS_COL]
+    frame = pd.concat(partials, ignore_index=True)
+    frame[grain] = frame[grain].astype(object)
+
+    out_df = frame.groupby(grain, dropna=False, sort=False)[sums].sum().reset_index()
+    if drop_empty:
+        out_df = out_df[out_df[ROWS_COL] != 0].reset_index(drop=True)
+    return out_df
+
+
+def apply_deltas(partial, inserted, deleted, grain, aggregates):
+    """Applies the rows inserted and deleted from a table to its aggregates.
+    An updated row is the deletion of its old values and the insertion of
+    the new ones.
+
+    Args:
+        partial (pandas.DataFrame): aggregates before the change (see weighted_partial)
+        inserted (pandas.DataFrame): rows inserted
+        deleted (pandas.DataFrame): rows deleted
+        grain (list of str): grain columns
+        aggregates (dict): see weighted_partial
+
+    Returns:
+        pandas.DataFrame: aggregates after the change
+    """
+    return merge_partials(
+        [
+            partial,
+            weighted_partial(inserted, np.ones(len(inserted)), grain, aggregates),
+            weighted_partial(deleted, -np.ones(len(deleted)), grain, aggregates),
+        ],
+        grain,
+        aggregates,
+    )
+
+
+class MaintainedAggregate:
+    """Aggregates of a table kept up to date from run to run.
+
+    The rows of every run are hashed on the columns the aggregates need (see
+    get_input_cols) and counted by hash. The table is stored between runs as
+    that multiset of hashes (with the values of each distinct hash) along
+    with the aggregates. Comparing it with the current one gives the rows
+    inserted (more rows with a hash than before) and deleted (fewer), and
+    only those are aggregated and applied to the stored aggregates (see
+    weighted_partial). Every AGGREGATES_CHECK_EVERY refreshes the aggregates
+    are also computed from all the rows, to confirm the maintained ones.
+
+    Usage:
+        aggregate = MaintainedAggregate("totales_cine", ["provincia"], CINE_AGGREGATES)
+        for chunk in chunks:
+            aggregate.add(chunk)
+        partial = aggregate.refresh()
+    """
+
+    def __init__(self, name, grain, aggregates, state_dir=None):
+        """
+        Args:
+            name (str): table name, names the state file
+            grain (list of str): columns to group by
+            aggregates (dict): see weighted_partial
+            state_dir (str, optional): folder of the state. Defaults to None (AGGREGATES_STATE_DIR).
+        """
+        self.name = name
+        self.grain = list(grain)
+        self.aggregates = aggregates
+        self.cols = get_input_cols(self.grain, aggregates)
+        self.state_fname = os.path.join(
+            AGGREGATES_STATE_DIR if state_dir is None else state_dir, f"{name}.pkl"
+        )
+        # Identifies the aggregates, a state saved for others is not used
+        self.signature = repr((self.grain, sorted(aggregates.items())))
+
+        # Rows added this run: times each hash was seen, and the values of
+        # each hash
+        self.counts = pd.Series(dtype="int64", index=pd.Index([], dtype="uint64"))
+        self.rows = None
+        self.stats = {}
+
+    def add(self, df):
+        """Adds rows of the current version of the table (e.g. a chunk)
+
+        Args:
+            df (pandas.DataFrame): rows, at least the columns of get_input_cols
+        """
+
+        df = df[self.cols]
+        hashes = pd.Index(pd.util.hash_pandas_object(df, index=False).to_numpy())
+
+        counts = pd.Series(hashes).value_counts()
+        self.counts = self.counts.add(counts, fill_value=0).astype("int64")
+
+        new = ~hashes.duplicated()
+        if self.rows is not None:
+            new &= ~hashes.isin(self.rows.index)
+        rows = df[new].set_axis(hashes[new])
+        self.rows = rows if self.rows is None else pd.concat([self.rows, rows])
+
+    def read_state(self):
+        """Returns the state saved by the last refresh (see write_state), or
+        None if there is none or it's of other aggregates"""
+        if not os.path.exists(self.state_fname):
+            return None
+        state = pd.read_pickle(self.state_fname)
+        if state["signature"] != self.signature:
+            log.info(f"{self.name}: aggregates changed, computing them again")
+            return None
+        return state
+
+    def write_state(self, state):
+        """Saves the state. It's written to a temporary file first and then
+        renamed, so an interrupted run can't leave it corrupted."""
+        os.makedirs(os.path.dirname(self.state_fname), exist_ok=True)
+        tmp_fname = self.state_fname + ".tmp"
+        pd.to_pickle(state, tmp_fname)
+        os.replace(tmp_fname, self.state_fname)
+
+    def get_full_partial(self):
+        """Aggregates computed from all the rows added (see add)"""
+        return weighted_partial(
+            self.rows, self.counts.reindex(self.rows.index), self.grain, self.aggregates
+        )
+
+    def is_correct(self, partial):
+        """Returns True if partial matches the aggregates of all the rows
+        added: their difference is 0 in every group"""
+        sums = list(self.aggregates) + [ROWS_COL]
+        maintained = partial.copy()
+        maintained[sums] *= -1
+        diff = merge_partials(
+            [self.get_full_partial(), maintained], self.grain, self.aggregates, drop_empty=False
+        )
+        return bool((diff[sums] == 0).all(axis=None))
+
+    @logger.traced
+    def refresh(self):
+        """Applies the rows inserted and deleted since the last refresh to
+        the stored aggregates, and saves the current rows and aggregates for
+        the next one
+
+        Returns:
+            pandas.DataFrame: grain columns + output columns, one row per group (see transform.rollup)
+        """
+
+        if self.rows is None:
+            self.rows = pd.DataFrame(columns=self.cols).set_axis(pd.Index([], dtype="uint64"))
+
+        state = self.read_state()
+        if state is None:
+            # Every row is an insertion
+            state = {
+                "rows": self.rows.iloc[:0].assign(_count=np.int64(0)),
+                "partial": weighted_partial(self.rows.iloc[:0], [], self.grain, self.aggregates),
+                "refreshes": 0,
+            }
+
+        # Signed change of the times each distinct row appears
+        previous = state["rows"]
+        changes = self.counts.sub(previous["_count"], fill_value=0).astype("int64")
+        changes = changes[changes != 0]
+        known = pd.concat([self.rows, previous[self.cols]])
+        delta = known[~known.index.duplicated()].reindex(changes.index)
+
+        partial = merge_partials(
+            [
+                state["partial"],
+                weighted_partial(delta, changes.to_numpy(), self.grain, self.aggregates),
+            ],
+            self.grain,
+            self.aggregates,
+        )
+
+        refreshes = state["refreshes"] + 1
+        if AGGREGATES_CHECK_EVERY > 0 and refreshes % AGGREGATES_CHECK_EVERY == 0:
+            if not self.is_correct(partial):
+                log.warning(
+                    f"{self.name}: maintained aggregates don't match the full computation, replaced"
+                )
+                partial = self.get_full_partial()
+
+        self.write_state(
+            {
+                "signature": self.signature,
+                "rows": self.rows.assign(_count=self.counts.reindex(self.rows.index)),
+                "partial": partial,
+                "refreshes": refreshes,
+            }
+        )
+
+        self.stats = {
+            "rows": int(self.counts.sum()),
+            "inserted": int(changes[changes > 0].sum()),
+            "deleted": int(-changes[changes < 0].sum()),
+            "groups": len(partial),
+        }
+        log.info(
+            f"{self.name} maintained: {self.stats['inserted']} rows inserted, "
+            f"{self.stats['deleted']} deleted of {self.stats['rows']}, {self.stats['groups']} groups"
+        )
+
+        return partial.drop(columns=ROWS_COL)
@@ -0,0 +1,303 @@
+import datetime as dt
+import glob
+import json
+import os
+import re
+
+import decouple as d
+import pandas as pd
+
+import pkg.cache as c
+import pkg.extract as e
+import pkg.logger as logger
+import pkg.sinks as sk
+import pkg.transform as t
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Root folder of the archive: one Parquet file per distinct snapshot of each
+# source, in <category>/date=<yyyy-mm-dd>/ (the date it was first seen),
+# plus the index of all of them (ARCHIVE_MANIFEST)
+ARCHIVE_DIR = d.config(
+    "ARCHIVE_DIR", default=os.path.join(os.getcwd(), "data", "archive")
+)
+ARCHIVE_MANIFEST = os.path.join(ARCHIVE_DIR, "manifest.json")
+
+# Parquet compression codec of the snapshots
+ARCHIVE_COMPRESSION = d.config("ARCHIVE_COMPRESSION", default="zstd")
+
+# Days the raw csv files are kept after being archived. The files of the
+# last download of each source are always kept (see
+# extract.MANIFEST_FILE). -1 keeps them all.
+ARCHIVE_KEEP_DAYS = d.config("ARCHIVE_KEEP_DAYS", default=7, cast=int)
+
+# Archive the raw files at the end of every run that loaded new data (see
+# app.run)
+ARCHIVE_AFTER_RUN = d.config("ARCHIVE_AFTER_RUN", default=False, cast=bool)
+
+# Folder of the raw files written by extract (see extract.get_abspath)
+RAW_DIR = os.path.join(os.getcwd(), "data")
+
+# Name of the raw files: <category>-dd-mm-yyyy.csv. The date is taken from
+# it, not from the month folder (named in Spanish).
+RAW_FNAME_RE = re.compile(
+    r"(?P<category>.+)-(?P<dd>\d{2})-(?P<mm>\d{2})-(?P<yyyy>\d{4})\.csv"
+)
+
+
+def read_index(fname=ARCHIVE_MANIFEST):
+    """Returns the archive's index (key: category, value: list of snapshots
+    sorted by date, see compact), or an empty dict if there is none yet."""
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def write_index(index, fname=ARCHIVE_MANIFEST):
+    """Saves the archive's index. It's written to a temporary file first and
+    then renamed, so an interrupted compaction can't leave it corrupted."""
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    os.replace(tmp_fname, fname)
+
+
+def find_raw_files(categories, raw_dir=RAW_DIR):
+    """Returns the raw files downloaded by extract
+
+    Args:
+        categories (iterable of str): sources to look for. Example: extract.URLS' keys
+        raw_dir (str, optional): downloads folder. Defaults to RAW_DIR.
+
+    Returns:
+        list of tuple: (category, date, file path), sorted by category and date
+    """
+
+    found = []
+    for category in categories:
+        for fname in glob.glob(os.path.join(raw_dir, category, "*", "*.csv")):
+            match = RAW_FNAME_RE.fullmatch(os.path.basename(fname))
+            if match is None or match["category"] != category:
+                continue
+            date = dt.date(int(match["yyyy"]), int(match["mm"]), int(match["dd"]))
+            found.append((category, date, fname))
+
+    return sorted(found)
+
+
+def write_snapshot(category, date, csv_file, sha256, root=ARCHIVE_DIR):
+    """Converts a raw file to Parquet. Every column is kept as text, so the
+    snapshot holds the file as it was downloaded (parsed, not cleaned up).
+
+    Args:
+        category (str): source category. Example: cine
+        date (datetime.date): download date
+        csv_file (str): raw csv file path
+        sha256 (str): hash of the raw file, names the Parquet file
+        root (str, optional): archive folder. Defaults to ARCHIVE_DIR.
+
+    Returns:
+        tuple: path (relative to root), rows and size in bytes
+    """
+
+    pa = sk.import_optional("pyarrow", "archive")
+    pq = sk.import_optional("pyarrow.parquet", "archive")
+
+    df = pd.read_csv(
+        csv_file,
+        dtype=str,
+        # Empty fields stay empty strings instead of NaN
+        keep_default_na=False,
+        encoding=t.SCHEMAS.get(category, {}).get("encoding", "utf-8"),
+    )
+
+    rel_path = os.path.join(
+        category, f"date={date:%Y-%m-%d}", f"{sha256[:16]}.parquet"
+    )
+    full_path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+    # Written to a temporary file and renamed, so an interrupted compaction
+    # can't leave a half written snapshot
+    tmp_path = full_path + ".tmp"
+    pq.write_table(
+        pa.Table.from_pandas(df, preserve_index=False),
+        tmp_path,
+        compression=ARCHIVE_COMPRESSION,
+    )
+    os.replace(tmp_path, full_path)
+
+    return rel_path, len(df), os.path.getsize(full_path)
+
+
+@logger.traced
+def compact(
+    categories=e.URLS.keys(),
+    keep_days=ARCHIVE_KEEP_DAYS,
+    raw_dir=RAW_DIR,
+    root=ARCHIVE_DIR,
+):
+    """Archives the raw files downloaded by extract and removes the old ones.
+
+    Every raw file is hashed. Its content is stored as a compressed Parquet
+    file (see write_snapshot) only if no previous download of the source had
+    the same hash. Otherwise the index just records that on that date the
+    source was the same as the snapshot already stored. The index
+    (ARCHIVE_MANIFEST) lists, per category and date: sha256, Parquet file,
+    rows and the size of the raw and Parquet files.
+
+    Archived raw files older than keep_days are removed, except the ones of
+    the last download of each source (extract needs them to skip unchanged
+    downloads), along with the month folders left empty.
+
+    Args:
+        categories (iterable of str, optional): sources to archive. Defaults to extract.URLS' keys.
+        keep_days (int, optional): days the raw files are kept, -1 to keep them all. Defaults to ARCHIVE_KEEP_DAYS.
+        raw_dir (str, optional): downloads folder. Defaults to RAW_DIR.
+        root (str, optional): archive folder. Defaults to ARCHIVE_DIR.
+
+    Returns:
+        dict: counts of raw files: archived (new content), deduplicated (content already archived), removed
+    """
+
+    index_fname = os.path.join(root, os.path.basename(ARCHIVE_MANIFEST))
+    index = read_index(index_fname)
+    counts = {"archived": 0, "deduplicated": 0, "removed": 0}
+
+    # Files of the last download of each source
+    in_use = {os.path.normpath(entry["path"]) for entry in e.read_manifest().values()}
+    today = dt.date.today()
+
+    for category, date, csv_file in find_raw_files(categories, raw_dir):
+        snapshots = index.setdefault(category, [])
+        # key: date, value: snapshot. Snapshots by hash, to reuse their file.
+        by_date = {snapshot["date"]: snapshot for snapshot in snapshots}
+        by_hash = {snapshot["sha256"]: snapshot for snapshot in snapshots}
+
+        sha256 = c.hash_file(csv_file).hexdigest()
+        iso_date = date.isoformat()
+
+        # Not archived yet, or downloaded again the same day with a different
+        # content (the snapshot of the day is replaced)
+        if by_date.get(iso_date, {}).get("sha256") != sha256:
+            if sha256 in by_hash:
+                snapshot = dict(by_hash[sha256], date=iso_date)
+                counts["deduplicated"] += 1
+            else:
+                path, rows, size = write_snapshot(category, date, csv_file, sha256, root)
+                snapshot = {
+                    "date": iso_date,
+                    "sha256": sha256,
+                    "path": path,
+                    "rows": rows,
+                    "raw_bytes": os.path.getsize(csv_file),
+                    "bytes": size,
+                }
+                counts["archived"] += 1
+                log.info(
+                    f"{category} {iso_date} archived: {rows} rows, "
+                    f"{snapshot['raw_bytes']} --> {size} bytes"
+                )
+
+            by_date[iso_date] = snapshot
+            index[category] = sorted(by_date.values(), key=lambda x: x["date"])
+
+            # Saved after every file: if the compaction is interrupted, the
+            # archived files are not processed again
+            write_index(index, index_fname)
+
+        if (
+            keep_days >= 0
+            and (today - date).days > keep_days
+            and os.path.normpath(csv_file) not in in_use
+        ):
+            os.remove(csv_file)
+            counts["removed"] += 1
+            # The month folder, once it's empty
+            try:
+                os.rmdir(os.path.dirname(csv_file))
+            except OSError:
+                pass
+
+    remove_unused_snapshots(index, root)
+
+    log.info(
+        f"Archive compacted: {counts['archived']} files archived, "
+        f"{counts['deduplicated']} deduplicated, {counts['removed']} raw files removed"
+    )
+    return counts
+
+
+def remove_unused_snapshots(index, root=ARCHIVE_DIR):
+    """Removes the Parquet files no date of the index points to anymore
+    (e.g. the first download of a day that was downloaded again)
+
+    Args:
+        index (dict): archive's index (see read_index)
+        root (str, optional): archive folder. Defaults to ARCHIVE_DIR.
+    """
+
+    used = {
+        os.path.normpath(os.path.join(root, snapshot["path"]))
+        for snapshots in index.values()
+        for snapshot in snapshots
+    }
+    for fname in glob.glob(os.path.join(root, "*", "date=*", "*.parquet")):
+        if os.path.normpath(fname) not in used:
+            os.remove(fname)
+            try:
+                os.rmdir(os.path.dirname(fname))
+            except OSError:
+                pass
+
+
+def get_snapshot_entry(category, as_of=None, index=None):
+    """Returns the index entry of the snapshot of a source as of a date: the
+    last one archived on or before it.
+
+    Args:
+        category (str): source category. Example: cine
+        as_of (datetime.date or str, optional): date (or ISO date, yyyy-mm-dd). Defaults to None (the latest).
+        index (dict, optional): archive's index. Defaults to None (read from ARCHIVE_MANIFEST).
+
+    Raises:
+        ValueError: there is no snapshot of the category on or before as_of
+
+    Returns:
+        dict: index entry (date, sha256, path, rows, raw_bytes, bytes)
+    """
+
+    index = read_index() if index is None else index
+    snapshots = index.get(category, [])
+
+    if as_of is not None:
+        as_of = dt.date.fromisoformat(str(as_of)[:10]).isoformat()
+        snapshots = [snapshot for snapshot in snapshots if snapshot["date"] <= as_of]
+
+    if not snapshots:
+        raise ValueError(f"No archived snapshot of {category} as of {as_of or 'today'}")
+
+    return snapshots[-1]
+
+
+@logger.traced
+def read_snapshot(category, as_of=None, columns=None, root=ARCHIVE_DIR):
+    """Reads a source as it was on a date (see get_snapshot_entry), using
+    the index instead of looking for the raw files.
+
+    Args:
+        category (str): source category. Example: cine
+        as_of (datetime.date or str, optional): date (or ISO date, yyyy-mm-dd). Defaults to None (the latest).
+        columns (list of str, optional): raw column names to read. Defaults to None (all).
+        root (str, optional): archive folder. Defaults to ARCHIVE_DIR.
+
+    Returns:
+        pandas.DataFrame: the source's raw columns, as text
+    """
+
+    index = read_index(os.path.join(root, os.path.basename(ARCHIVE_MANIFEST)))
+    entry = get_snapshot_entry(category, as_of, index)
+    return pd.read_parquet(os.path.join(root, entry["path"]), columns=columns)
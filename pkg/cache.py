@@ -0,0 +1,280 @@
+import datetime as dt
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+
+import decouple as d
+import pandas as pd
+
+import pkg.aggregates as ag
+import pkg.dedup as dd
+import pkg.logger as logger
+import pkg.metrics as metrics
+import pkg.spatial as sp
+import pkg.transform as t
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Reuse the output of transform when it's called again with the same input
+# files and the same transform code (e.g. retrying a failed load)
+TRANSFORM_CACHE = d.config("TRANSFORM_CACHE", default=True, cast=bool)
+
+# Folder of the cache, one sub folder per entry (named after its key)
+TRANSFORM_CACHE_DIR = d.config(
+    "TRANSFORM_CACHE_DIR", default=os.path.join(os.getcwd(), "data", "transform_cache")
+)
+
+# Max size of the cache. When it's exceeded, the least recently used entries
+# are removed.
+TRANSFORM_CACHE_MAX_MB = d.config("TRANSFORM_CACHE_MAX_MB", default=500, cast=float)
+
+# Source files of the code that produces the cached tables. Any change to
+# them invalidates the cache.
+CODE_FILES = [t.__file__, dd.__file__, sp.__file__, ag.__file__]
+
+# Size (in bytes) of the blocks read when hashing files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Rows per block when setting dt_loaded on the tables cached as csv files
+# (see set_dt_loaded)
+REWRITE_CHUNKSIZE = 100000
+
+
+def hash_file(fname, sha256=None):
+    """Returns the SHA-256 of a file's content
+
+    Args:
+        fname (str): file path
+        sha256 (hashlib._Hash, optional): hash to update instead of creating a new one. Defaults to None.
+
+    Returns:
+        hashlib._Hash: updated hash
+    """
+    sha256 = sha256 or hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256
+
+
+def get_key(csvs_dic, chunksize=t.TRANSFORM_CHUNKSIZE):
+    """Returns the cache key of a transform call: a hash of the content of
+    the input files, the transform code (CODE_FILES), the mode (in memory
+    or streaming, which return different kinds of values) and DEDUP.
+
+    Args:
+        csvs_dic (dict): files to transform (key: category, value: csv file path)
+        chunksize (int, optional): transform's chunksize. Defaults to t.TRANSFORM_CHUNKSIZE.
+
+    Returns:
+        str: cache key (hex digest)
+    """
+
+    sha256 = hashlib.sha256()
+
+    for fname in CODE_FILES:
+        hash_file(fname, sha256)
+
+    sha256.update(f"streaming={bool(chunksize)}".encode())
+    sha256.update(f"dedup={dd.DEDUP}".encode())
+    sha256.update(f"spatial={sp.SPATIAL_PRECISION},{sp.SPATIAL_RADIUS_KM}".encode())
+
+    for category, csv_file in sorted(csvs_dic.items()):
+        sha256.update(category.encode())
+        hash_file(csv_file, sha256)
+
+    return sha256.hexdigest()
+
+
+def save_frames(path, dfs_dic):
+    """Saves the tables in a folder, along with a meta.json file describing
+    them (see load_frames). DataFrames are saved as Parquet if pyarrow is
+    installed, or pickled otherwise, so their dtypes are kept. csv files are
+    copied as they are.
+
+    Args:
+        path (str): destination folder (created if it doesn't exist)
+        dfs_dic (dict): tables (key: table name, value: DataFrame or csv file path)
+    """
+
+    os.makedirs(path, exist_ok=True)
+    parquet = importlib.util.find_spec("pyarrow") is not None
+    meta = {}
+
+    for tb, df in dfs_dic.items():
+        if isinstance(df, str):
+            fname = tb + ".csv"
+            shutil.copyfile(df, os.path.join(path, fname))
+        elif parquet:
+            fname = tb + ".parquet"
+            df.to_parquet(os.path.join(path, fname), index=False)
+        else:
+            fname = tb + ".pkl"
+            df.to_pickle(os.path.join(path, fname))
+        meta[tb] = fname
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+def load_frames(path):
+    """Reads the tables saved by save_frames
+
+    Args:
+        path (str): folder written by save_frames
+
+    Returns:
+        dict: tables (key: table name, value: DataFrame, or csv file path for the ones saved as csv)
+    """
+
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+
+    dfs_dic = {}
+    for tb, fname in meta.items():
+        full_fname = os.path.join(path, fname)
+        if fname.endswith(".csv"):
+            dfs_dic[tb] = full_fname
+        elif fname.endswith(".parquet"):
+            dfs_dic[tb] = pd.read_parquet(full_fname)
+        else:
+            dfs_dic[tb] = pd.read_pickle(full_fname)
+
+    return dfs_dic
+
+
+def set_dt_loaded(fname, now, chunksize=REWRITE_CHUNKSIZE):
+    """Sets the dt_loaded column of a table cached as a csv file, chunksize
+    rows at a time. The other values are rewritten as the same text.
+
+    Args:
+        fname (str): csv file path (see transform.read_output)
+        now (datetime.datetime): new dt_loaded
+        chunksize (int, optional): rows per block. Defaults to REWRITE_CHUNKSIZE.
+    """
+
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "w", encoding="utf-8", newline="") as f:
+        header = True
+        for chunk in pd.read_csv(
+            fname, dtype=str, keep_default_na=False, chunksize=chunksize
+        ):
+            chunk["dt_loaded"] = now
+            chunk.to_csv(f, header=header, index=False)
+            header = False
+    os.replace(tmp_fname, fname)
+
+
+@logger.traced
+def get(csvs_dic):
+    """Returns the cached output of transform(csvs_dic), if there is one
+
+    Args:
+        csvs_dic (dict): files to transform (key: category, value: csv file path)
+
+    Returns:
+        dict or None: same as transform (with dt_loaded set to now), or None on a cache miss
+    """
+
+    if not TRANSFORM_CACHE:
+        return None
+
+    key = get_key(csvs_dic)
+    path = os.path.join(TRANSFORM_CACHE_DIR, key)
+
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        log.info(f"Transform cache miss ({key[:12]})")
+        metrics.inc("cache_misses", cache="transform", category="all")
+        return None
+
+    dfs_dic = load_frames(path)
+
+    # Mark the entry as recently used (see evict)
+    os.utime(os.path.join(path, "meta.json"))
+
+    # The data is being loaded now, not when it was cached
+    now = dt.datetime.now()
+    for df in dfs_dic.values():
+        if isinstance(df, pd.DataFrame):
+            df["dt_loaded"] = now
+        else:
+            set_dt_loaded(df, now)
+
+    metrics.inc("cache_hits", cache="transform", category="all")
+    log.info(f"Transform cache hit ({key[:12]}), skipping transform")
+    return dfs_dic
+
+
+@logger.traced
+def put(csvs_dic, dfs_dic):
+    """Caches the output of transform(csvs_dic) and evicts old entries if the
+    cache is over TRANSFORM_CACHE_MAX_MB (see evict).
+
+    Args:
+        csvs_dic (dict): transformed files (key: category, value: csv file path)
+        dfs_dic (dict): transform's output
+    """
+
+    if not TRANSFORM_CACHE:
+        return
+
+    key = get_key(csvs_dic)
+    path = os.path.join(TRANSFORM_CACHE_DIR, key)
+    tmp_path = path + ".tmp"
+
+    # Written to a temporary folder and renamed, so an interrupted run can't
+    # leave a half written entry
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    save_frames(tmp_path, dfs_dic)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+    log.info(f"Transform output cached ({key[:12]})")
+
+    evict(keep=key)
+
+
+def get_size(path):
+    """Returns the size (in bytes) of all the files in a folder"""
+    return sum(
+        os.path.getsize(os.path.join(root, fname))
+        for root, _, fnames in os.walk(path)
+        for fname in fnames
+    )
+
+
+def evict(keep=None, max_mb=TRANSFORM_CACHE_MAX_MB):
+    """Removes the least recently used entries (by the modification time of
+    their meta.json, see get) until the cache fits in max_mb.
+
+    Args:
+        keep (str, optional): key of an entry that must not be removed. Defaults to None.
+        max_mb (float, optional): max cache size in MB. Defaults to TRANSFORM_CACHE_MAX_MB.
+    """
+
+    entries = []
+    for key in os.listdir(TRANSFORM_CACHE_DIR):
+        meta_fname = os.path.join(TRANSFORM_CACHE_DIR, key, "meta.json")
+        if os.path.exists(meta_fname):
+            entries.append(
+                (
+                    os.path.getmtime(meta_fname),
+                    key,
+                    get_size(os.path.join(TRANSFORM_CACHE_DIR, key)),
+                )
+            )
+
+    total = sum(size for _, _, size in entries)
+
+    # Oldest first
+    for _, key, size in sorted(entries):
+        if total <= max_mb * 2**20:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(TRANSFORM_CACHE_DIR, key), ignore_errors=True)
+        total -= size
+        log.info(f"Transform cache entry {key[:12]} evicted ({size} bytes)")
@@ -0,0 +1,124 @@
+import concurrent.futures as cf
+
+import pkg.metrics as metrics
+
+
+class Task:
+    """
+    Node of a task graph (see run_dag). func is called with args followed by
+    the results of deps, in the same order as deps.
+
+    Tasks with process=True run in a process pool: func, args and the
+    results of deps must be picklable (e.g. module level functions and
+    DataFrames). The rest run in a thread pool of the calling process, which
+    avoids copying their inputs. The stages they record (see
+    metrics.record) are sent back along with their results.
+    """
+
+    def __init__(self, func, args=(), deps=(), process=False):
+        self.func = func
+        self.args = tuple(args)
+        self.deps = list(deps)
+        self.process = process
+
+
+def check_dag(tasks):
+    """Checks that every dependency exists and that there are no cycles
+
+    Args:
+        tasks (dict): task graph (key: task name, value: Task)
+
+    Raises:
+        ValueError: unknown dependency or cycle
+    """
+
+    for name, task in tasks.items():
+        unknown = [dep for dep in task.deps if dep not in tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks {unknown}")
+
+    done = set()
+    pending = dict(tasks)
+    while pending:
+        ready = [name for name, task in pending.items() if set(task.deps) <= done]
+        if not ready:
+            raise ValueError(f"Cycle between tasks {sorted(pending)}")
+        for name in ready:
+            done.add(name)
+            del pending[name]
+
+
+def run_dag(tasks, max_workers=1):
+    """Runs a task graph, each task as soon as the tasks it depends on are
+    done.
+
+    With max_workers <= 1 the tasks run one after the other in the calling
+    thread, in insertion order (as far as the dependencies allow). Otherwise
+    up to max_workers tasks run at the same time in each pool (see Task).
+    Either way the results are the same: they only depend on the tasks, not
+    on the order they finish.
+
+    If a task fails, the tasks not started yet are cancelled and its
+    exception is raised once the running ones finish.
+
+    Args:
+        tasks (dict): task graph (key: task name, value: Task)
+        max_workers (int, optional): workers of each pool. Defaults to 1.
+
+    Returns:
+        dict: results (key: task name, value: what its func returned)
+    """
+
+    check_dag(tasks)
+    results = {}
+
+    if max_workers <= 1:
+        pending = dict(tasks)
+        while pending:
+            for name, task in list(pending.items()):
+                if all(dep in results for dep in task.deps):
+                    results[name] = task.func(
+                        *task.args, *(results[dep] for dep in task.deps)
+                    )
+                    del pending[name]
+        return results
+
+    threads = cf.ThreadPoolExecutor(max_workers=max_workers)
+    # Only start a process pool if some task needs it
+    processes = None
+    if any(task.process for task in tasks.values()):
+        processes = cf.ProcessPoolExecutor(max_workers=max_workers)
+
+    try:
+        pending = dict(tasks)
+        running = {}
+
+        while pending or running:
+            # Submit, in insertion order, every task whose inputs are ready
+            for name, task in list(pending.items()):
+                if all(dep in results for dep in task.deps):
+                    args = (*task.args, *(results[dep] for dep in task.deps))
+                    if task.process:
+                        future = processes.submit(metrics.collected, task.func, *args)
+                    else:
+                        future = threads.submit(task.func, *args)
+                    running[future] = name
+                    del pending[name]
+
+            done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for future in done:
+                # Re-raises the task's exception, the finally below cancels
+                # the rest
+                name = running.pop(future)
+                if tasks[name].process:
+                    results[name], records = future.result()
+                    metrics.merge(records)
+                else:
+                    results[name] = future.result()
+
+    finally:
+        threads.shutdown(cancel_futures=True)
+        if processes is not None:
+            processes.shutdown(cancel_futures=True)
+
+    return results
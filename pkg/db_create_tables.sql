@@ -5,7 +5,7 @@ CREATE TABLE public.alk_registros_totales (
 	categoria text,
 	provincia text,
 	fuente text,
-	cnt int8,
+	totals_cnt int8,
 	dt_loaded timestamp
 );
 
@@ -26,6 +26,11 @@ CREATE TABLE public.alk_registros_unificados (
 	telefono text,
 	mail text,
 	web text,
+	fuente text,
+	cluster_id int8,
+	latitud float8,
+	longitud float8,
+	geohash text,
 	dt_loaded timestamp
 );
 
@@ -33,31 +38,34 @@ CREATE TABLE public.alk_registros_unificados (
 DROP TABLE IF EXISTS public.alk_totales_cine;
 
 CREATE TABLE public.alk_totales_cine (
-	cod_loc int8,
-	id_provincia int8,
-	id_departamento int8,
-	observaciones float8,
-	categoria text,
 	provincia text,
-	departamento text,
-	localidad text,
-	nombre text,
-	domicilio text,
-	piso text,
-	cp int8,
-	cod_area text,
-	telefono text,
-	mail text,
-	web text,
-	info_adicional float8,
+	sum_pantallas int8,
+	sum_butacas int8,
+	cnt_espacio_incaa int8,
+	dt_loaded timestamp
+);
+
+-- public.alk_totales_geo definition
+DROP TABLE IF EXISTS public.alk_totales_geo;
+
+CREATE TABLE public.alk_totales_geo (
+	nivel text,
+	celda text,
+	id_departamento int8,
 	latitud float8,
 	longitud float8,
-	tipo_latitud_longitud text,
-	fuente text,
-	tipo_gestion text,
-	pantallas int8,
-	butacas int8,
-	espacio_incaa text,
-	ano_actualizacion int8,
+	cnt_espacios int8,
+	cnt_cines int8,
+	sum_pantallas int8,
+	sum_butacas int8,
+	cnt_museos int8,
+	cnt_bibliotecas int8,
+	cnt_espacios_radio int8,
+	cnt_cines_radio int8,
+	sum_pantallas_radio int8,
+	sum_butacas_radio int8,
+	cnt_museos_radio int8,
+	cnt_bibliotecas_radio int8,
+	radio_km float8,
 	dt_loaded timestamp
 );
\ No newline at end of file
@@ -0,0 +1,312 @@
+import re
+
+import decouple as d
+import numpy as np
+import pandas as pd
+import unidecode as un
+
+import pkg.logger as logger
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Duplicate venues of registros_unificados (see Deduplicator):
+# off: not looked for. tag: every record gets the cluster_id of its venue.
+# drop: same as tag, but only the first record of each venue is kept (and
+# counted in registros_totales).
+DEDUP = d.config("DEDUP", default="tag")
+
+# Records are only compared with the ones of their block: same id_provincia
+# and cod_loc. Records missing any of them are never duplicates.
+BLOCK_COLS = ["id_provincia", "cod_loc"]
+
+# Two records of a block are the same venue when they have the same
+# normalized nombre, or the same categoria, normalized telefono and
+# normalized domicilio (key: rule name, value: columns compared)
+MATCH_RULES = {
+    "nombre": ["nombre_key"],
+    "telefono_domicilio": ["categoria", "telefono_key", "domicilio_key"],
+}
+
+# Words left out of the nombre key (see nombre_key). Example:
+# "Biblioteca Popular del Pueblo" == "Biblioteca Pueblo"
+NOMBRE_STOPWORDS = {"DE", "DEL", "LA", "LAS", "EL", "LOS", "Y", "POPULAR"}
+
+# Abbreviations expanded in the domicilio key (see domicilio_key)
+DOMICILIO_ABBREVIATIONS = {
+    "AV": "AVENIDA",
+    "AVDA": "AVENIDA",
+    "AVE": "AVENIDA",
+    "GRAL": "GENERAL",
+    "PTE": "PRESIDENTE",
+    "PJE": "PASAJE",
+    "BV": "BOULEVARD",
+    "BVARD": "BOULEVARD",
+    "BLVD": "BOULEVARD",
+}
+
+# Words left out of the domicilio key. Example: "Calle San Martín N° 120" ==
+# "San Martin 120"
+DOMICILIO_STOPWORDS = {"CALLE", "N", "NO", "NRO", "NUM", "NUMERO", "S", "SN"}
+
+# Digits of the phone number compared: the last ones, so the same number
+# with and without area or country code matches
+TELEFONO_DIGITS = 7
+
+# Characters removed before unidecode, which turns "°" into "deg" (e.g.
+# "N° 120"), and everything but letters and digits, after it
+DEGREES_TABLE = str.maketrans("°º", "  ")
+NON_WORD_RE = re.compile(r"[^A-Z0-9]+")
+
+# Hash of missing values (see hash_column)
+NO_KEY = np.uint64(0)
+
+# Mask that keeps the cluster ids positive (they're stored as int8)
+ID_MASK = np.uint64(0x7FFFFFFFFFFFFFFF)
+
+
+def get_words(x):
+    """Upper case ASCII words of a value, without punctuation"""
+    return NON_WORD_RE.sub(" ", un.unidecode(str(x).translate(DEGREES_TABLE)).upper()).split()
+
+
+def nombre_key(x):
+    """Normalized nombre: words sorted, without stopwords. Example:
+    "Museo Histórico Municipal" --> "HISTORICO MUNICIPAL MUSEO" """
+    words = sorted(set(get_words(x)) - NOMBRE_STOPWORDS)
+    return " ".join(words) or None
+
+
+def domicilio_key(x):
+    """Normalized domicilio: abbreviations expanded, without stopwords.
+    Example: "Av. Gral. Paz N° 1200" --> "AVENIDA GENERAL PAZ 1200" """
+    words = [DOMICILIO_ABBREVIATIONS.get(word, word) for word in get_words(x)]
+    return " ".join(word for word in words if word not in DOMICILIO_STOPWORDS) or None
+
+
+def telefono_key(x):
+    """Normalized telefono: its last TELEFONO_DIGITS digits. Example:
+    "(0351) 422-1234" --> "4221234". None if it has fewer digits."""
+    digits = re.sub(r"\D", "", str(x))
+    return digits[-TELEFONO_DIGITS:] if len(digits) >= TELEFONO_DIGITS else None
+
+
+def hash_column(series, func=None):
+    """Returns a 64 bit hash of each value of a column, after normalizing it
+    with func. Both are done once per distinct value (see
+    transform.normalize), the rows only take the result.
+
+    Args:
+        series (pandas.Series): column to hash
+        func (function, optional): normalization of one value, returns str or None (missing). Defaults to None (the value as it is).
+
+    Returns:
+        numpy.ndarray: uint64 hashes, 0 where the (normalized) value is missing
+    """
+    codes, uniques = pd.factorize(series)
+    values = [func(x) for x in uniques] if func else list(uniques)
+    values = np.array(values + [None], dtype=object)
+
+    hashes = np.where(pd.isna(values), NO_KEY, pd.util.hash_array(values))
+    return hashes.take(codes)
+
+
+def hash_rows(df):
+    """Returns a 64 bit hash of each row's values (see hash_column), 0 where
+    any of them is missing. The hashes work as keys of an index: rows are
+    only linked to the ones with the same hash, never compared pair by pair.
+
+    Args:
+        df (pandas.DataFrame): uint64 hashes
+
+    Returns:
+        numpy.ndarray: uint64 hashes
+    """
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return np.where((df.to_numpy() == NO_KEY).any(axis=1), NO_KEY, hashes)
+
+
+def get_keys(df):
+    """Returns the hashes of the fields compared by MATCH_RULES (see
+    hash_column), plus the block and one key per rule (see hash_rows).
+
+    Args:
+        df (pandas.DataFrame): registros_unificados records
+
+    Returns:
+        pandas.DataFrame: uint64 hashes (0 when the record can't match by that field or rule), positional index
+    """
+
+    keys = pd.DataFrame(
+        {
+            **{col: hash_column(df[col]) for col in BLOCK_COLS},
+            "categoria": hash_column(df["categoria"]),
+            "nombre_key": hash_column(df["nombre"], nombre_key),
+            "domicilio_key": hash_column(df["domicilio"], domicilio_key),
+            "telefono_key": hash_column(df["telefono"], telefono_key),
+        }
+    )
+    keys["block"] = hash_rows(keys[BLOCK_COLS])
+
+    for rule, cols in MATCH_RULES.items():
+        keys[rule] = hash_rows(keys[BLOCK_COLS + cols])
+
+    return keys
+
+
+def connect(keys):
+    """Groups the records linked by any rule, directly or through other
+    records (e.g. A and B share the nombre, B and C the telefono and
+    domicilio: A, B and C are one venue).
+
+    Every rule key works as a hash index: records are only linked to the
+    ones with the same key, never compared pair by pair. The labels are
+    propagated until they don't change: each record takes the lowest label
+    of its keys, then the label of its label (pointer jumping, as in a
+    union-find).
+
+    Args:
+        keys (pandas.DataFrame): see get_keys
+
+    Returns:
+        numpy.ndarray: label of each record, the position of the first record of its group
+    """
+
+    n = len(keys)
+    labels = np.arange(n)
+    codes_lst = []
+    for rule in MATCH_RULES:
+        codes = pd.factorize(keys[rule])[0]
+        codes[keys[rule].to_numpy() == NO_KEY] = -1
+        codes_lst.append(codes)
+
+    while True:
+        new_labels = labels.copy()
+        for codes in codes_lst:
+            linked = codes >= 0
+            lowest = np.full(codes.max() + 1, n)
+            np.minimum.at(lowest, codes[linked], new_labels[linked])
+            new_labels[linked] = lowest[codes[linked]]
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+class Deduplicator:
+    """Finds the records of registros_unificados that are the same venue.
+
+    Every record gets a cluster_id, the same for all the records of a venue:
+    a hash of the first record's normalized fields, so it doesn't depend on
+    the row order of the other records. Chunks of the same table (see
+    transform.transform_streaming) can be passed one after the other: each
+    one is also matched against the keys of the previous ones. A record
+    linking two venues of previous chunks takes the id of one of them, the
+    records already returned keep theirs.
+
+    Usage:
+        dedup = Deduplicator()
+        for chunk in chunks:
+            chunk = dedup.apply(chunk)
+        dedup.log_stats()
+    """
+
+    def __init__(self, mode=None):
+        """
+        Args:
+            mode (str, optional): off, tag or drop. Defaults to None (DEDUP).
+        """
+        self.mode = DEDUP if mode is None else mode
+        if self.mode not in ("off", "tag", "drop"):
+            raise ValueError(f"Unknown DEDUP mode: {self.mode}. Use off, tag or drop")
+
+        # Rule keys seen (key: rule key, value: cluster_id), and records per
+        # cluster_id and per block
+        self.index = pd.Series(dtype="int64", index=pd.Index([], dtype="uint64"))
+        self.clusters = pd.Series(dtype="int64")
+        self.blocks = pd.Series(dtype="int64")
+        self.rows = 0
+
+    @logger.traced
+    def apply(self, df):
+        """Adds the cluster_id column to df, and drops the duplicates if
+        mode is drop
+
+        Args:
+            df (pandas.DataFrame): registros_unificados records
+
+        Returns:
+            pandas.DataFrame: df with cluster_id (the same object if mode is off)
+        """
+
+        if self.mode == "off" or df.empty:
+            return df
+
+        keys = get_keys(df)
+        labels = connect(keys)
+
+        # Id of each group: a hash of its first record
+        first = keys[BLOCK_COLS + ["categoria", "nombre_key", "telefono_key", "domicilio_key"]]
+        first = first.assign(nombre=hash_column(df["nombre"])).iloc[labels]
+        ids = pd.util.hash_pandas_object(first, index=False).to_numpy()
+        ids = pd.Series((ids & ID_MASK).astype("int64"))
+
+        # Groups matching records of previous chunks take their id
+        if len(self.index):
+            previous = np.zeros(len(keys), dtype="int64")
+            found = np.zeros(len(keys), dtype=bool)
+            for rule in MATCH_RULES:
+                pos = self.index.index.get_indexer(keys[rule].to_numpy())
+                new = (pos >= 0) & ~found
+                previous[new] = self.index.to_numpy()[pos[new]]
+                found |= new
+            previous = pd.Series(pd.arrays.IntegerArray(previous, ~found))
+            ids = previous.groupby(labels).transform("first").fillna(ids)
+        ids = ids.astype("int64").to_numpy()
+
+        for rule in MATCH_RULES:
+            hashes = pd.Index(keys[rule].to_numpy())
+            new = (hashes != NO_KEY) & ~hashes.isin(self.index.index)
+            new_index = pd.Series(ids[new], index=hashes[new])
+            # The first record of a key (of this chunk) wins
+            self.index = pd.concat(
+                [self.index, new_index[~new_index.index.duplicated()]]
+            )
+
+        seen = pd.Series(ids).isin(self.clusters.index).to_numpy()
+        self.rows += len(df)
+        self.clusters = self.clusters.add(pd.Series(ids).value_counts(), fill_value=0)
+        blocks = keys["block"][keys["block"] != NO_KEY]
+        self.blocks = self.blocks.add(blocks.value_counts(), fill_value=0)
+
+        if self.mode == "drop":
+            keep = ~(pd.Series(ids).duplicated().to_numpy() | seen)
+            return df[keep].assign(cluster_id=ids[keep])
+        return df.assign(cluster_id=ids)
+
+    def get_stats(self):
+        """Returns the match statistics of the records seen so far
+
+        Returns:
+            dict: rows, blocks, candidate_pairs (pairs of records in the same block), all_pairs, clusters, duplicates (rows that aren't the first of their cluster), largest_cluster
+        """
+        sizes = self.blocks.to_numpy()
+        return {
+            "rows": self.rows,
+            "blocks": len(self.blocks),
+            "candidate_pairs": int((sizes * (sizes - 1) // 2).sum()),
+            "all_pairs": self.rows * (self.rows - 1) // 2,
+            "clusters": len(self.clusters),
+            "duplicates": self.rows - len(self.clusters),
+            "largest_cluster": int(self.clusters.max()) if len(self.clusters) else 0,
+        }
+
+    def log_stats(self):
+        if self.mode == "off":
+            return
+        stats = self.get_stats()
+        log.info(
+            f"Dedup ({self.mode}): {stats['rows']} records, {stats['clusters']} venues, "
+            f"{stats['duplicates']} duplicates, {stats['blocks']} blocks, "
+            f"{stats['candidate_pairs']} candidate pairs of {stats['all_pairs']}"
+        )
@@ -1,14 +1,86 @@
+import base64
+import concurrent.futures as cf
+import contextlib
 import datetime
-import locale
+import hashlib
+import json
 import os
+import random
+import re
+import time
 
+import decouple as d
 import requests
+import requests.adapters
 
 import pkg.logger as logger
+import pkg.metrics as metrics
 
 # Set the logger for this file
 log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
 
+# Number of sources downloaded at the same time. It's also the size of the
+# shared session's connection pool, so every worker gets its own connection.
+EXTRACT_WORKERS = d.config("EXTRACT_WORKERS", default=3, cast=int)
+
+# Size (in bytes) of each block written to disk while streaming a response
+EXTRACT_CHUNK_SIZE = d.config("EXTRACT_CHUNK_SIZE", default=64 * 1024, cast=int)
+
+# Reuse the previous download of a source when the server says it hasn't
+# changed (see MANIFEST_FILE)
+EXTRACT_CACHE = d.config("EXTRACT_CACHE", default=True, cast=bool)
+
+# Per URL record of the last download: validators sent back to the server
+# (ETag, Last-Modified), size, content hash, local path and the hash of the
+# last file that went all the way through transform and load.
+MANIFEST_FILE = os.path.join(os.getcwd(), "data", "download_manifest.json")
+
+# Seconds to wait for a server to respond (to connect and between received
+# bytes). Slow sources can be given more time in TIMEOUTS.
+EXTRACT_TIMEOUT = d.config("EXTRACT_TIMEOUT", default=5, cast=float)
+
+# Failed downloads are retried up to EXTRACT_RETRIES times, waiting a random
+# time between 0 and EXTRACT_BACKOFF * 2 ** attempt seconds (capped at
+# EXTRACT_BACKOFF_MAX) in between. Retries resume from the bytes already
+# downloaded whenever the server supports it.
+EXTRACT_RETRIES = d.config("EXTRACT_RETRIES", default=5, cast=int)
+EXTRACT_BACKOFF = d.config("EXTRACT_BACKOFF", default=1, cast=float)
+EXTRACT_BACKOFF_MAX = d.config("EXTRACT_BACKOFF_MAX", default=30, cast=float)
+
+# HTTP status codes worth retrying, any other error status fails right away
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+URLS = {
+    "museos_datosabiertos": "https://datos.cultura.gob.ar/dataset/37305de4-3cce-4d4b-9d9a-fec3ca61d09f/resource/4207def0-2ff7-41d5-9095-d42ae8207a5d/download/museos_datosabiertos.csv",
+    "cine": "https://datos.cultura.gob.ar/dataset/37305de4-3cce-4d4b-9d9a-fec3ca61d09f/resource/392ce1a8-ef11-4776-b280-6f1c7fae16ae/download/cine.csv",
+    "biblioteca_popular": "https://datos.cultura.gob.ar/dataset/37305de4-3cce-4d4b-9d9a-fec3ca61d09f/resource/01c6c048-dbeb-44e0-8efa-6944f73715d7/download/biblioteca_popular.csv",
+}
+
+# Month names of the download folders (data/<category>/<yyyy-mes>/), as
+# strftime("%B") writes them in the es_AR locale
+MESES = [
+    "enero",
+    "febrero",
+    "marzo",
+    "abril",
+    "mayo",
+    "junio",
+    "julio",
+    "agosto",
+    "septiembre",
+    "octubre",
+    "noviembre",
+    "diciembre",
+]
+
+# Timeout (seconds) of each source
+TIMEOUTS = {category: EXTRACT_TIMEOUT for category in URLS.keys()}
+
+
+class ChecksumError(requests.RequestException):
+    """The downloaded file doesn't match the size or digest announced by the
+    server. It's retried like any other connection error."""
+
 
 def get_abspath(fname):
     r"""Returns the absolute path of the file
@@ -23,19 +95,15 @@ def get_abspath(fname):
                   "c:\Users\user1\Alkemy_Challenge_Data_Analytics_con_Python\data\museos\2021-noviembre\museos-03-11-2021.csv")
     """
 
-    # Set locale to Spanish Argentina to get the month name in spanish
-    # See list https://saimana.com/list-of-country-locale-code/
-    locale.setlocale(locale.LC_TIME, "es_AR.UTF-8")
-
     # Get the current date and format it properly
     # %Y	Full year with century	2021,2022
-    # %B	Full month name	January, February,…, December
     # %d	Days with zero padded value	01-31
     # %m	Month with zero padded value	01-12
-    # %y	Year without century with zero padded value	00,01,….21,22…,99
+    # The month name comes from MESES instead of %B, which would need the
+    # es_AR.UTF-8 locale installed (and changing the process' locale)
 
     now = datetime.datetime.now()
-    yyyy_mon = now.strftime("%Y-%B")
+    yyyy_mon = f"{now:%Y}-{MESES[now.month - 1]}"
     dd_mm_yyyy = now.strftime("%d-%m-%Y")
 
     full_path = os.path.join(os.getcwd(), "data", fname, yyyy_mon)
@@ -44,19 +112,359 @@ def get_abspath(fname):
     return full_path, full_fname
 
 
-def download_csvs():
+def get_session(pool_size=EXTRACT_WORKERS):
+    """Returns a requests session with a connection pool big enough for all
+    the download workers, so connections are reused instead of re-opened.
 
-    urls = {
-        "museos_datosabiertos": "https://datos.cultura.gob.ar/dataset/37305de4-3cce-4d4b-9d9a-fec3ca61d09f/resource/4207def0-2ff7-41d5-9095-d42ae8207a5d/download/museos_datosabiertos.csv",
-        "cine": "https://datos.cultura.gob.ar/dataset/37305de4-3cce-4d4b-9d9a-fec3ca61d09f/resource/392ce1a8-ef11-4776-b280-6f1c7fae16ae/download/cine.csv",
-        "biblioteca_popular": "https://datos.cultura.gob.ar/dataset/37305de4-3cce-4d4b-9d9a-fec3ca61d09f/resource/01c6c048-dbeb-44e0-8efa-6944f73715d7/download/biblioteca_popular.csv",
-    }
+    Args:
+        pool_size (int, optional): max connections kept per host. Defaults to EXTRACT_WORKERS.
 
-    csvs = {}
+    Returns:
+        requests.Session: shared session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def read_manifest():
+    """Returns the download manifest (key: URL, value: dict with the last
+    download's details), or an empty dict if there is none yet."""
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest):
+    """Saves the download manifest. It's written to a temporary file first and
+    then renamed, so an interrupted run can't leave it corrupted."""
+    os.makedirs(os.path.dirname(MANIFEST_FILE), exist_ok=True)
+    tmp_fname = MANIFEST_FILE + ".tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_fname, MANIFEST_FILE)
+
+
+def get_backoff(attempt):
+    """Returns the seconds to wait before retrying, using exponential backoff
+    with full jitter: a random time between 0 and EXTRACT_BACKOFF * 2 ** attempt
+    (capped at EXTRACT_BACKOFF_MAX). The randomness avoids all the workers
+    hitting the server again at the same time.
+
+    Args:
+        attempt (int): number of the failed attempt, starting at 0
+
+    Returns:
+        float: seconds to wait
+    """
+    return random.uniform(0, min(EXTRACT_BACKOFF_MAX, EXTRACT_BACKOFF * 2**attempt))
+
+
+def is_retryable(exc):
+    """Checks if a failed download is worth retrying
+
+    Args:
+        exc (requests.RequestException): exception raised by the download
+
+    Returns:
+        bool: False for errors that won't go away by retrying (e.g. 404)
+    """
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code in RETRY_STATUSES
+    return isinstance(
+        exc,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            ChecksumError,
+        ),
+    )
+
+
+def verify_digest(headers, sha256, md5=None):
+    """Compares the hashes of the downloaded file with the ones sent by the
+    server, if any: "Digest: SHA-256=<base64>" (RFC 3230) or
+    "Content-MD5: <base64>".
+
+    Args:
+        headers (requests.structures.CaseInsensitiveDict): response headers
+        sha256 (hashlib._Hash): SHA-256 of the whole file
+        md5 (hashlib._Hash, optional): MD5 of the whole file. Only available when it was downloaded in one go. Defaults to None.
+
+    Raises:
+        ChecksumError: the file doesn't match the server's digest
+    """
+
+    for digest in headers.get("Digest", "").split(","):
+        algorithm, _, value = digest.strip().partition("=")
+        if algorithm.lower() == "sha-256" and value != base64.b64encode(
+            sha256.digest()
+        ).decode():
+            raise ChecksumError(f"SHA-256 mismatch (expected {value})")
+
+    if md5 is not None and "Content-MD5" in headers:
+        if headers["Content-MD5"] != base64.b64encode(md5.digest()).decode():
+            raise ChecksumError(
+                f"MD5 mismatch (expected {headers['Content-MD5']})")
+
+
+def fetch(session, url, full_fname, cached=None, timeout=EXTRACT_TIMEOUT):
+    """Performs one download attempt of url into full_fname.
+
+    The response is streamed in EXTRACT_CHUNK_SIZE blocks to a partial file
+    (full_fname + ".part") next to the final one, which is renamed to
+    full_fname once the download is complete and verified. This way memory
+    usage doesn't depend on the file size, and full_fname is never left
+    half-written.
+
+    If a previous attempt left a partial file, only the missing bytes are
+    requested (Range), guarded by If-Range so the server sends the whole file
+    again if it changed in the meantime.
+
+    If there is a previous download of url (cached), the request is made
+    conditional (If-None-Match / If-Modified-Since). When the server answers
+    304 Not Modified, or sends back exactly the same content, nothing is
+    written and the cached file is reused.
+
+    Args:
+        session (requests.Session): session used to perform the request
+        url (str): URL to download
+        full_fname (str): destination file (absolute path)
+        cached (dict, optional): manifest entry of the previous download. Defaults to None.
+        timeout (float, optional): seconds to wait for the server to respond. Defaults to EXTRACT_TIMEOUT.
+
+    Raises:
+        requests.RequestException: the attempt failed. The partial file is kept to be resumed.
+
+    Returns:
+        dict: manifest entry of the file to use. Its "status" is one of
+        "downloaded", "not_modified" (304) or "unchanged" (same hash)
+    """
+
+    part_fname = full_fname + ".part"
+    # Validators of the partial file, to know if it can still be resumed
+    state_fname = part_fname + ".json"
+
+    # Only trust the cache if its file is still there
+    if cached and not os.path.exists(cached.get("path", "")):
+        cached = None
+
+    offset = os.path.getsize(part_fname) if os.path.exists(part_fname) else 0
+    validator = None
+    if offset and os.path.exists(state_fname):
+        with open(state_fname) as f:
+            state = json.load(f)
+        validator = state.get("etag") or state.get("last_modified")
+
+    # Ask for the file as it is stored: byte ranges and sizes refer to the
+    # encoded content, so a compressed response couldn't be resumed
+    headers = {"Accept-Encoding": "identity"}
+
+    if offset and validator:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+    else:
+        # Without validators there's no way to tell if the partial file
+        # belongs to the current version of the file, start over
+        offset = 0
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+    with session.get(url, headers=headers, timeout=timeout, stream=True) as r:
+        if r.status_code == requests.codes.not_modified and cached:
+            return dict(cached, status="not_modified")
 
-    for category, url in urls.items():
-        log.info("Downloading {}".format(category))
+        if r.status_code == requests.codes.requested_range_not_satisfiable:
+            # The partial file is useless (e.g. the file got smaller)
+            remove_files(part_fname, state_fname)
+            raise ChecksumError(f"{part_fname} can't be resumed")
 
+        r.raise_for_status()
+
+        sha256 = hashlib.sha256()
+        md5 = None
+
+        if r.status_code == requests.codes.partial_content:
+            # Content-Range: bytes <start>-<end>/<total or *>
+            content_range = r.headers.get("Content-Range", "")
+            match = re.fullmatch(r"bytes (\d+)-\d+/(\d+|\*)", content_range.strip())
+            if not match or int(match.group(1)) != offset:
+                remove_files(part_fname, state_fname)
+                raise ChecksumError(f"Unexpected Content-Range {content_range!r}")
+            total = int(match.group(2)) if match.group(2).isdigit() else None
+
+            # The hash has to cover the whole file, not only the new bytes
+            with open(part_fname, "rb") as f:
+                for chunk in iter(lambda: f.read(EXTRACT_CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+
+            mode = "ab"
+            log.info(f"Resuming {url} from byte {offset}")
+        else:
+            # The whole file is coming (the server doesn't support ranges or
+            # the file changed)
+            offset = 0
+            total = r.headers.get("Content-Length")
+            total = int(total) if total and total.isdigit() else None
+            md5 = hashlib.md5() if "Content-MD5" in r.headers else None
+            mode = "wb"
+
+            with open(state_fname, "w") as f:
+                json.dump(
+                    {
+                        "etag": r.headers.get("ETag"),
+                        "last_modified": r.headers.get("Last-Modified"),
+                    },
+                    f,
+                )
+
+        # stream=True defers downloading the body until iter_content is
+        # called, so the whole content is never held in memory.
+        # "wb"/"ab" write the raw bytes as they come, so there's no need to
+        # care about the encoding of the response (iso-8859-1)
+        size = offset
+        with open(part_fname, mode) as f:
+            for chunk in r.iter_content(chunk_size=EXTRACT_CHUNK_SIZE):
+                f.write(chunk)
+                sha256.update(chunk)
+                if md5 is not None:
+                    md5.update(chunk)
+                size += len(chunk)
+
+        if total is not None and size != total:
+            raise ChecksumError(f"Got {size} bytes out of {total}")
+
+        try:
+            verify_digest(r.headers, sha256, md5)
+        except ChecksumError:
+            # Corrupted, resuming it would keep it corrupted
+            remove_files(part_fname, state_fname)
+            raise
+
+        entry = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "size": size,
+            "sha256": sha256.hexdigest(),
+            "path": full_fname,
+        }
+
+    # The server doesn't support conditional requests (or ignored them) but
+    # the content is the same we already have
+    if cached and cached.get("sha256") == entry["sha256"]:
+        remove_files(part_fname, state_fname)
+        return dict(
+            cached,
+            status="unchanged",
+            etag=entry["etag"],
+            last_modified=entry["last_modified"],
+        )
+
+    # The partial file is in the same folder (same filesystem) as the final
+    # one, so os.replace is an atomic rename
+    os.replace(part_fname, full_fname)
+    remove_files(state_fname)
+
+    if cached and "processed_sha256" in cached:
+        entry["processed_sha256"] = cached["processed_sha256"]
+
+    return dict(entry, status="downloaded")
+
+
+@logger.traced
+def download_file(
+    session, url, full_fname, cached=None, timeout=EXTRACT_TIMEOUT, category=None
+):
+    """Downloads url into full_fname (see fetch), retrying with exponential
+    backoff and jitter (see get_backoff) up to EXTRACT_RETRIES times when the
+    error is transient (see is_retryable). The duration, bytes, retries and
+    whether the previous download was reused are recorded (see pkg/metrics.py).
+
+    Args:
+        session (requests.Session): session used to perform the request
+        url (str): URL to download
+        full_fname (str): destination file (absolute path)
+        cached (dict, optional): manifest entry of the previous download. Defaults to None.
+        timeout (float, optional): seconds to wait for the server to respond. Defaults to EXTRACT_TIMEOUT.
+        category (str, optional): source category, labels the metrics. Defaults to None (url).
+
+    Returns:
+        dict: manifest entry of the file to use (see fetch)
+    """
+
+    category = category or url
+    start = time.perf_counter()
+
+    for attempt in range(EXTRACT_RETRIES + 1):
+        try:
+            entry = fetch(session, url, full_fname, cached=cached, timeout=timeout)
+            break
+        except requests.RequestException as exc:
+            if attempt == EXTRACT_RETRIES or not is_retryable(exc):
+                raise
+            metrics.inc("retries", stage="extract.download", category=category)
+            delay = get_backoff(attempt)
+            log.warning(
+                f"Downloading {url} failed ({exc}). Retry {attempt + 1}/{EXTRACT_RETRIES} in {delay:.1f}s"
+            )
+            time.sleep(delay)
+
+    # not_modified: nothing was sent. unchanged: the same content was sent
+    # again, and discarded.
+    status = entry["status"]
+    metrics.inc(
+        "cache_misses" if status == "downloaded" else "cache_hits",
+        cache="download",
+        category=category,
+    )
+    metrics.record(
+        "extract.download",
+        category,
+        time.perf_counter() - start,
+        bytes_read=0 if status == "not_modified" else entry["size"],
+        bytes_written=entry["size"] if status == "downloaded" else 0,
+    )
+    return entry
+
+
+def remove_files(*fnames):
+    """Removes the files that exist"""
+    for fname in fnames:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+@logger.traced
+def download_csvs(urls=URLS, max_workers=EXTRACT_WORKERS, session=None):
+    """Downloads all the sources concurrently
+
+    Sources that haven't changed since the last run are not downloaded
+    again, the file of the previous download is returned instead (see
+    download_file).
+
+    Args:
+        urls (dict, optional): sources to download (key: category, value: URL). Defaults to URLS.
+        max_workers (int, optional): number of simultaneous downloads. Defaults to EXTRACT_WORKERS.
+        session (requests.Session, optional): session to use (see get_session), it's left open. Defaults to None (a new one, closed at the end).
+
+    Returns:
+        dict: Downloaded files (key: category, value: csv file path)
+    """
+
+    csvs = {}
+    manifest = read_manifest() if EXTRACT_CACHE else {}
+
+    # Build every path up front, so all the files of a run get the same date
+    for category in urls.keys():
         full_path, full_fname = get_abspath(category)
 
         # Create the directory if it doesn't exist
@@ -64,28 +472,102 @@ def download_csvs():
         # directory will not be created
         os.makedirs(full_path, exist_ok=True)
 
-        # Downloading the file from the URL. If the response takes more than 5
-        # seconds, it will raise a TimeoutError exception.
-        r = requests.get(url, timeout=5)
+        csvs[category] = full_fname
 
-        # Writing the content of the response to a file.
-        # "wb" indicates that the file is opened for writing in binary mode
-        # r.content is the content of the response content in bytes
-        # Therefore, r.content goes along with open(full_fname, "wb")
-        # Alternatively, you can use:
-        # r.text along with open(full_fname, "wt", encoding=r.encoding)
-        # If we use text, we need to enforce to write the file in the same
-        # encoding of the request, which is iso-8859-1
+    max_workers = max(1, min(max_workers, len(urls)))
 
-        with open(full_fname, "wb") as f:
-            f.write(r.content)
+    # A session passed by the caller (e.g. the daemon's) keeps its
+    # connections open for the next runs
+    if session is None:
+        session_ctx = get_session(pool_size=max_workers)
+    else:
+        session_ctx = contextlib.nullcontext(session)
 
-        log.info(f"{category} downloaded and saved in {full_fname}")
+    with session_ctx as session, cf.ThreadPoolExecutor(
+        max_workers=max_workers
+    ) as executor:
+        futures = {}
+        for category, url in urls.items():
+            log.info("Downloading {}".format(category))
+            # If the server takes more than the source's timeout to respond,
+            # it will raise a Timeout exception (and retry).
+            futures[category] = executor.submit(
+                download_file,
+                session,
+                url,
+                csvs[category],
+                cached=manifest.get(url),
+                timeout=TIMEOUTS.get(category, EXTRACT_TIMEOUT),
+                category=category,
+            )
 
-        csvs[category] = full_fname
+        # result() re-raises in this thread any exception raised while
+        # downloading
+        for category, future in futures.items():
+            entry = future.result()
+            status = entry.pop("status")
+            manifest[urls[category]] = entry
+            csvs[category] = entry["path"]
+
+            if status == "downloaded":
+                log.info(
+                    f"{category} downloaded ({entry['size']} bytes) and saved in {entry['path']}"
+                )
+            else:
+                log.info(
+                    f"{category} hasn't changed ({status}), reusing {entry['path']}"
+                )
+
+    if EXTRACT_CACHE:
+        write_manifest(manifest)
 
     return csvs
 
 
+def inputs_changed(csvs_dic):
+    """Checks if any of the files has changed since the last time the pipeline
+    was run to the end (see mark_processed).
+
+    Args:
+        csvs_dic (dict): files returned by download_csvs (key: category, value: csv file path)
+
+    Returns:
+        bool: True if transform and load need to run
+    """
+
+    if not EXTRACT_CACHE:
+        return True
+
+    entries = {entry["path"]: entry for entry in read_manifest().values()}
+
+    for csv_file in csvs_dic.values():
+        entry = entries.get(csv_file)
+        if entry is None or entry.get("processed_sha256") != entry["sha256"]:
+            return True
+
+    return False
+
+
+def mark_processed(csvs_dic):
+    """Records the files as successfully transformed and loaded, so that
+    inputs_changed returns False until one of them changes.
+
+    Args:
+        csvs_dic (dict): files returned by download_csvs (key: category, value: csv file path)
+    """
+
+    if not EXTRACT_CACHE:
+        return
+
+    manifest = read_manifest()
+    csv_files = set(csvs_dic.values())
+
+    for entry in manifest.values():
+        if entry["path"] in csv_files:
+            entry["processed_sha256"] = entry["sha256"]
+
+    write_manifest(manifest)
+
+
 if __name__ == "__main__":
     download_csvs()
@@ -1,9 +1,42 @@
+import concurrent.futures as cf
+import io
 import os
+import re
+import time
 
 import decouple as d
+import pandas as pd
 import sqlalchemy as s
 
 import pkg.logger as logger
+import pkg.sinks as sk
+import pkg.transform as t
+
+
+# Tables found in the database (key: engine URL, value: set of table names),
+# see get_table_names
+table_names_cache = {}
+
+# Storage backends already created (key: name, value: sinks.Sink), see
+# get_sink
+sinks_cache = {}
+
+
+def get_table_names(e, refresh=False):
+    """
+    Returns the tables in POSTGRES_SCHEMA. The schema is reflected only the
+    first time (or when refresh is True), afterwards the cached result is
+    returned.
+
+    :param e: the database engine
+    :param refresh: reflect the schema again
+    :return: A set of table names.
+    """
+    key = str(e.url)
+    if refresh or key not in table_names_cache:
+        table_names_cache[key] = set(
+            s.inspect(e).get_table_names(schema=POSTGRES_SCHEMA))
+    return table_names_cache[key]
 
 
 def exists_in_db(t, e):
@@ -13,38 +46,283 @@ def exists_in_db(t, e):
     :param t: the table name
     :return: A boolean value.
     """
-    return s.inspect(e).has_table(table_name=t, schema=POSTGRES_SCHEMA)
+    return t in get_table_names(e)
 
 
 # Set the logger for this file
 log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
 
-POSTGRES_USER = d.config("POSTGRES_USER")
-POSTGRES_PASSWORD = d.config("POSTGRES_PASSWORD")
-POSTGRES_DB = d.config("POSTGRES_DB")
-POSTGRES_PORT = d.config("POSTGRES_PORT")
-POSTGRES_HOST = d.config("POSTGRES_HOST")
-POSTGRES_SCHEMA = d.config("POSTGRES_SCHEMA")
+# Where the tables are stored: "postgres", "sqlite", "duckdb" or "parquet"
+# (see SINKS)
+LOAD_SINK = d.config("LOAD_SINK", default="postgres")
+
+# The rest of the connection settings (POSTGRES_USER, POSTGRES_PASSWORD,
+# POSTGRES_HOST, POSTGRES_PORT and POSTGRES_DB) are only read when the
+# postgres sink is used (see get_engine)
+POSTGRES_SCHEMA = d.config("POSTGRES_SCHEMA", default="public")
+
+# How the tables are written:
+# "copy": streams them with COPY ... FROM STDIN into the tables defined in
+#         db_create_tables.sql
+# "swap": same as copy, but into staging tables that replace the live ones
+#         at once when they are ready (see load_swap)
+# "to_sql": replaces them with pandas' DataFrame.to_sql (row by row INSERTs)
+LOAD_METHOD = d.config("LOAD_METHOD", default="copy")
+
+# Tables loaded at the same time, each one through its own connection of the
+# engine's pool
+LOAD_WORKERS = d.config("LOAD_WORKERS", default=3, cast=int)
+
+# With LOAD_METHOD "copy", load all the tables or none: they are replaced in
+# a single transaction, one after the other. When off (and LOAD_WORKERS > 1)
+# they are loaded in parallel and each one is committed as soon as it's
+# loaded. To load them in parallel and still replace all or none, use
+# LOAD_METHOD "swap".
+LOAD_ATOMIC = d.config("LOAD_ATOMIC", default=True, cast=bool)
+
+# Load alk_registros_unificados incrementally: only the rows that were
+# inserted, updated or deleted since the last load are written (see
+# load_incremental)
+LOAD_INCREMENTAL = d.config("LOAD_INCREMENTAL", default=False, cast=bool)
+
+# Table loaded incrementally, the columns identifying each record, and the
+# table keeping the hash of every record's content
+INCREMENTAL_TABLE = "alk_registros_unificados"
+INCREMENTAL_KEYS = ["categoria", "cod_loc", "nombre"]
+HASHES_TABLE = INCREMENTAL_TABLE + "_hashes"
+
+# Compute alk_registros_totales in the database, with GROUP BY GROUPING SETS
+# over the stored alk_registros_unificados (see load_totales_pushdown),
+# instead of loading the one computed by transform. It always matches what
+# is stored, e.g. after an incremental load.
+TOTALES_PUSHDOWN = d.config("TOTALES_PUSHDOWN", default=False, cast=bool)
+
+TOTALES_TABLE = "alk_registros_totales"
+
+# Columns added to the tables after they were first created (key: table
+# name, value: dict of column --> type). They are added to the tables
+# created by an older db_create_tables.sql (see create_tables).
+ADDED_COLUMNS = {
+    "alk_registros_unificados": {
+        "fuente": "text",
+        "cluster_id": "int8",
+        "latitud": "float8",
+        "longitud": "float8",
+        "geohash": "text",
+    }
+}
+
+# Tables added after the first ones. They are created, if they are missing,
+# in a database created by an older db_create_tables.sql (see create_tables).
+ADDED_TABLES = ["alk_totales_geo"]
+
+# Max time the swap waits for the readers' locks on the live tables. It
+# fails instead of queueing (and blocking) every new reader behind it.
+LOAD_LOCK_TIMEOUT = d.config("LOAD_LOCK_TIMEOUT", default="5s")
+
+# Indexes built on the staging tables before the swap (key: table name,
+# value: list of indexed columns lists)
+INDEXES = {
+    "alk_registros_unificados": [["provincia", "categoria"], ["cod_loc"], ["geohash"]],
+    "alk_registros_totales": [["categoria"]],
+    "alk_totales_cine": [["provincia"]],
+    "alk_totales_geo": [["nivel"]],
+}
+
+# Rows per COPY batch, or per chunk when loading a table from a csv file
+LOAD_CHUNKSIZE = d.config("LOAD_CHUNKSIZE", default=100000, cast=int)
+
+
+def get_table_name(tb, schema=POSTGRES_SCHEMA):
+    """Returns the quoted, schema qualified table name. Example: "public"."alk_cine"
+    Temporary tables don't have a schema (schema=None). Example: "delta_keys" """
+    if schema is None:
+        return f'"{tb}"'
+    return f'"{schema}"."{tb}"'
+
+
+def copy_df(cursor, tb, df, batch_size=LOAD_CHUNKSIZE, schema=POSTGRES_SCHEMA):
+    """Appends a DataFrame to a table with COPY ... FROM STDIN.
+
+    The DataFrame is written as csv, batch_size rows at a time, to an
+    in-memory buffer that is sent to the server, so there's no intermediate
+    file and memory stays bounded by batch_size.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): cursor of the connection to use
+        tb (str): table name (without schema)
+        df (pandas.DataFrame): data to load, its columns must exist in the table
+        batch_size (int, optional): rows per COPY. Defaults to LOAD_CHUNKSIZE.
+        schema (str, optional): table's schema, None for temporary tables. Defaults to POSTGRES_SCHEMA.
+
+    Returns:
+        tuple of int: rows and bytes sent
+    """
+
+    cols = ", ".join(f'"{col}"' for col in df.columns)
+    # \N stands for NULL, so empty strings stay empty strings (see
+    # transform.NULL_REP)
+    sql = f"COPY {get_table_name(tb, schema)} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    size = 0
+
+    for start in range(0, len(df), batch_size):
+        buffer = io.StringIO()
+        df.iloc[start : start + batch_size].to_csv(
+            buffer, header=False, index=False, na_rep=t.NULL_REP
+        )
+        size += buffer.tell()
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+
+    return len(df), size
+
+
+def copy_csv(cursor, tb, csv_file):
+    """Appends a csv file written by transform's streaming mode to a table
+    with COPY ... FROM STDIN. The file is streamed as it is, without parsing
+    it.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): cursor of the connection to use
+        tb (str): table name (without schema)
+        csv_file (str): csv file path. Its header must match the table columns.
+
+    Returns:
+        tuple of int: rows and bytes sent
+    """
+
+    with open(csv_file, encoding="utf-8") as f:
+        cols = ", ".join(f'"{col}"' for col in f.readline().strip().split(","))
+        # Missing values are written as \N (see transform.NULL_REP), as
+        # copy_df does
+        sql = f"COPY {get_table_name(tb)} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        cursor.copy_expert(sql, f, size=1024 * 1024)
 
+    return cursor.rowcount, os.path.getsize(csv_file)
 
-def load(dfs_dic):
-    url = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-    engine = s.create_engine(url, pool_pre_ping=True)
+
+@logger.traced
+def load(dfs_dic, sink=LOAD_SINK):
+    """Main function to load data
+
+    Args:
+        dfs_dic (dict): tables to load (key: table name, value: DataFrame or csv file path)
+        sink (str, optional): storage backend (see SINKS). Defaults to LOAD_SINK.
+
+    Returns:
+        dict: load statistics (key: table name, value: see sinks.get_stats)
+    """
 
     # Apply prefix to category names as they will be used as table names in
     # the database
     dfs_dic = {f"alk_{cat}": df for cat, df in dfs_dic.items()}
 
+    return get_sink(sink).write(dfs_dic)
+
+
+def get_sink(name):
+    """Returns the storage backend called name. It's created the first time,
+    afterwards the same one is returned, so later loads of the same process
+    (e.g. in daemon mode) reuse its engine and connection pool.
+
+    Args:
+        name (str): key of SINKS. Example: sqlite
+
+    Raises:
+        ValueError: unknown sink
+
+    Returns:
+        sinks.Sink: storage backend
+    """
+    if name not in SINKS:
+        raise ValueError(f"Unknown sink {name}, use one of: {', '.join(SINKS)}")
+    if name not in sinks_cache:
+        sinks_cache[name] = SINKS[name](chunksize=LOAD_CHUNKSIZE)
+    return sinks_cache[name]
+
+
+def forget_engines():
+    """Drops the connection pools of the cached sinks without closing their
+    connections. Called in processes forked from this one (e.g. transform's
+    process pool): the connections belong to the parent, closing them (even
+    when the child exits) would end them for the parent too."""
+    for sink in sinks_cache.values():
+        engine = getattr(sink, "engine", None)
+        if engine is not None:
+            engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=forget_engines)
+
+
+def get_engine():
+    """Returns an engine connected to the database set in .env (POSTGRES_*)
+
+    Returns:
+        sqlalchemy.engine.Engine: database engine
+    """
+
+    # URL.create takes care of quoting special characters in the password,
+    # and allows POSTGRES_HOST to be a unix socket folder
+    url = s.engine.URL.create(
+        drivername="postgresql",
+        username=d.config("POSTGRES_USER"),
+        password=d.config("POSTGRES_PASSWORD"),
+        host=d.config("POSTGRES_HOST"),
+        port=d.config("POSTGRES_PORT"),
+        database=d.config("POSTGRES_DB"),
+    )
+    # One connection per worker, plus one for the schema reflection and the
+    # swap
+    return s.create_engine(
+        url, pool_pre_ping=True, pool_size=LOAD_WORKERS + 1, max_overflow=0
+    )
+
+
+def get_create_statement(tb):
+    """Returns the statements of db_create_tables.sql that create a table:
+    the block that starts with its "-- public.<table> definition" comment"""
+    with open(os.path.join(os.path.dirname(__file__), "db_create_tables.sql")) as file:
+        script = file.read()
+    blocks = re.split(r"(?m)^(?=-- public\.)", script)
+    return next(block for block in blocks if block.startswith(f"-- public.{tb} definition"))
+
+
+@logger.traced
+def create_tables(engine, tbs):
+    """Creates the tables (see db_create_tables.sql) if none of them exist.
+    The ones of ADDED_TABLES are created on their own if only they are
+    missing.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        tbs (list of str): tables to be loaded
+    """
+
+    # Database created before the table was added: only it is created
+    older = any(exists_in_db(tb, engine) for tb in tbs if tb not in ADDED_TABLES)
+    for tb in ADDED_TABLES:
+        if older and tb in tbs and not exists_in_db(tb, engine):
+            with engine.begin() as conn:
+                conn.execute(s.text(get_create_statement(tb)))
+            log.info(f"Table {tb} created")
+            get_table_names(engine, refresh=True)
+
     # Apply exists_in_db to all elements in a list
-    exist_in_db = [exists_in_db(tb, engine) for tb in dfs_dic.keys()]
+    exist_in_db = [exists_in_db(tb, engine) for tb in tbs]
 
     # Check if all tables exist in the database
     if not all(exist_in_db):
         # If none of them exist, create them
         if not any(exist_in_db):
-            with open(os.path.join(os.getcwd(), "pkg", "db_create_tables.sql")) as file:
-                engine.execute(s.text(file.read()))
+            # engine.begin() commits on exit. engine.execute's autocommit
+            # doesn't detect the DDL because the script starts with a comment.
+            with open(
+                os.path.join(os.path.dirname(__file__), "db_create_tables.sql")
+            ) as file, engine.begin() as conn:
+                conn.execute(s.text(file.read()))
                 log.info("Tables created")
+            get_table_names(engine, refresh=True)
 
         else:
             log.critical(
@@ -52,15 +330,666 @@ def load(dfs_dic):
             )
             exit()
 
+    else:
+        add_columns(engine, tbs)
+
+
+def add_columns(engine, tbs):
+    """Adds the columns of ADDED_COLUMNS missing from the tables
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        tbs (list of str): tables to be loaded
+    """
+
+    inspector = s.inspect(engine)
+
+    for tb in tbs:
+        if tb not in ADDED_COLUMNS:
+            continue
+
+        existing = {
+            col["name"] for col in inspector.get_columns(tb, schema=POSTGRES_SCHEMA)
+        }
+        for col, col_type in ADDED_COLUMNS[tb].items():
+            if col not in existing:
+                with engine.begin() as conn:
+                    conn.execute(
+                        s.text(
+                            f'ALTER TABLE {get_table_name(tb)} ADD COLUMN "{col}" {col_type}'
+                        )
+                    )
+                log.info(f"Column {col} added to {tb}")
+
+
+class PostgresSink(sk.Sink):
+    """Stores the tables in PostgreSQL, as set by LOAD_METHOD (see load_copy,
+    load_swap and load_to_sql) and LOAD_INCREMENTAL (see load_incremental)"""
+
+    def __init__(self, chunksize):
+        super().__init__(chunksize)
+        self.engine = get_engine()
+
+    @logger.traced
+    def write(self, dfs_dic):
+        engine = self.engine
+        dfs_dic = dict(dfs_dic)
+
+        create_tables(engine, list(dfs_dic.keys()))
+
+        stats = {}
+
+        totales_df = None
+        if TOTALES_PUSHDOWN:
+            totales_df = dfs_dic.pop(TOTALES_TABLE, None)
+
+        if LOAD_INCREMENTAL and INCREMENTAL_TABLE in dfs_dic:
+            stats[INCREMENTAL_TABLE] = load_incremental(
+                engine, INCREMENTAL_TABLE, dfs_dic.pop(INCREMENTAL_TABLE)
+            )
+        elif INCREMENTAL_TABLE in dfs_dic and exists_in_db(HASHES_TABLE, engine):
+            # The table is about to be fully replaced, the hashes won't match
+            # it anymore. The next incremental load will start from scratch.
+            with engine.begin() as conn:
+                conn.execute(
+                    s.text(f"TRUNCATE TABLE {get_table_name(HASHES_TABLE)}"))
+
+        if LOAD_METHOD == "to_sql" and dfs_dic:
+            stats.update(load_to_sql(engine, dfs_dic))
+        elif LOAD_METHOD == "swap" and dfs_dic:
+            stats.update(load_swap(engine, dfs_dic))
+        elif dfs_dic:
+            stats.update(load_copy(engine, dfs_dic))
+
+        if totales_df is not None:
+            # Once registros_unificados is stored
+            dt_loaded = totales_df["dt_loaded"].max()
+            stats[TOTALES_TABLE] = load_totales_pushdown(
+                engine, None if pd.isna(dt_loaded) else dt_loaded.to_pydatetime()
+            )
+
+        return stats
+
+
+def get_grouping_sets_sql(grouping_sets):
+    """Returns the GROUP BY and HAVING clauses computing grouping_sets like
+    transform does (see transform.aggregate_grouping_sets): rows with NULL
+    in a column of a grouping set are left out of it, while SQL would count
+    them in a NULL group. GROUPING(col) is 1 in the sets not using col.
+    Example: [["categoria"], ["provincia", "categoria"]] -->
+    GROUP BY GROUPING SETS ((categoria), (provincia, categoria))
+    HAVING (GROUPING(categoria) = 1 OR categoria IS NOT NULL) AND ...
+
+    Args:
+        grouping_sets (list of list of str): columns of each grouping
+
+    Returns:
+        str: GROUP BY ... HAVING ... clauses
+    """
+
+    sets = ", ".join(
+        "(" + ", ".join(f'"{col}"' for col in cols) + ")" for cols in grouping_sets
+    )
+    having = " AND ".join(
+        f'(GROUPING("{col}") = 1 OR "{col}" IS NOT NULL)'
+        for col in t.get_grain(grouping_sets)
+    )
+    return f"GROUP BY GROUPING SETS ({sets}) HAVING {having}"
+
+
+@logger.traced
+def load_totales_pushdown(engine, dt_loaded=None):
+    """Replaces alk_registros_totales with the counts of TOTALES_GROUPING_SETS
+    over the stored alk_registros_unificados, computed by the database in a
+    single GROUP BY GROUPING SETS (see get_grouping_sets_sql). It runs in its
+    own transaction, after the other tables are loaded.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        dt_loaded (datetime.datetime, optional): load time of the rows. Defaults to None (now).
+
+    Returns:
+        dict: load statistics (see sinks.get_stats), bytes are 0: no data is sent
+    """
+
+    start = time.perf_counter()
+    cols = ", ".join(f'"{col}"' for col in t.get_grain(t.TOTALES_GROUPING_SETS))
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"TRUNCATE TABLE {get_table_name(TOTALES_TABLE)}")
+            cursor.execute(
+                f"""INSERT INTO {get_table_name(TOTALES_TABLE)} ({cols}, totals_cnt, dt_loaded)
+                SELECT {cols}, count(*), COALESCE(%s, now()::timestamp)
+                FROM {get_table_name("alk_registros_unificados")}
+                {get_grouping_sets_sql(t.TOTALES_GROUPING_SETS)}""",
+                (dt_loaded,),
+            )
+            rows = cursor.rowcount
+        conn.commit()
+
+    except BaseException:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    log.info(f"{TOTALES_TABLE}: {rows} rows computed in the database")
+    return sk.get_stats(TOTALES_TABLE, rows, 0, time.perf_counter() - start)
+
+
+def replace_table(cursor, tb, df):
+    """Replaces the content of a table with COPY (see copy_df and copy_csv)
+
+    Args:
+        cursor (psycopg2.extensions.cursor): cursor of the connection to use
+        tb (str): table name (without schema)
+        df (pandas.DataFrame or str): data to load, or csv file path
+
+    Returns:
+        tuple of int: rows and bytes loaded
+    """
+
+    cursor.execute(f"TRUNCATE TABLE {get_table_name(tb)}")
+
+    if isinstance(df, str):
+        return copy_csv(cursor, tb, df)
+    return copy_df(cursor, tb, df)
+
+
+@logger.traced
+def load_table(engine, func, tb, df):
+    """Runs func(cursor, tb, df) in a connection of its own, commits it and
+    measures the throughput (see sinks.get_stats)
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        func (function): loading function. Example: replace_table
+        tb (str): table name (without schema)
+        df (pandas.DataFrame or str): data to load, or csv file path
+
+    Returns:
+        dict: load statistics (see sinks.get_stats)
+    """
+
+    start = time.perf_counter()
+
+    # COPY is not part of SQLAlchemy, the DBAPI (psycopg2) connection is used
+    # directly
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            rows, size = func(cursor, tb, df)
+        conn.commit()
+
+    except BaseException:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return sk.get_stats(tb, rows, size, time.perf_counter() - start)
+
+
+def load_parallel(engine, func, dfs_dic, max_workers=LOAD_WORKERS):
+    """Loads the tables concurrently (see load_table), each one in its own
+    connection and transaction.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        func (function): loading function. Example: replace_table
+        dfs_dic (dict): tables to load (key: table name, value: DataFrame or csv file path)
+        max_workers (int, optional): tables loaded at the same time. Defaults to LOAD_WORKERS.
+
+    Returns:
+        dict: load statistics (key: table name, value: see sinks.get_stats)
+    """
+
+    max_workers = max(1, min(max_workers, len(dfs_dic)))
+
+    with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            tb: executor.submit(load_table, engine, func, tb, df)
+            for tb, df in dfs_dic.items()
+        }
+        # result() re-raises in this thread any exception raised while
+        # loading
+        return {tb: future.result() for tb, future in futures.items()}
+
+
+@logger.traced
+def load_copy(engine, dfs_dic):
+    """Replaces the content of the tables with COPY (see replace_table).
+
+    With LOAD_ATOMIC (or a single worker) all the tables are replaced in the
+    same transaction, so either all of them or none are updated. With
+    LOAD_ATOMIC off and several workers (LOAD_WORKERS), they are loaded in
+    parallel and each one is committed on its own.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        dfs_dic (dict): tables to load (key: table name, value: DataFrame or csv file path)
+
+    Returns:
+        dict: load statistics (key: table name, value: see sinks.get_stats)
+    """
+
+    if not LOAD_ATOMIC and LOAD_WORKERS > 1:
+        return load_parallel(engine, replace_table, dfs_dic)
+
+    stats = {}
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            for tb, df in dfs_dic.items():
+                start = time.perf_counter()
+                rows, size = replace_table(cursor, tb, df)
+                stats[tb] = sk.get_stats(tb, rows, size, time.perf_counter() - start)
+
+        conn.commit()
+
+    except BaseException:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return stats
+
+
+def get_index_name(tb, cols):
+    """Returns the name of the index of tb on cols. Example: alk_totales_cine_provincia_idx"""
+    return f"{tb}_{'_'.join(cols)}_idx"
+
+
+def stage_table(cursor, tb, df):
+    """Loads a table into its staging copy (tb + "_staging"), which is created
+    empty with the same columns as tb. The indexes of INDEXES are built
+    afterwards (it's faster than keeping them up to date while loading) and
+    the statistics are gathered, so the table is ready to be queried as soon
+    as it's swapped in.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): cursor of the connection to use
+        tb (str): live table name (without schema)
+        df (pandas.DataFrame or str): data to load, or csv file path
+
+    Returns:
+        tuple of int: rows and bytes loaded
+    """
+
+    staging = f"{tb}_staging"
+
+    cursor.execute(f"DROP TABLE IF EXISTS {get_table_name(staging)}")
+    cursor.execute(
+        f"CREATE TABLE {get_table_name(staging)} (LIKE {get_table_name(tb)} INCLUDING DEFAULTS)"
+    )
+
+    if isinstance(df, str):
+        rows, size = copy_csv(cursor, staging, df)
+    else:
+        rows, size = copy_df(cursor, staging, df)
+
+    for cols in INDEXES.get(tb, []):
+        cursor.execute(
+            f'CREATE INDEX "{get_index_name(staging, cols)}" ON {get_table_name(staging)} ({", ".join(cols)})'
+        )
+
+    cursor.execute(f"ANALYZE {get_table_name(staging)}")
+
+    return rows, size
+
+
+def rename_table(cursor, tb, suffix, new_suffix):
+    """Renames a version of a table (if it exists) along with its INDEXES,
+    which are named after the table (see get_index_name).
+    Example: rename_table(cursor, "alk_cine", "_staging", "") renames
+    alk_cine_staging to alk_cine.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): cursor of the connection to use
+        tb (str): live table name (without schema)
+        suffix (str): suffix of the version to rename. Example: _staging
+        new_suffix (str): its new suffix. Example: "" (the live table)
+    """
+
+    cursor.execute(
+        f'ALTER TABLE IF EXISTS {get_table_name(tb + suffix)} RENAME TO "{tb + new_suffix}"'
+    )
+
+    for cols in INDEXES.get(tb, []):
+        cursor.execute(
+            f'ALTER INDEX IF EXISTS "{POSTGRES_SCHEMA}"."{get_index_name(tb + suffix, cols)}" RENAME TO "{get_index_name(tb + new_suffix, cols)}"'
+        )
+
+
+def swap_tables(cursor, tbs):
+    """Replaces the live tables with their staging copies. The current
+    versions are kept as tb + "_old" (see rollback), the previous old ones
+    are dropped. Must be called inside a transaction: readers see either all
+    the old tables or all the new ones.
+
+    Note: views are bound to the table, not its name, so after the swap they
+    keep pointing to the "_old" table and must be recreated.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): cursor of the connection to use
+        tbs (list of str): live tables names (without schema)
+    """
+
+    cursor.execute(f"SET LOCAL lock_timeout = '{LOAD_LOCK_TIMEOUT}'")
+
+    for tb in tbs:
+        cursor.execute(f"DROP TABLE IF EXISTS {get_table_name(tb + '_old')}")
+        rename_table(cursor, tb, "", "_old")
+        rename_table(cursor, tb, "_staging", "")
+
+
+@logger.traced
+def load_swap(engine, dfs_dic):
+    """Loads the tables without disturbing the readers of the live ones.
+
+    Every table is loaded into a staging copy (see stage_table), LOAD_WORKERS
+    at a time, and once all of them are ready they replace the live ones in a
+    single transaction (see swap_tables). Readers never see missing or half
+    loaded data, and the live tables are only locked for the instant the
+    renames take. If any table fails to load, none is swapped.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        dfs_dic (dict): tables to load (key: table name, value: DataFrame or csv file path)
+
+    Returns:
+        dict: load statistics (key: table name, value: see sinks.get_stats)
+    """
+
+    # The staging tables are committed as they are ready, the live ones
+    # aren't touched
+    stats = load_parallel(engine, stage_table, dfs_dic)
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            swap_tables(cursor, list(dfs_dic.keys()))
+
+        conn.commit()
+        log.info(f"Tables swapped: {', '.join(dfs_dic.keys())}")
+
+    except BaseException:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return stats
+
+
+def rollback(engine, tbs):
+    """Brings back the previous version of the tables replaced by load_swap
+    (tb + "_old"). The replaced ones become the "_old" ones, so calling it
+    again undoes the rollback.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        tbs (list of str): live tables names (without schema)
+
+    Raises:
+        ValueError: some table has no previous version (tb + "_old")
+    """
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET LOCAL lock_timeout = '{LOAD_LOCK_TIMEOUT}'")
+
+            # Without an "_old" version (no swap yet), the renames below
+            # would leave the live table renamed to "_old"
+            cursor.execute(
+                "SELECT tablename FROM pg_tables WHERE schemaname = %s",
+                (POSTGRES_SCHEMA,),
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+            missing = [tb for tb in tbs if tb + "_old" not in existing]
+            if missing:
+                raise ValueError(
+                    f"No previous version to roll back to: {', '.join(tb + '_old' for tb in missing)}"
+                )
+
+            for tb in tbs:
+                rename_table(cursor, tb, "", "_rollback")
+                rename_table(cursor, tb, "_old", "")
+                rename_table(cursor, tb, "_rollback", "_old")
+        conn.commit()
+        get_table_names(engine, refresh=True)
+        log.info(f"Tables rolled back: {', '.join(tbs)}")
+
+    except BaseException:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+
+def get_row_hashes(df, keys=INCREMENTAL_KEYS):
+    """Returns a hash of the content of each group of rows sharing the same
+    keys.
+
+    Every row is hashed (all columns but dt_loaded) with pandas' stable
+    hashing, and the hashes of the rows of each group are added up, so the
+    result doesn't depend on the order of the rows. Keys are not unique
+    (e.g. two venues with the same name in the same town), so a group is the
+    unit that gets inserted, updated or deleted.
+
+    Args:
+        df (pandas.DataFrame): table data
+        keys (list of str, optional): columns identifying a record. Defaults to INCREMENTAL_KEYS.
+
+    Returns:
+        pandas.DataFrame: keys + row_hash (int64, as stored in the database)
+    """
+
+    cols = [col for col in df.columns if col != "dt_loaded"]
+
+    hashes = df[keys].astype(object)
+    hashes["row_hash"] = pd.util.hash_pandas_object(df[cols], index=False)
+
+    # dropna=False: a missing cod_loc or nombre is still a key. The sum of
+    # uint64 wraps around on overflow, which is fine for a hash.
+    hashes = hashes.groupby(keys, dropna=False, as_index=False, sort=False)[
+        "row_hash"
+    ].sum()
+    hashes["row_hash"] = hashes["row_hash"].astype("uint64").view("int64")
+
+    return hashes
+
+
+def delete_keys(cursor, tb, keys_df):
+    """Deletes the rows of tb whose keys are in keys_df. The keys are copied
+    into a temporary table so the whole delete is one join. NULLs are
+    replaced by sentinels to compare them as equal while still allowing a
+    hash join.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): cursor of the connection to use
+        tb (str): table name (without schema)
+        keys_df (pandas.DataFrame): keys of the rows to delete
+
+    Returns:
+        int: deleted rows
+    """
+
+    cursor.execute(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS delta_keys "
+        "(categoria text, cod_loc int8, nombre text) ON COMMIT DROP"
+    )
+    cursor.execute("TRUNCATE TABLE delta_keys")
+    copy_df(cursor, "delta_keys", keys_df[INCREMENTAL_KEYS], schema=None)
+
+    cursor.execute(
+        f"""DELETE FROM {get_table_name(tb)} t USING delta_keys k
+        WHERE COALESCE(t.categoria, '') = COALESCE(k.categoria, '')
+        AND COALESCE(t.cod_loc, -1) = COALESCE(k.cod_loc, -1)
+        AND COALESCE(t.nombre, '') = COALESCE(k.nombre, '')"""
+    )
+    return cursor.rowcount
+
+
+@logger.traced
+def load_incremental(engine, tb, df):
+    """Writes only the changes of a table since its last load.
+
+    The hashes of the new data (see get_row_hashes) are compared with the
+    ones stored in HASHES_TABLE at the last load:
+    - keys only in the new data are inserted
+    - keys only in the database are deleted
+    - keys in both with a different hash are updated (deleted and inserted)
+    Unchanged rows are not touched, so they keep their dt_loaded. Everything
+    is applied in one transaction. If there are no stored hashes yet, the
+    table is fully replaced.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        tb (str): table name (without schema)
+        df (pandas.DataFrame or str): data to load, or csv file path
+
+    Returns:
+        dict: load statistics (see sinks.get_stats)
+    """
+
+    start = time.perf_counter()
+
+    if isinstance(df, str):
+        df = t.read_output(df)
+
+    new_hashes = get_row_hashes(df)
+
+    with engine.begin() as conn:
+        conn.execute(
+            s.text(
+                f"CREATE TABLE IF NOT EXISTS {get_table_name(HASHES_TABLE)} "
+                "(categoria text, cod_loc int8, nombre text, row_hash int8)"
+            )
+        )
+
+    old_hashes = pd.read_sql_table(
+        HASHES_TABLE, engine, schema=POSTGRES_SCHEMA
+    ).astype({"categoria": object, "cod_loc": "Int64", "nombre": object})
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            if old_hashes.empty:
+                log.info(f"{tb}: no previous hashes, replacing the whole table")
+                rows, size = replace_table(cursor, tb, df)
+                cursor.execute(f"TRUNCATE TABLE {get_table_name(HASHES_TABLE)}")
+                copy_df(cursor, HASHES_TABLE, new_hashes)
+
+            else:
+                # NaN keys match each other in merge
+                diff = new_hashes.astype({"cod_loc": "Int64"}).merge(
+                    old_hashes,
+                    on=INCREMENTAL_KEYS,
+                    how="outer",
+                    suffixes=("", "_old"),
+                    indicator=True,
+                )
+                inserted = diff["_merge"] == "left_only"
+                deleted = diff["_merge"] == "right_only"
+                updated = (diff["_merge"] == "both") & (
+                    diff["row_hash"] != diff["row_hash_old"]
+                )
+
+                # Updated records are deleted and inserted again
+                to_delete = diff.loc[deleted | updated, INCREMENTAL_KEYS]
+                to_insert = diff.loc[inserted | updated, INCREMENTAL_KEYS]
+
+                deleted_rows = delete_keys(cursor, tb, to_delete)
+                delete_keys(cursor, HASHES_TABLE, to_delete)
+
+                # Rows of the new data belonging to the inserted keys
+                rows_df = df.merge(
+                    to_insert.astype({"cod_loc": "Int64"}),
+                    on=INCREMENTAL_KEYS,
+                    how="inner",
+                )[df.columns]
+                rows, size = copy_df(cursor, tb, rows_df)
+                copy_df(
+                    cursor,
+                    HASHES_TABLE,
+                    new_hashes.merge(to_insert, on=INCREMENTAL_KEYS, how="inner"),
+                )
+
+                log.info(
+                    f"{tb}: {inserted.sum()} inserted, {updated.sum()} updated, "
+                    f"{deleted.sum()} deleted, "
+                    f"{len(diff) - inserted.sum() - updated.sum() - deleted.sum()} unchanged keys "
+                    f"({rows} rows written, {deleted_rows} rows deleted)"
+                )
+
+        conn.commit()
+
+    except BaseException:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return sk.get_stats(tb, rows, size, time.perf_counter() - start)
+
+
+@logger.traced
+def load_to_sql(engine, dfs_dic):
+    """Replaces the tables with pandas' DataFrame.to_sql
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        dfs_dic (dict): tables to load (key: table name, value: DataFrame or csv file path)
+
+    Returns:
+        dict: load statistics (key: table name, value: see sinks.get_stats)
+    """
+
+    stats = {}
+
     # Load the dataframes into the database
     for cat, df in dfs_dic.items():
-        df.to_sql(
-            name=cat,
-            con=engine,
-            if_exists="replace",
-            index=False,
-            schema=POSTGRES_SCHEMA,
-        )
+        start = time.perf_counter()
+        rows = 0
+        size = 0
+
+        # Tables written to disk by transform's streaming mode are loaded one
+        # chunk at a time
+        for idx, chunk in enumerate(sk.iter_chunks(df, LOAD_CHUNKSIZE)):
+            chunk.to_sql(
+                name=cat,
+                con=engine,
+                if_exists="replace" if idx == 0 else "append",
+                index=False,
+                schema=POSTGRES_SCHEMA,
+            )
+            rows += len(chunk)
+            size += int(chunk.memory_usage(index=False).sum())
+
+        stats[cat] = sk.get_stats(cat, rows, size, time.perf_counter() - start)
+
+    return stats
+
+
+# Storage backends that can be set in LOAD_SINK
+SINKS = {
+    "postgres": PostgresSink,
+    "sqlite": sk.SQLiteSink,
+    "duckdb": sk.DuckDBSink,
+    "parquet": sk.ParquetSink,
+}
 
 
 if __name__ == "__main__":
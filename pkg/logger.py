@@ -4,28 +4,220 @@ https://towardsdatascience.com/the-reusable-python-logging-template-for-all-your
 https://github.com/yashprakash13/Python-Cool-Concepts/blob/main/logging_template/logger/logger.py
 
 """
-import datetime
+import atexit
+import contextlib
+import functools
 import logging
+import logging.handlers
 import os
+import queue
+import reprlib
 import sys
+import threading
 import time
 
+import decouple as d
+
 LOG_DIR = os.path.join(os.getcwd(), "logs")
 global debug_flg
 debug_flg = False
 
-if not os.path.exists(LOG_DIR):
-    os.mkdir(LOG_DIR)
-
 # Set a logger's name, in case it's not provided, to the base project's
 # folder name is used by default
 # (Alkemy_Challenge_Data_Analytics_con_Python)
 APP_LOGGER_NAME = os.path.basename(os.getcwd())
 
-# Use this line to generate one log file per file run
-APP_LOG_FILE_NAME = os.path.join(
-    LOG_DIR, f"{APP_LOGGER_NAME}_{datetime.datetime.now():%Y%m%d_%H%M%S_%f}.log"
-)
+# Log file, rotated according to LOG_ROTATE (the rotated files get a suffix:
+# .1, .2, ... by size or the date by time)
+APP_LOG_FILE_NAME = os.path.join(LOG_DIR, f"{APP_LOGGER_NAME}.log")
+
+# size: rotate when the file reaches LOG_MAX_BYTES. time: rotate every
+# LOG_ROTATE_WHEN (see logging.handlers.TimedRotatingFileHandler)
+LOG_ROTATE = d.config("LOG_ROTATE", default="size")
+LOG_MAX_BYTES = d.config("LOG_MAX_BYTES", default=10 * 2**20, cast=int)
+LOG_ROTATE_WHEN = d.config("LOG_ROTATE_WHEN", default="midnight")
+# Rotated files kept
+LOG_BACKUP_COUNT = d.config("LOG_BACKUP_COUNT", default=5, cast=int)
+
+# Records waiting to be written by the background thread. When the queue is
+# full, LOG_OVERFLOW decides: block (wait for room) or drop (discard records
+# below WARNING, the rest still wait).
+LOG_QUEUE_SIZE = d.config("LOG_QUEUE_SIZE", default=10000, cast=int)
+LOG_OVERFLOW = d.config("LOG_OVERFLOW", default="block")
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler over a bounded queue that applies LOG_OVERFLOW when it's full.
+    """
+
+    def __init__(self, log_queue, overflow=LOG_OVERFLOW):
+        super().__init__(log_queue)
+        self.overflow = overflow
+        # Records discarded by the drop policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only what can't be done later by the background thread: merging
+        # the args (they may change after the call) and rendering the
+        # traceback (it holds references to the frames). The formatting is
+        # done by the background thread.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == "drop" and record.levelno < logging.WARNING:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+        else:
+            self.queue.put(record)
+
+
+# Handler shared by all the loggers and the listener that writes its records
+# from a background thread (see get_queue_handler)
+queue_handler = None
+queue_listener = None
+queue_lock = threading.Lock()
+
+
+class LazyFileMixin:
+    """
+    Mixin for file handlers created with delay=True: the log folder and
+    file are created when the first record is written, not when the handler
+    is created (at import, see set_logger). Commands that don't log anything
+    leave no trace on disk.
+    """
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+class RotatingFileHandler(LazyFileMixin, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class TimedRotatingFileHandler(
+    LazyFileMixin, logging.handlers.TimedRotatingFileHandler
+):
+    pass
+
+
+def get_queue_handler(file_name=APP_LOG_FILE_NAME):
+    """Returns the handler shared by all the loggers. On the first call it
+    starts the background thread that writes the queued records to the
+    console and to file_name (created along with its folder on the first
+    record), and registers stop_logging to run at exit.
+
+    Args:
+        file_name (str, optional): log file. If empty, the log is only written to the console. Defaults to APP_LOG_FILE_NAME.
+
+    Returns:
+        BoundedQueueHandler: handler to add to the loggers
+    """
+
+    global queue_handler, queue_listener
+
+    with queue_lock:
+        if queue_handler is not None:
+            return queue_handler
+
+        # Set up a logging format
+        formatter = logging.Formatter(
+            fmt="%(asctime)s.%(msecs)03d [%(name)-20s:%(lineno)-4d] %(levelname)8s: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+
+        # Set up a console handler
+        sh = logging.StreamHandler(sys.stdout)
+        sh.setFormatter(formatter)
+        handlers = [sh]
+
+        # Set up a file handler if a file name is provided for the messages
+        # to be logged to a log file
+        if file_name:
+            if LOG_ROTATE == "time":
+                fh = TimedRotatingFileHandler(
+                    file_name,
+                    when=LOG_ROTATE_WHEN,
+                    backupCount=LOG_BACKUP_COUNT,
+                    delay=True,
+                )
+            else:
+                fh = RotatingFileHandler(
+                    file_name,
+                    maxBytes=LOG_MAX_BYTES,
+                    backupCount=LOG_BACKUP_COUNT,
+                    delay=True,
+                )
+            fh.setFormatter(formatter)
+            handlers.append(fh)
+
+        queue_handler = BoundedQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        queue_listener = logging.handlers.QueueListener(
+            queue_handler.queue, *handlers, respect_handler_level=True
+        )
+        queue_listener.start()
+        atexit.register(stop_logging)
+
+        return queue_handler
+
+
+def restart_logging():
+    """Starts a new background thread in a forked child process (the
+    parent's thread isn't copied by fork), along with a new queue as the
+    parent's one may have been copied in the middle of a put or get."""
+
+    global queue_listener
+
+    if queue_listener is not None:
+        queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        queue_listener = logging.handlers.QueueListener(
+            queue_handler.queue, *queue_listener.handlers, respect_handler_level=True
+        )
+        queue_listener.start()
+
+
+def flush_logging():
+    """Waits until the background thread has written all the queued records"""
+    if queue_listener is not None:
+        queue_handler.queue.join()
+        for handler in queue_listener.handlers:
+            handler.flush()
+
+
+# Before forking, let the background thread write everything: if the fork
+# happens while it's writing, the child would get the file's lock held
+os.register_at_fork(before=flush_logging, after_in_child=restart_logging)
+
+
+def stop_logging():
+    """Writes the queued records and stops the background thread. Runs at
+    exit (see get_queue_handler)."""
+
+    global queue_handler, queue_listener
+
+    with queue_lock:
+        if queue_listener is None:
+            return
+
+        # Drains the queue before stopping
+        queue_listener.stop()
+        for handler in queue_listener.handlers:
+            handler.close()
+
+        if queue_handler.dropped:
+            sys.stderr.write(
+                f"{queue_handler.dropped} log records were dropped (LOG_OVERFLOW=drop)\n"
+            )
+
+        queue_handler = queue_listener = None
 
 
 def set_logger(
@@ -38,7 +230,7 @@ def set_logger(
     Args:
         logger_name (str, optional): main logger's name. Defaults to APP_LOGGER_NAME.
         is_debug (bool, optional): Sets log's level to DEBUG. Defaults to True.
-        file_name (str, optional): If set, the log's output will be stored into a file in the /logs folder. Defaults to APP_LOG_FILE_NAME.
+        file_name (str, optional): If set, the log's output will be stored into a file in the /logs folder (only the first call sets it, see get_queue_handler). Defaults to APP_LOG_FILE_NAME.
 
     Returns:
         logging.Logger: Main logger
@@ -70,20 +262,11 @@ def set_logger(
 
     logger.setLevel(logging.DEBUG if is_debug else logging.INFO)
 
-    # Set up a logging format
-    formatter = logging.Formatter(
-        fmt="%(asctime)s.%(msecs)03d [%(name)-20s:%(lineno)-4d] %(levelname)8s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
-
-    # Set up a console handler
-    sh = logging.StreamHandler(sys.stdout)
-    sh.setFormatter(formatter)
-
-    # Add the console handler to the logger for the messages to be shown on
-    # the console
+    # All the loggers share a handler that only queues the records, a
+    # background thread writes them (see get_queue_handler), so logging
+    # doesn't block the caller on I/O
     logger.handlers.clear()
-    logger.addHandler(sh)
+    logger.addHandler(get_queue_handler(file_name))
 
     # sys.excepthook(*exc_info) prints out a given traceback and exception to
     # sys.stderr
@@ -91,14 +274,6 @@ def set_logger(
         logger, *exc_info)
     sys.excepthook = new_excepthook
 
-    # Set up a file handler if a file name is provided for the messages to be
-    # logged to a log file
-    if file_name:
-        fh = logging.FileHandler(file_name)
-        fh.setFormatter(formatter)
-        # Add the file handler to the logger
-        logger.addHandler(fh)
-
     return logger
 
 
@@ -135,66 +310,165 @@ def log_unhandled_exception(in_logger, *in_exc_info):
         "Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback)
     )
 
+    # Make sure it's written before the process ends
+    flush_logging()
+
+
+# Spans (see span and traced) are only logged when tracing is on. When it's
+# off they cost a flag check, so they can stay in the code in production.
+tracing = False
+trace_log = None
+
+# Max length of the summary of a span argument or return value (see summarize)
+SPAN_MAX_REPR = 120
+
+# Open spans of each thread, innermost last (see span)
+span_stack = threading.local()
+
+summary_repr = reprlib.Repr()
+summary_repr.maxstring = SPAN_MAX_REPR
+summary_repr.maxother = SPAN_MAX_REPR
 
-class Debug2Log:
+
+def set_tracing(enabled):
+    """Turns the span logging on or off. Spans are logged at DEBUG level by
+    this file's logger.
+
+    Args:
+        enabled (bool): True to log the spans
     """
-    Class used to log debug messages.
+    global tracing, trace_log
+    if enabled:
+        trace_log = set_logger(logger_name=get_rel_path(__file__), is_debug=True)
+    tracing = enabled
+
+
+def summarize(value, depth=0):
+    """Returns a short description of a value to be logged. DataFrames and
+    Series are described by their shape, dtypes and memory, never by their
+    content. Containers are described up to 2 levels deep and the result is
+    truncated to SPAN_MAX_REPR characters.
+
+    Args:
+        value (any): value to describe
+        depth (int, optional): current container depth. Defaults to 0.
+
+    Returns:
+        str: description. Example: DataFrame(1000x14, object:9, Int64:3, category:2, 1.2 MB shallow)
     """
 
-    def __init__(self):
-        # As the messages are triggered in this script, the logger's name is
-        # set to this file's name.
-        self.logger = set_logger(
-            logger_name=get_rel_path(__file__),
-            is_debug=debug_flg)
-        self.timer = {}
-
-    def tracefunc(self, frame, event, arg):
-        """tracefunc is a trace function for the sys.setprofile function.
-        sys.setprofile(profilefunc):
-        Profile functions should have three arguments: frame, event, and arg.
-        'call': A function is called (or some other code block entered). The profile function is called; arg is None.
-        'return': A function (or other code block) is about to return. The profile function is called; arg is the value that will be returned, or None if the event is caused by an exception being raised.
-        'c_call': A C function is about to be called. This may be an extension function or a built-in. arg is the C function object.
-        'c_return':A C function has returned. arg is the C function object.
-        'c_exception':A C function has raised an exception. arg is the C function object.
-        Args:
-            frame (frame): is the current stack frame. A stack frame represents a single function call. You can visualize functions that call one another as virtual frames stacking on top of one another. The stack data structure is actually used for this
-            event (str): is a string: 'call', 'return', 'c_call', 'c_return', or 'c_exception'.
-            arg (?): depends on the event type.
-
-        Returns:
-            function: set tracefunc
-        """
-
-        # Log only the functions from this project, imported modules and
-        # venv folder are ignored.
-        # os.environ["VIRTUAL_ENV"] causes error when running with the
-        # venv desactivated, so we need to check. if desactivated,
-        # the venv folder files are not called so we can use 'absurd'
-        if frame.f_code.co_filename.startswith(
-            os.getcwd()
-        ) and not frame.f_code.co_filename.startswith(
-            os.environ["VIRTUAL_ENV"] if in_virtualenv() else "absurd"
-        ):
-            # Get the relative path of the file. E.g. \pkg\extract.py
-            rel_path_fname = os.sep + os.path.relpath(
-                frame.f_code.co_filename, start=os.getcwd()
-            )
-            if event == "call":
-                self.timer[rel_path_fname] = time.time()
-                self.logger.debug(
-                    f"Call {rel_path_fname} {frame.f_code.co_name} locals: {'' if frame.f_locals is None else frame.f_locals}"
-                )
-            elif event == "return" and rel_path_fname in self.timer:
-                duration = time.time() - self.timer[rel_path_fname]
-                self.logger.debug(
-                    f"End {rel_path_fname} {frame.f_code.co_name} returning: {arg} elapsed: {duration:.4f}"
-                )
-            return self.tracefunc
+    # Checked by name to avoid importing pandas in here
+    type_name = type(value).__name__
+    if type_name == "DataFrame":
+        rows, cols = value.shape
+        # Columns per dtype. Example: object:9, Int64:3
+        dtypes = ", ".join(
+            f"{dtype}:{cnt}" for dtype, cnt in value.dtypes.astype(str).value_counts().items()
+        )
+        # Shallow: object columns count the pointers, not the strings (a deep
+        # count would have to go through every value)
+        size = value.memory_usage(index=False).sum()
+        return f"DataFrame({rows}x{cols}, {dtypes}, {size / 2**20:.1f} MB shallow)"
+    if type_name == "Series":
+        return f"Series({value.name}, {len(value)}, {value.dtype})"
+
+    if isinstance(value, dict) and depth < 2:
+        items = ", ".join(
+            f"{k!r}: {summarize(v, depth + 1)}" for k, v in list(value.items())[:6]
+        )
+        summary = f"{{{items}{', ...' if len(value) > 6 else ''}}}"
+    elif isinstance(value, (list, tuple)) and depth < 2:
+        items = ", ".join(summarize(v, depth + 1) for v in value[:6])
+        summary = f"[{items}{', ...' if len(value) > 6 else ''}]"
+    else:
+        return summary_repr.repr(value)
+
+    if len(summary) > SPAN_MAX_REPR:
+        summary = summary[: SPAN_MAX_REPR - 3] + "..."
+    return summary
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Logs the start and end of a block of code along with its elapsed time.
+    Spans can be nested (also across functions, see traced): the end message
+    of each one shows its total time and its self time, i.e. the time not
+    spent in its child spans.
+
+    Usage:
+        with logger.span("transform", files=3):
+            ...
+
+    Args:
+        name (str): span name
+        **attrs: values to log with the start message (see summarize)
+    """
+
+    if not tracing:
+        yield
+        return
+
+    stack = getattr(span_stack, "spans", None)
+    if stack is None:
+        stack = span_stack.spans = []
+
+    indent = "  " * len(stack)
+    args = ", ".join(f"{k}={summarize(v)}" for k, v in attrs.items())
+    trace_log.debug(f"{indent}Start {name}({args})")
+
+    # Time spent in the child spans
+    current = {"children": 0.0}
+    stack.append(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as exc:
+        elapsed = time.perf_counter() - start
+        trace_log.debug(
+            f"{indent}Failed {name} after {elapsed:.4f}s: {summarize(exc)}")
+        raise
+    else:
+        elapsed = time.perf_counter() - start
+        result = f" -> {summarize(current['result'])}" if "result" in current else ""
+        trace_log.debug(
+            f"{indent}End {name}{result} in {elapsed:.4f}s "
+            f"(self {elapsed - current['children']:.4f}s)"
+        )
+    finally:
+        stack.pop()
+        if stack:
+            stack[-1]["children"] += elapsed
+
+
+def traced(func):
+    """Decorator that runs a function inside a span (see span) named after
+    it, logging its arguments and return value.
+
+    Args:
+        func (function): function to trace
 
-    def set_trace(self):
-        return sys.setprofile(self.tracefunc)
+    Returns:
+        function: decorated function
+    """
+
+    name = f"{func.__module__}.{func.__qualname__}"
+    # Names of the positional parameters. Read from the code object instead
+    # of inspect.signature: importing inspect would slow down the start of
+    # every command.
+    params = func.__code__.co_varnames[: func.__code__.co_argcount]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracing:
+            return func(*args, **kwargs)
+
+        attrs = dict(zip(params, args))
+        attrs.update(kwargs)
+        with span(name, **attrs) as current:
+            current["result"] = func(*args, **kwargs)
+            return current["result"]
+
+    return wrapper
 
 
 def get_rel_path(in_file_name):
@@ -208,15 +482,3 @@ def get_rel_path(in_file_name):
 
     return os.sep + os.path.relpath(in_file_name, start=os.getcwd())
 
-
-def get_base_prefix_compat():
-    """Get base/real prefix, or sys.prefix if there is none."""
-    return (
-        getattr(sys, "base_prefix", None)
-        or getattr(sys, "real_prefix", None)
-        or sys.prefix
-    )
-
-
-def in_virtualenv():
-    return get_base_prefix_compat() != sys.prefix
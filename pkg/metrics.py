@@ -0,0 +1,454 @@
+import contextlib
+import datetime
+import functools
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+import decouple as d
+
+import pkg.logger as logger
+import pkg.profiling as profiling
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Record the metrics of every run (see start_run and end_run). When off,
+# every function of this module does nothing.
+METRICS = d.config("METRICS", default=True, cast=bool)
+
+# Folder of the metrics: the OpenMetrics textfile (METRICS_TEXTFILE), read by
+# a node_exporter-style textfile collector, the counters kept between
+# processes (METRICS_STATE) and one JSON summary per run in runs/
+METRICS_DIR = d.config(
+    "METRICS_DIR", default=os.path.join(os.getcwd(), "data", "metrics")
+)
+METRICS_TEXTFILE = os.path.join(METRICS_DIR, "alkemy.prom")
+METRICS_STATE = os.path.join(METRICS_DIR, "state.json")
+
+# Run summaries kept in METRICS_DIR/runs, the oldest ones are removed
+METRICS_KEEP_RUNS = d.config("METRICS_KEEP_RUNS", default=100, cast=int)
+
+# Prefix of the metric names
+PREFIX = "alkemy"
+
+# Upper bounds (seconds) of the buckets of the duration histograms
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, math.inf]
+
+# Metrics exported (key: name without PREFIX, value: type and help). Counters
+# are cumulative across runs and processes (see read_state).
+DEFINITIONS = {
+    "runs": ("counter", "Pipeline runs by result: ok, skipped (no source changed) or failed"),
+    "last_run_timestamp_seconds": ("gauge", "End of the last run with each result (Unix time)"),
+    "stage_duration_seconds": ("histogram", "Duration of each stage, per category"),
+    "stage_rows_in": ("counter", "Rows taken by each stage"),
+    "stage_rows_out": ("counter", "Rows produced by each stage"),
+    "stage_read_bytes": ("counter", "Bytes read by each stage"),
+    "stage_written_bytes": ("counter", "Bytes written by each stage"),
+    "stage_rows_per_second": ("gauge", "Throughput of the last execution of each stage (rows out, or in, per second)"),
+    "stage_peak_memory_bytes": ("gauge", "Peak RSS of the process at the end of the last execution of each stage"),
+    "cache_hits": ("counter", "Downloads and transforms reused from their cache"),
+    "cache_misses": ("counter", "Downloads and transforms not found in their cache"),
+    "retries": ("counter", "Retried attempts of each stage (e.g. failed downloads)"),
+}
+
+# Metrics recorded (key: name, value: dict of labels --> value). Labels are
+# stored as a JSON list of (name, value) pairs, histogram values as dicts of
+# bucket counts, sum and count.
+registry = {}
+
+# Summary of the current run (see start_run)
+run = None
+
+# Runs of the process: the counters of previous processes are read once
+loaded = False
+
+lock = threading.Lock()
+
+# Stages recorded by the current task of a worker process (see collected),
+# None in the main process
+collecting = None
+
+
+def get_key(labels):
+    """Key of a label set in the registry"""
+    return json.dumps(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Adds value to a counter
+
+    Args:
+        name (str): metric name (see DEFINITIONS)
+        value (float, optional): amount to add. Defaults to 1.
+        **labels: label values. Example: category="cine"
+    """
+    if not METRICS:
+        return
+    with lock:
+        samples = registry.setdefault(name, {})
+        key = get_key(labels)
+        samples[key] = samples.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Sets the value of a gauge (see inc)"""
+    if not METRICS:
+        return
+    with lock:
+        registry.setdefault(name, {})[get_key(labels)] = value
+
+
+def observe(name, value, **labels):
+    """Adds an observation to a histogram (see inc and DURATION_BUCKETS)"""
+    if not METRICS:
+        return
+    with lock:
+        samples = registry.setdefault(name, {})
+        hist = samples.setdefault(
+            get_key(labels), {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0}
+        )
+        for pos, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                hist["buckets"][pos] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+
+def record(
+    stage,
+    category="all",
+    seconds=0.0,
+    rows_in=None,
+    rows_out=None,
+    bytes_read=None,
+    bytes_written=None,
+    peak_rss=None,
+):
+    """Records an execution of a stage: its duration, rows, bytes,
+    throughput and the peak memory of the process so far. Also added to the
+    run summary.
+
+    Args:
+        stage (str): stage name. Example: transform.standarize_data
+        category (str, optional): source category or table. Defaults to "all".
+        seconds (float, optional): duration. Defaults to 0.0.
+        rows_in (int, optional): rows taken. Defaults to None (unknown).
+        rows_out (int, optional): rows produced. Defaults to None (unknown).
+        bytes_read (int, optional): bytes read. Defaults to None (unknown).
+        bytes_written (int, optional): bytes written. Defaults to None (unknown).
+        peak_rss (int, optional): peak RSS (bytes). Defaults to None (the one of this process).
+    """
+
+    if not METRICS:
+        return
+
+    if peak_rss is None:
+        _, peak_rss = profiling.get_rss()
+
+    if collecting is not None:
+        # Sent to the main process along with the task result
+        collecting.append(
+            {
+                "stage": stage,
+                "category": category,
+                "seconds": seconds,
+                "rows_in": rows_in,
+                "rows_out": rows_out,
+                "bytes_read": bytes_read,
+                "bytes_written": bytes_written,
+                "peak_rss": peak_rss,
+            }
+        )
+        return
+
+    labels = {"stage": stage, "category": category}
+    observe("stage_duration_seconds", seconds, **labels)
+
+    values = {
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+        "read_bytes": bytes_read,
+        "written_bytes": bytes_written,
+    }
+    for name, value in values.items():
+        if value is not None:
+            inc(f"stage_{name}", value, **labels)
+
+    rows = rows_out if rows_out is not None else rows_in
+    if rows is not None:
+        set_gauge("stage_rows_per_second", rows / max(seconds, 1e-9), **labels)
+
+    if peak_rss is not None:
+        set_gauge("stage_peak_memory_bytes", peak_rss, stage=stage)
+
+    if run is not None:
+        with lock:
+            summary = run["stages"].setdefault(
+                f"{stage}|{category}",
+                {"stage": stage, "category": category, "calls": 0, "seconds": 0.0},
+            )
+            summary["calls"] += 1
+            summary["seconds"] += seconds
+            for name, value in values.items():
+                if value is not None:
+                    summary[name] = summary.get(name, 0) + value
+            if peak_rss is not None:
+                summary["peak_rss_bytes"] = peak_rss
+
+
+@contextlib.contextmanager
+def stage(name, category="all"):
+    """Records the duration of a block of code as an execution of a stage
+    (see record). The rows and bytes are set on the dict it yields.
+
+    Usage:
+        with metrics.stage("extract.download", category="cine") as m:
+            ...
+            m["bytes_written"] = size
+
+    Args:
+        name (str): stage name
+        category (str, optional): source category or table. Defaults to "all".
+    """
+
+    values = {}
+    start = time.perf_counter()
+    yield values
+    record(name, category, time.perf_counter() - start, **values)
+
+
+def count_rows(value):
+    """Rows of the DataFrames in value (a DataFrame, or a list or dict of
+    them), None if there are none"""
+    if hasattr(value, "columns"):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        counts = [count_rows(x) for x in value]
+        counts = [x for x in counts if x is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def measured(func):
+    """Decorator that records every call of a function as an execution of a
+    stage named after it (see record), with the rows of the DataFrames it
+    takes and returns. Example: transform.set_t3_totales_cine
+
+    Args:
+        func (function): function to measure
+
+    Returns:
+        function: decorated function
+    """
+
+    name = f"{func.__module__.split('.')[-1]}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not METRICS:
+            return func(*args, **kwargs)
+
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        record(
+            name,
+            seconds=time.perf_counter() - start,
+            rows_in=count_rows(list(args) + list(kwargs.values())),
+            rows_out=count_rows(result),
+        )
+        return result
+
+    return wrapper
+
+
+def collected(func, *args):
+    """Calls func(*args) in a worker process, collecting the stages it
+    records (see record), which are lost otherwise: the registry of the
+    worker is not the one written by end_run. A module level function, so
+    it can be submitted to a process pool (see dag.run_dag).
+
+    Args:
+        func (function): function to call
+        *args: its arguments
+
+    Returns:
+        tuple: what func returned, and the stages recorded (see merge)
+    """
+    global collecting
+
+    collecting = []
+    try:
+        result = func(*args)
+        return result, collecting
+    finally:
+        collecting = None
+
+
+def merge(records):
+    """Records in this process the stages collected in a worker (see
+    collected)
+
+    Args:
+        records (list of dict): keyword arguments of record
+    """
+    for kwargs in records:
+        record(**kwargs)
+
+
+def read_state(folder=None):
+    """Returns the counters and histograms saved by the previous process
+    (see write), or an empty registry
+
+    Args:
+        folder (str, optional): metrics folder. Defaults to None (METRICS_DIR).
+
+    Returns:
+        dict: registry
+    """
+    fname = os.path.join(folder or METRICS_DIR, os.path.basename(METRICS_STATE))
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        state = json.load(f)
+    # Gauges describe the last run of the process that set them
+    return {
+        name: samples
+        for name, samples in state.items()
+        if name in DEFINITIONS and DEFINITIONS[name][0] != "gauge"
+    }
+
+
+def start_run():
+    """Starts the summary of a run. The first run of the process starts
+    from the counters of the previous processes (see read_state)."""
+    global run, loaded, registry
+
+    if not METRICS:
+        return
+
+    with lock:
+        if not loaded:
+            registry = read_state()
+            loaded = True
+
+    run = {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "stages": {},
+    }
+
+
+def end_run(result):
+    """Ends the run: counts it, and writes the textfile and its summary
+
+    Args:
+        result (str): ok, skipped or failed
+
+    Returns:
+        str: run summary file path, None if metrics are off
+    """
+    global run
+
+    if not METRICS or run is None:
+        return None
+
+    inc("runs", result=result)
+    set_gauge("last_run_timestamp_seconds", time.time(), result=result)
+
+    run["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+    run["result"] = result
+    run["stages"] = list(run["stages"].values())
+    fname = write(run)
+    run = None
+    return fname
+
+
+def get_openmetrics():
+    """Returns the registry in the OpenMetrics text format
+
+    Returns:
+        str: metric families, ending with # EOF
+    """
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def format_labels(pairs):
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def format_value(value):
+        if value == math.inf:
+            return "+Inf"
+        return repr(value) if isinstance(value, float) else str(value)
+
+    lines = []
+    with lock:
+        for name, (kind, help_text) in DEFINITIONS.items():
+            samples = registry.get(name)
+            if not samples:
+                continue
+            family = f"{PREFIX}_{name}"
+            lines.append(f"# TYPE {family} {kind}")
+            lines.append(f"# HELP {family} {escape(help_text)}")
+
+            for key, value in sorted(samples.items()):
+                pairs = json.loads(key)
+                if kind == "counter":
+                    lines.append(f"{family}_total{format_labels(pairs)} {format_value(value)}")
+                elif kind == "gauge":
+                    lines.append(f"{family}{format_labels(pairs)} {format_value(value)}")
+                else:
+                    for bound, count in zip(DURATION_BUCKETS, value["buckets"]):
+                        le = format_labels(pairs + [["le", format_value(float(bound))]])
+                        lines.append(f"{family}_bucket{le} {count}")
+                    lines.append(f"{family}_sum{format_labels(pairs)} {format_value(value['sum'])}")
+                    lines.append(f"{family}_count{format_labels(pairs)} {value['count']}")
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(fname, text):
+    """Writes a file to a temporary one first and then renames it, so the
+    collector never reads a half written file"""
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "w") as f:
+        f.write(text)
+    os.replace(tmp_fname, fname)
+
+
+def write(summary, folder=None):
+    """Writes the textfile, the state of the counters and the run summary,
+    and removes the oldest summaries (see METRICS_KEEP_RUNS)
+
+    Args:
+        summary (dict): run summary (see end_run)
+        folder (str, optional): metrics folder. Defaults to None (METRICS_DIR).
+
+    Returns:
+        str: run summary file path
+    """
+
+    folder = folder or METRICS_DIR
+    write_atomic(os.path.join(folder, os.path.basename(METRICS_TEXTFILE)), get_openmetrics())
+    with lock:
+        state = json.dumps(registry, indent=4)
+    write_atomic(os.path.join(folder, os.path.basename(METRICS_STATE)), state)
+
+    fname = os.path.join(folder, "runs", f"{datetime.datetime.now():%Y%m%d_%H%M%S_%f}.json")
+    write_atomic(fname, json.dumps(summary, indent=4))
+
+    summaries = sorted(glob.glob(os.path.join(folder, "runs", "*.json")))
+    for old in summaries[: max(len(summaries) - METRICS_KEEP_RUNS, 0)]:
+        os.remove(old)
+
+    log.info(f"Run metrics written to {fname}")
+    return fname
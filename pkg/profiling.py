@@ -0,0 +1,189 @@
+import contextlib
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import decouple as d
+
+import pkg.logger as logger
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Allocations listed per stage in the report, the ones that grew the most
+PROFILE_TOP = d.config("PROFILE_TOP", default=10, cast=int)
+
+# Stack frames kept by tracemalloc per allocation. More frames tell which
+# caller made the allocation but slow the run down even more.
+PROFILE_FRAMES = d.config("PROFILE_FRAMES", default=1, cast=int)
+
+# Profiling is opt-in (see start): tracemalloc slows down every allocation.
+# When off, stage and record_frames do nothing.
+profiling = False
+
+# Report being built (see write_report)
+report = {}
+
+
+def start():
+    """Turns profiling on: starts tracemalloc and a new report"""
+    global profiling, report
+    tracemalloc.start(PROFILE_FRAMES)
+    report = {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "stages": [],
+        "frames": [],
+    }
+    profiling = True
+
+
+def get_rss():
+    """Returns the current and peak resident set size of the process (bytes)
+
+    Returns:
+        tuple: current RSS (None if unknown) and peak RSS (None if unknown)
+    """
+
+    rss = None
+    # Linux only. statm: size resident shared text lib data dt (in pages)
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    peak_rss = None
+    try:
+        import resource
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        if sys.platform != "darwin":
+            peak_rss *= 1024
+    except ImportError:
+        # Windows
+        pass
+
+    return rss, peak_rss
+
+
+def take_snapshot():
+    """Returns a tracemalloc snapshot without tracemalloc's own allocations"""
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Records the memory used by a pipeline stage: the tracemalloc peak
+    while it runs, the allocations that grew the most (still alive at its
+    end) and the process RSS. Stages must not be nested, each one resets
+    tracemalloc's peak.
+
+    Usage:
+        with profiling.stage("transform"):
+            ...
+
+    Args:
+        name (str): stage name
+    """
+
+    if not profiling:
+        yield
+        return
+
+    tracemalloc.reset_peak()
+    before = take_snapshot()
+    rss_before, _ = get_rss()
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        current, peak = tracemalloc.get_traced_memory()
+        rss, peak_rss = get_rss()
+
+        top = take_snapshot().compare_to(before, "lineno")[:PROFILE_TOP]
+
+        report["stages"].append(
+            {
+                "stage": name,
+                "seconds": elapsed,
+                "traced_current_bytes": current,
+                "traced_peak_bytes": peak,
+                "rss_before_bytes": rss_before,
+                "rss_after_bytes": rss,
+                "peak_rss_bytes": peak_rss,
+                "top_allocations": [
+                    {
+                        "where": str(stat.traceback),
+                        "size_bytes": stat.size,
+                        "size_diff_bytes": stat.size_diff,
+                        "count": stat.count,
+                    }
+                    for stat in top
+                ],
+            }
+        )
+
+        log.info(
+            f"Profile {name}: traced peak {peak / 2**20:.1f} MB, "
+            f"peak RSS {(peak_rss or 0) / 2**20:.1f} MB"
+        )
+
+
+def record_frames(step, dfs_dic):
+    """Records the real (deep) memory footprint of the DataFrames in dfs_dic.
+    Other values (e.g. csv file paths) are skipped.
+
+    Args:
+        step (str): name of the point of the pipeline. Example: transform.standarized
+        dfs_dic (dict): frames (key: name, value: DataFrame)
+    """
+
+    if not profiling:
+        return
+
+    for name, df in dfs_dic.items():
+        if not hasattr(df, "memory_usage"):
+            continue
+        # deep=True: object columns count their strings too
+        usage = df.memory_usage(index=True, deep=True)
+        report["frames"].append(
+            {
+                "step": step,
+                "frame": name,
+                "rows": len(df),
+                "columns": len(df.columns),
+                "deep_bytes": int(usage.sum()),
+                "columns_bytes": {str(col): int(size) for col, size in usage.items()},
+            }
+        )
+
+
+def write_report(fname=None):
+    """Writes the report as JSON next to the log file
+
+    Args:
+        fname (str, optional): report file. Defaults to <log folder>/<app>_profile_<timestamp>.json.
+
+    Returns:
+        str: report file path, None if profiling is off
+    """
+
+    if not profiling:
+        return None
+
+    fname = fname or os.path.join(
+        logger.LOG_DIR,
+        f"{logger.APP_LOGGER_NAME}_profile_{datetime.datetime.now():%Y%m%d_%H%M%S}.json",
+    )
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, "w") as f:
+        json.dump(report, f, indent=4)
+
+    log.info(f"Memory profile written to {fname}")
+    return fname
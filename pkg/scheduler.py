@@ -0,0 +1,266 @@
+import contextlib
+import datetime
+import json
+import os
+import signal
+import threading
+import time
+import traceback
+
+import decouple as d
+
+import pkg.logger as logger
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Seconds between the start of two runs in daemon mode (see run_forever). A
+# run that takes longer delays the next one, runs are never stacked up.
+DAEMON_INTERVAL = d.config("DAEMON_INTERVAL", default=86400, cast=float)
+
+# Status of the daemon and its last run, rewritten after every change (see
+# write_status)
+DAEMON_STATUS_FILE = d.config(
+    "DAEMON_STATUS_FILE", default=os.path.join(os.getcwd(), "data", "daemon_status.json")
+)
+
+# Held while the pipeline runs, by the daemon and by single runs (e.g. from
+# cron) alike, so two runs never overlap (see run_lock)
+LOCK_FILE = os.path.join(os.getcwd(), "data", "app.lock")
+
+
+@contextlib.contextmanager
+def run_lock(fname=LOCK_FILE):
+    """Takes an exclusive lock on fname without waiting for it. The lock
+    belongs to the process: it's released when the block ends or the process
+    dies, so a crashed run never leaves it behind.
+
+    Usage:
+        with scheduler.run_lock() as locked:
+            if locked:
+                ...
+
+    Args:
+        fname (str, optional): lock file. Defaults to LOCK_FILE.
+
+    Yields:
+        bool: True if the lock was taken, False if another process holds it
+    """
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+    with open(fname, "a+") as f:
+        try:
+            import fcntl
+
+            lock = lambda: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            unlock = lambda: fcntl.flock(f, fcntl.LOCK_UN)
+        except ImportError:
+            # Windows
+            import msvcrt
+
+            lock = lambda: msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            unlock = lambda: msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+        try:
+            lock()
+        except OSError:
+            yield False
+            return
+
+        try:
+            # Who holds it, for whoever finds it locked
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()))
+            f.flush()
+            yield True
+        finally:
+            unlock()
+
+
+def get_running_pid(fname=LOCK_FILE):
+    """Returns the pid of the process running the pipeline (holding the run
+    lock, see run_lock), None if no run is in progress. It doesn't create
+    the lock file.
+
+    Args:
+        fname (str, optional): lock file. Defaults to LOCK_FILE.
+
+    Returns:
+        int or None: pid of the running process
+    """
+
+    if not os.path.exists(fname):
+        return None
+
+    with run_lock(fname) as locked:
+        if locked:
+            return None
+
+    with open(fname) as f:
+        pid = f.read().strip()
+    return int(pid) if pid.isdigit() else None
+
+
+def write_status(status, fname=DAEMON_STATUS_FILE):
+    """Writes the status as JSON. It's written to a temporary file and
+    renamed, so readers never see it half written.
+
+    Args:
+        status (dict): daemon status (see run_forever)
+        fname (str, optional): status file. Defaults to DAEMON_STATUS_FILE.
+    """
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(status, f, indent=4, default=str)
+    os.replace(tmp_fname, fname)
+
+
+def read_status(fname=DAEMON_STATUS_FILE):
+    """Returns the status written by the daemon, None if there's none"""
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+
+def now_iso():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def run_once(job, status, status_file=DAEMON_STATUS_FILE, lock_file=LOCK_FILE):
+    """Runs job holding the run lock and records the result in status.
+
+    Args:
+        job (function): called without arguments, returns a dict of run details (e.g. seconds per stage)
+        status (dict): daemon status, its "last_run" is replaced
+        status_file (str, optional): see write_status. Defaults to DAEMON_STATUS_FILE.
+        lock_file (str, optional): see run_lock. Defaults to LOCK_FILE.
+
+    Returns:
+        str: outcome: ok, error or skipped (another run holds the lock)
+    """
+
+    run = {"started": now_iso(), "finished": None, "outcome": "running"}
+    status.update(state="running", last_run=run)
+    write_status(status, status_file)
+
+    start = time.perf_counter()
+
+    with run_lock(lock_file) as locked:
+        if not locked:
+            log.warning("Another run is in progress, skipping this one")
+            run["outcome"] = "skipped"
+        else:
+            try:
+                run.update(job() or {})
+                run["outcome"] = "ok"
+            except Exception as exc:
+                # The daemon keeps going, the next run may succeed
+                log.exception(f"Run failed: {exc}")
+                run["outcome"] = "error"
+                run["error"] = "".join(
+                    traceback.format_exception_only(type(exc), exc)
+                ).strip()
+
+    run["finished"] = now_iso()
+    run["elapsed"] = time.perf_counter() - start
+    status["runs"][run["outcome"]] = status["runs"].get(run["outcome"], 0) + 1
+    if run["outcome"] == "ok":
+        status["last_success"] = run["finished"]
+
+    return run["outcome"]
+
+
+def run_forever(
+    job,
+    interval=DAEMON_INTERVAL,
+    max_runs=None,
+    status_file=DAEMON_STATUS_FILE,
+    lock_file=LOCK_FILE,
+):
+    """Runs job every interval seconds in this process, which stays alive in
+    between: modules, sessions and connection pools created by job are
+    reused by the next runs.
+
+    Runs never overlap: if one takes longer than interval, the missed starts
+    are skipped and the next run starts as soon as it ends. The status (state,
+    next run, counts and the details of the last run) is kept in
+    DAEMON_STATUS_FILE. SIGTERM or Ctrl+C stop the daemon after the current
+    run.
+
+    Args:
+        job (function): called without arguments, returns a dict of run details (see run_once)
+        interval (float, optional): seconds between the start of two runs. Defaults to DAEMON_INTERVAL.
+        max_runs (int, optional): stop after this many runs. Defaults to None (never).
+        status_file (str, optional): see write_status. Defaults to DAEMON_STATUS_FILE.
+        lock_file (str, optional): see run_lock. Defaults to LOCK_FILE.
+    """
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        log.info(f"Signal {signum} received, stopping after the current run")
+        stop.set()
+
+    previous_handlers = {
+        signum: signal.signal(signum, request_stop)
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+
+    status = {
+        "pid": os.getpid(),
+        "started": now_iso(),
+        "interval": interval,
+        "state": "starting",
+        "next_run": None,
+        "last_success": None,
+        "runs": {},
+        "last_run": None,
+    }
+    log.info(f"Daemon started, running every {interval:g}s")
+
+    runs = 0
+    next_start = time.monotonic()
+
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            run_once(job, status, status_file, lock_file)
+            runs += 1
+            if max_runs is not None and runs >= max_runs:
+                break
+
+            # Starts that fell inside the run are skipped, not made up for
+            next_start += interval
+            missed = 0
+            while next_start <= time.monotonic():
+                next_start += interval
+                missed += 1
+            if missed:
+                log.warning(
+                    f"The run took {time.monotonic() - started:.0f}s, "
+                    f"longer than the interval, {missed} start(s) skipped"
+                )
+
+            wait = next_start - time.monotonic()
+            status.update(
+                state="idle",
+                next_run=(datetime.datetime.now() + datetime.timedelta(seconds=wait)).isoformat(
+                    timespec="seconds"
+                ),
+            )
+            write_status(status, status_file)
+
+            stop.wait(wait)
+
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    status.update(state="stopped", next_run=None)
+    write_status(status, status_file)
+    log.info("Daemon stopped")
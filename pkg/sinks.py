@@ -0,0 +1,277 @@
+import importlib
+import os
+import shutil
+import time
+
+import decouple as d
+import sqlalchemy as s
+
+import pkg.logger as logger
+import pkg.metrics as metrics
+import pkg.transform as t
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Database files of the embedded sinks
+SQLITE_PATH = d.config(
+    "SQLITE_PATH", default=os.path.join(os.getcwd(), "data", "alkemy.sqlite")
+)
+DUCKDB_PATH = d.config(
+    "DUCKDB_PATH", default=os.path.join(os.getcwd(), "data", "alkemy.duckdb")
+)
+
+# Root folder of the Parquet sink, one sub folder per table
+PARQUET_DIR = d.config(
+    "PARQUET_DIR", default=os.path.join(os.getcwd(), "data", "parquet")
+)
+
+# Columns each table is partitioned by in the Parquet sink (one sub folder
+# per value, e.g. alk_registros_unificados/categoria=Salas de cine/)
+PARQUET_PARTITIONS = {
+    "alk_registros_unificados": ["categoria"],
+    "alk_registros_totales": [],
+    "alk_totales_cine": [],
+    "alk_totales_geo": ["nivel"],
+}
+
+
+def get_stats(tb, rows, size, elapsed):
+    """Logs, records (see pkg/metrics.py) and returns the throughput of a
+    table's load
+
+    Args:
+        tb (str): table name
+        rows (int): rows loaded
+        size (int): bytes loaded
+        elapsed (float): seconds it took
+
+    Returns:
+        dict: rows, bytes, seconds, rows/s and bytes/s
+    """
+    elapsed = max(elapsed, 1e-9)
+    stats = {
+        "rows": rows,
+        "bytes": size,
+        "seconds": elapsed,
+        "rows_per_s": rows / elapsed,
+        "bytes_per_s": size / elapsed,
+    }
+    log.info(
+        f"{tb}: {rows} rows ({size} bytes) in {elapsed:.2f}s "
+        f"({stats['rows_per_s']:.0f} rows/s, {stats['bytes_per_s'] / 2**20:.2f} MB/s)"
+    )
+    metrics.record("load", tb, elapsed, rows_out=rows, bytes_written=size)
+    return stats
+
+
+def iter_chunks(df, chunksize):
+    """Returns the table as an iterable of DataFrames. Tables written to disk
+    by transform's streaming mode are read chunksize rows at a time.
+
+    Args:
+        df (pandas.DataFrame or str): table data, or csv file path
+        chunksize (int): rows per chunk when reading a csv file
+
+    Returns:
+        iterable of pandas.DataFrame: table chunks
+    """
+    if isinstance(df, str):
+        return t.read_output(df, chunksize=chunksize)
+    return [df]
+
+
+def import_optional(module_name, sink_name):
+    """Imports a package that is only needed by some sinks
+
+    Args:
+        module_name (str): package to import. Example: duckdb
+        sink_name (str): LOAD_SINK value that needs it
+
+    Raises:
+        ImportError: the package is not installed
+
+    Returns:
+        module: imported package
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError as exc:
+        raise ImportError(
+            f'LOAD_SINK="{sink_name}" needs the {module_name} package: pip install {module_name}'
+        ) from exc
+
+
+class Sink:
+    """
+    Storage backend used by load.load. A sink receives the output tables of
+    transform (key: table name, value: DataFrame or csv file path written by
+    the streaming mode) and replaces its stored version of each of them.
+    """
+
+    def __init__(self, chunksize):
+        # Rows per chunk when reading csv files written by the streaming mode
+        self.chunksize = chunksize
+
+    def write(self, dfs_dic):
+        """Replaces the stored tables with the ones in dfs_dic
+
+        Args:
+            dfs_dic (dict): tables to load (key: table name, value: DataFrame or csv file path)
+
+        Returns:
+            dict: load statistics (key: table name, value: see get_stats)
+        """
+        raise NotImplementedError
+
+
+class SQLiteSink(Sink):
+    """Stores the tables in a SQLite database file (SQLITE_PATH)"""
+
+    def __init__(self, chunksize, path=SQLITE_PATH):
+        super().__init__(chunksize)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.engine = s.create_engine(f"sqlite:///{path}")
+
+    @logger.traced
+    def write(self, dfs_dic):
+        stats = {}
+
+        # A single transaction: all the tables are replaced or none
+        with self.engine.begin() as conn:
+            for tb, df in dfs_dic.items():
+                start = time.perf_counter()
+                rows = 0
+                size = 0
+
+                for idx, chunk in enumerate(iter_chunks(df, self.chunksize)):
+                    chunk.to_sql(
+                        name=tb,
+                        con=conn,
+                        if_exists="replace" if idx == 0 else "append",
+                        index=False,
+                    )
+                    rows += len(chunk)
+                    size += int(chunk.memory_usage(index=False).sum())
+
+                stats[tb] = get_stats(tb, rows, size, time.perf_counter() - start)
+
+        return stats
+
+
+class DuckDBSink(Sink):
+    """Stores the tables in a DuckDB database file (DUCKDB_PATH). Needs the
+    duckdb package."""
+
+    def __init__(self, chunksize, path=DUCKDB_PATH):
+        super().__init__(chunksize)
+        self.duckdb = import_optional("duckdb", "duckdb")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+
+    @logger.traced
+    def write(self, dfs_dic):
+        stats = {}
+
+        with self.duckdb.connect(self.path) as conn:
+            # A single transaction: all the tables are replaced or none
+            conn.begin()
+            try:
+                for tb, df in dfs_dic.items():
+                    start = time.perf_counter()
+                    rows = 0
+                    size = 0
+
+                    for idx, chunk in enumerate(iter_chunks(df, self.chunksize)):
+                        # Categorical columns would be ENUMs of the values of
+                        # the first chunk, the next ones can have others
+                        categories = list(chunk.select_dtypes("category"))
+                        if categories:
+                            chunk = chunk.astype({col: object for col in categories})
+                        # DuckDB reads the DataFrame in place, without
+                        # copying it, through a view
+                        conn.register("chunk_view", chunk)
+                        if idx == 0:
+                            conn.execute(
+                                f'CREATE OR REPLACE TABLE "{tb}" AS SELECT * FROM chunk_view'
+                            )
+                        else:
+                            conn.execute(f'INSERT INTO "{tb}" SELECT * FROM chunk_view')
+                        conn.unregister("chunk_view")
+                        rows += len(chunk)
+                        size += int(chunk.memory_usage(index=False).sum())
+
+                    stats[tb] = get_stats(
+                        tb, rows, size, time.perf_counter() - start)
+
+                conn.commit()
+
+            except BaseException:
+                conn.rollback()
+                raise
+
+        return stats
+
+
+class ParquetSink(Sink):
+    """Stores every table as a Parquet dataset in PARQUET_DIR/<table>,
+    partitioned by PARQUET_PARTITIONS. Needs the pyarrow package.
+
+    Each table is written to a temporary folder that replaces the previous
+    one once complete, so readers never find a half written table.
+    """
+
+    def __init__(self, chunksize, path=PARQUET_DIR):
+        super().__init__(chunksize)
+        self.pa = import_optional("pyarrow", "parquet")
+        self.pq = import_optional("pyarrow.parquet", "parquet")
+        self.path = path
+
+    @logger.traced
+    def write(self, dfs_dic):
+        stats = {}
+        os.makedirs(self.path, exist_ok=True)
+
+        for tb, df in dfs_dic.items():
+            start = time.perf_counter()
+            rows = 0
+
+            tb_dir = os.path.join(self.path, tb)
+            tmp_dir = tb_dir + ".tmp"
+            old_dir = tb_dir + ".old"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            table = None
+
+            for idx, chunk in enumerate(iter_chunks(df, self.chunksize)):
+                table = self.pa.Table.from_pandas(chunk, preserve_index=False)
+                self.pq.write_to_dataset(
+                    table,
+                    root_path=tmp_dir,
+                    partition_cols=PARQUET_PARTITIONS.get(tb) or None,
+                    # One file per chunk (and partition)
+                    basename_template=f"part-{idx}-{{i}}.parquet",
+                )
+                rows += len(chunk)
+
+            # write_to_dataset writes no file for an empty table, a file with
+            # only the schema keeps it readable
+            if not rows and table is not None:
+                self.pq.write_table(table, os.path.join(tmp_dir, "part-0-0.parquet"))
+
+            # Swap the folders: renames are atomic, the old folder is only
+            # missing between the two of them
+            shutil.rmtree(old_dir, ignore_errors=True)
+            if os.path.exists(tb_dir):
+                os.rename(tb_dir, old_dir)
+            os.rename(tmp_dir, tb_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+            size = sum(
+                os.path.getsize(os.path.join(root, fname))
+                for root, _, fnames in os.walk(tb_dir)
+                for fname in fnames
+            )
+            stats[tb] = get_stats(tb, rows, size, time.perf_counter() - start)
+
+        return stats
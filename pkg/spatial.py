@@ -0,0 +1,530 @@
+import heapq
+
+import decouple as d
+import numpy as np
+import pandas as pd
+
+import pkg.logger as logger
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Characters of the geohash cells of the venues (see encode_geohash). 5 is a
+# cell of about 4.9 x 4.9 km, every character less makes it 4 to 8 times
+# bigger. Max 12.
+SPATIAL_PRECISION = d.config("SPATIAL_PRECISION", default=5, cast=int)
+
+# Radius (km) of the proximity aggregates of totales_geo: venues, pantallas,
+# butacas, etc. within it from the center of each cell and departamento
+SPATIAL_RADIUS_KM = d.config("SPATIAL_RADIUS_KM", default=10, cast=float)
+
+# Points per leaf of the KD-tree (see KDTree)
+KD_LEAF_SIZE = 32
+
+# Mean radius of the Earth, in km
+EARTH_RADIUS_KM = 6371.0088
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Kind of venue of each source, counted in totales_geo as cnt_<kind>
+KINDS = {
+    "cine": "cines",
+    "museos_datosabiertos": "museos",
+    "biblioteca_popular": "bibliotecas",
+}
+
+# Aggregates of totales_geo, per cell or departamento and within
+# SPATIAL_RADIUS_KM (<measure>_radio)
+MEASURES = [
+    "cnt_espacios",
+    "cnt_cines",
+    "sum_pantallas",
+    "sum_butacas",
+    "cnt_museos",
+    "cnt_bibliotecas",
+]
+
+
+def clean_coordinates(latitud, longitud):
+    """Parses the coordinates of a source. Values that are not numbers, out
+    of range or 0, 0 (a placeholder of some sources) are left missing.
+
+    Args:
+        latitud (pandas.Series): latitud as read (text)
+        longitud (pandas.Series): longitud as read (text)
+
+    Returns:
+        tuple of pandas.Series: latitud and longitud (float, NaN where missing)
+    """
+
+    def parse(series):
+        # "-34,6037" --> -34.6037
+        return pd.to_numeric(
+            series.astype(str).str.strip().str.replace(",", ".", regex=False),
+            errors="coerce",
+        )
+
+    latitud, longitud = parse(latitud), parse(longitud)
+    valid = (
+        latitud.between(-90, 90)
+        & longitud.between(-180, 180)
+        & ~((latitud == 0) & (longitud == 0))
+    )
+    return latitud.where(valid), longitud.where(valid)
+
+
+def geohash_codes(latitud, longitud, precision=SPATIAL_PRECISION):
+    """Returns the geohash cell of each point as an integer: 5 * precision
+    bits, alternating longitud and latitud bits (longitud first). Codes of
+    cells sharing a prefix are contiguous, so a cell's points are a range of
+    the sorted codes.
+
+    Args:
+        latitud (array-like): latitud (degrees)
+        longitud (array-like): longitud (degrees)
+        precision (int, optional): geohash characters. Defaults to SPATIAL_PRECISION.
+
+    Returns:
+        numpy.ndarray: uint64 codes (the points must not be missing)
+    """
+
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+
+    def quantize(x, lower, span, n_bits):
+        cells = np.floor((np.asarray(x, dtype=float) - lower) / span * 2**n_bits)
+        return np.clip(cells, 0, 2**n_bits - 1).astype("uint64")
+
+    lon_q = quantize(longitud, -180, 360, lon_bits)
+    lat_q = quantize(latitud, -90, 180, lat_bits)
+
+    codes = np.zeros(len(lon_q), dtype="uint64")
+    for bit in range(bits):
+        q, n_bits = (lon_q, lon_bits) if bit % 2 == 0 else (lat_q, lat_bits)
+        shift = np.uint64(n_bits - 1 - bit // 2)
+        codes = (codes << np.uint64(1)) | ((q >> shift) & np.uint64(1))
+
+    return codes
+
+
+def geohash_strings(codes, precision=SPATIAL_PRECISION):
+    """Returns the geohash of each code (see geohash_codes). Example:
+    -34.6037, -58.3816 --> "69y7p"
+
+    Args:
+        codes (numpy.ndarray): uint64 codes
+        precision (int, optional): geohash characters. Defaults to SPATIAL_PRECISION.
+
+    Returns:
+        numpy.ndarray: geohashes (object)
+    """
+
+    # Once per distinct cell, the points take the result
+    uniques, inverse = np.unique(codes, return_inverse=True)
+    alphabet = np.array(list(GEOHASH_ALPHABET))
+    chars = [
+        alphabet[(uniques >> np.uint64(5 * (precision - 1 - pos))) & np.uint64(31)]
+        for pos in range(precision)
+    ]
+    strings = np.array(["".join(x) for x in zip(*chars)], dtype=object)
+    return strings[inverse]
+
+
+def geohash_centers(codes, precision=SPATIAL_PRECISION):
+    """Returns the center of each geohash cell
+
+    Args:
+        codes (numpy.ndarray): uint64 codes (see geohash_codes)
+        precision (int, optional): geohash characters. Defaults to SPATIAL_PRECISION.
+
+    Returns:
+        tuple of numpy.ndarray: latitud and longitud (degrees)
+    """
+
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    lon_q = np.zeros(len(codes), dtype="uint64")
+    lat_q = np.zeros(len(codes), dtype="uint64")
+
+    for bit in range(bits):
+        value = (codes >> np.uint64(bits - 1 - bit)) & np.uint64(1)
+        if bit % 2 == 0:
+            lon_q = (lon_q << np.uint64(1)) | value
+        else:
+            lat_q = (lat_q << np.uint64(1)) | value
+
+    return (
+        -90 + (lat_q + 0.5) * 180 / 2**lat_bits,
+        -180 + (lon_q + 0.5) * 360 / 2**lon_bits,
+    )
+
+
+def encode_geohash(latitud, longitud, precision=SPATIAL_PRECISION):
+    """Returns the geohash of each point, None where it's missing
+
+    Args:
+        latitud (pandas.Series): latitud (degrees)
+        longitud (pandas.Series): longitud (degrees)
+        precision (int, optional): geohash characters. Defaults to SPATIAL_PRECISION.
+
+    Returns:
+        pandas.Series: geohashes (same index as latitud)
+    """
+
+    valid = (latitud.notna() & longitud.notna()).to_numpy()
+    geohash = np.full(len(latitud), None, dtype=object)
+    if valid.any():
+        codes = geohash_codes(latitud[valid], longitud[valid], precision)
+        geohash[valid] = geohash_strings(codes, precision)
+    return pd.Series(geohash, index=latitud.index)
+
+
+def to_xyz(latitud, longitud):
+    """Cartesian coordinates (km) of points on the Earth's surface. The
+    straight line distance between two of them (a chord) grows with the
+    distance along the surface, so it ranks neighbours the same."""
+    lat = np.radians(np.asarray(latitud, dtype=float))
+    lon = np.radians(np.asarray(longitud, dtype=float))
+    return EARTH_RADIUS_KM * np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+def chord_to_km(chord):
+    """Distance along the surface of a chord's length (km)"""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / (2 * EARTH_RADIUS_KM), 1))
+
+
+def km_to_chord(km):
+    """Chord's length of a distance along the surface (km)"""
+    return 2 * EARTH_RADIUS_KM * np.sin(np.minimum(km / (2 * EARTH_RADIUS_KM), np.pi / 2))
+
+
+class KDTree:
+    """Static KD-tree over 3D points.
+
+    The points are split in two halves at the median of their widest
+    dimension, recursively, until KD_LEAF_SIZE or less are left. Nodes are
+    stored in flat arrays (range of points, children and bounding box), and
+    the points in tree order, so every node is a contiguous slice of them.
+    Nodes whose bounding box is out of reach are skipped whole, and nodes
+    fully in reach are added up without looking at their points (see
+    radius_sums).
+    """
+
+    def __init__(self, points, leaf_size=KD_LEAF_SIZE):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.order = np.arange(len(points))
+
+        starts, ends, lefts, rights, lows, highs = [], [], [], [], [], []
+
+        def build(start, end):
+            node = len(starts)
+            pts = points[self.order[start:end]]
+            starts.append(start)
+            ends.append(end)
+            lefts.append(-1)
+            rights.append(-1)
+            lows.append(pts.min(axis=0))
+            highs.append(pts.max(axis=0))
+
+            if end - start > leaf_size:
+                dim = np.argmax(highs[node] - lows[node])
+                mid = (start + end) // 2
+                part = np.argpartition(pts[:, dim], mid - start)
+                self.order[start:end] = self.order[start:end][part]
+                lefts[node] = build(start, mid)
+                rights[node] = build(mid, end)
+            return node
+
+        if len(points):
+            build(0, len(points))
+
+        self.starts, self.ends = np.array(starts, dtype=int), np.array(ends, dtype=int)
+        self.lefts, self.rights = np.array(lefts, dtype=int), np.array(rights, dtype=int)
+        self.lows = np.array(lows).reshape(-1, 3)
+        self.highs = np.array(highs).reshape(-1, 3)
+        self.points = points[self.order]
+
+    def box_distances(self, node, queries):
+        """Squared distances from each query to the nearest and farthest
+        points of a node's bounding box"""
+        low, high = self.lows[node], self.highs[node]
+        nearest = np.maximum(low - queries, 0) + np.maximum(queries - high, 0)
+        farthest = np.maximum(np.abs(queries - low), np.abs(queries - high))
+        return (nearest**2).sum(axis=1), (farthest**2).sum(axis=1)
+
+    def radius_sums(self, queries, radius, weights):
+        """Adds up the weights of the points within radius of each query, all
+        the queries at once
+
+        Args:
+            queries (numpy.ndarray): points (m x 3)
+            radius (float): max distance (straight line)
+            weights (numpy.ndarray): values to add up of each point (n x w, in input order)
+
+        Returns:
+            numpy.ndarray: sums (m x w)
+        """
+
+        weights = np.asarray(weights, dtype=float)[self.order]
+        cumsum = np.vstack([np.zeros(weights.shape[1]), np.cumsum(weights, axis=0)])
+        sums = np.zeros((len(queries), weights.shape[1]))
+        radius2 = radius**2
+
+        stack = [(0, np.arange(len(queries)))] if len(self.starts) else []
+        while stack:
+            node, idx = stack.pop()
+            nearest, farthest = self.box_distances(node, queries[idx])
+            reached = nearest <= radius2
+            idx, farthest = idx[reached], farthest[reached]
+
+            start, end = self.starts[node], self.ends[node]
+            inside = farthest <= radius2
+            sums[idx[inside]] += cumsum[end] - cumsum[start]
+            idx = idx[~inside]
+            if not len(idx):
+                continue
+
+            if self.lefts[node] < 0:
+                dist2 = ((queries[idx, None, :] - self.points[None, start:end]) ** 2).sum(axis=2)
+                sums[idx] += (dist2 <= radius2) @ weights[start:end]
+            else:
+                stack.append((self.lefts[node], idx))
+                stack.append((self.rights[node], idx))
+
+        return sums
+
+    def within(self, query, radius):
+        """Returns the points within radius of query
+
+        Args:
+            query (numpy.ndarray): point (3)
+            radius (float): max distance (straight line)
+
+        Returns:
+            tuple of numpy.ndarray: positions (input order) and distances, nearest first
+        """
+
+        found = []
+        stack = [0] if len(self.starts) else []
+        while stack:
+            node = stack.pop()
+            nearest, _ = self.box_distances(node, query[None])
+            if nearest[0] > radius**2:
+                continue
+            if self.lefts[node] < 0:
+                found.append(np.arange(self.starts[node], self.ends[node]))
+            else:
+                stack += [self.lefts[node], self.rights[node]]
+
+        pos = np.concatenate(found) if found else np.array([], dtype=int)
+        dist = np.sqrt(((self.points[pos] - query) ** 2).sum(axis=1))
+        pos, dist = pos[dist <= radius], dist[dist <= radius]
+        sort = np.argsort(dist, kind="stable")
+        return self.order[pos[sort]], dist[sort]
+
+    def nearest(self, query, k=1):
+        """Returns the k points nearest to query. Nodes are visited nearest
+        box first, and the search ends when the next box is farther than the
+        k-th point found.
+
+        Args:
+            query (numpy.ndarray): point (3)
+            k (int, optional): number of points. Defaults to 1.
+
+        Returns:
+            tuple of numpy.ndarray: positions (input order) and distances, nearest first
+        """
+
+        best_pos = np.array([], dtype=int)
+        best_dist2 = np.array([])
+        heap = [(0.0, 0)] if len(self.starts) else []
+
+        while heap:
+            box_dist2, node = heapq.heappop(heap)
+            if len(best_dist2) == k and box_dist2 > best_dist2[-1]:
+                break
+
+            if self.lefts[node] < 0:
+                start, end = self.starts[node], self.ends[node]
+                dist2 = ((self.points[start:end] - query) ** 2).sum(axis=1)
+                best_pos = np.concatenate([best_pos, np.arange(start, end)])
+                best_dist2 = np.concatenate([best_dist2, dist2])
+                keep = np.argsort(best_dist2, kind="stable")[:k]
+                best_pos, best_dist2 = best_pos[keep], best_dist2[keep]
+            else:
+                for child in (self.lefts[node], self.rights[node]):
+                    nearest, _ = self.box_distances(child, query[None])
+                    heapq.heappush(heap, (nearest[0], child))
+
+        return self.order[best_pos], np.sqrt(best_dist2)
+
+
+class SpatialIndex:
+    """Index of points by latitud/longitud: a KD-tree (see KDTree) for
+    nearest and radius queries, and the points sorted by geohash cell, so
+    the points of a cell (or of any geohash prefix) are a contiguous range.
+
+    Usage:
+        index = SpatialIndex(df["latitud"], df["longitud"])
+        pos, km = index.nearest(-34.6037, -58.3816, k=5)
+        df.iloc[pos]
+    """
+
+    def __init__(self, latitud, longitud, precision=SPATIAL_PRECISION):
+        """
+        Args:
+            latitud (array-like): latitud (degrees), not missing
+            longitud (array-like): longitud (degrees), not missing
+            precision (int, optional): characters of the geohash cells. Defaults to SPATIAL_PRECISION.
+        """
+        self.precision = precision
+        self.tree = KDTree(to_xyz(latitud, longitud))
+
+        codes = geohash_codes(latitud, longitud, precision)
+        self.cell_order = np.argsort(codes, kind="stable")
+        self.cell_codes = codes[self.cell_order]
+
+    def nearest(self, latitud, longitud, k=1):
+        """Returns the k points nearest to a location
+
+        Returns:
+            tuple of numpy.ndarray: positions and distances (km), nearest first
+        """
+        pos, chord = self.tree.nearest(to_xyz([latitud], [longitud])[0], k)
+        return pos, chord_to_km(chord)
+
+    def within(self, latitud, longitud, radius_km):
+        """Returns the points within radius_km of a location
+
+        Returns:
+            tuple of numpy.ndarray: positions and distances (km), nearest first
+        """
+        pos, chord = self.tree.within(to_xyz([latitud], [longitud])[0], km_to_chord(radius_km))
+        return pos, chord_to_km(chord)
+
+    def radius_sums(self, latitud, longitud, radius_km, weights):
+        """Adds up the weights of the points within radius_km of each
+        location (see KDTree.radius_sums)
+
+        Args:
+            latitud (array-like): latitud of the locations (degrees)
+            longitud (array-like): longitud of the locations (degrees)
+            radius_km (float): radius (km)
+            weights (numpy.ndarray): values to add up of each point (n x w)
+
+        Returns:
+            numpy.ndarray: sums (locations x w)
+        """
+        return self.tree.radius_sums(
+            to_xyz(latitud, longitud), km_to_chord(radius_km), weights
+        )
+
+    def in_cell(self, geohash):
+        """Returns the points in a geohash cell, or in all the cells starting
+        with geohash if it's shorter than precision
+
+        Returns:
+            numpy.ndarray: positions
+        """
+        prefix = len(geohash)
+        if prefix > self.precision:
+            raise ValueError(f"geohash longer than the index precision ({self.precision})")
+
+        code = 0
+        for char in geohash:
+            code = code * 32 + GEOHASH_ALPHABET.index(char)
+        shift = 5 * (self.precision - prefix)
+        first, last = np.searchsorted(
+            self.cell_codes,
+            np.array([code << shift, (code + 1) << shift], dtype="uint64"),
+        )
+        return self.cell_order[first:last]
+
+
+def get_points(category, df):
+    """Returns the venues of a standarized source with coordinates, with the
+    values added up by totales_geo (see MEASURES)
+
+    Args:
+        category (str): source category. Example: cine
+        df (pandas.DataFrame): standarized source (see transform.standarize_data)
+
+    Returns:
+        pandas.DataFrame: latitud, longitud, id_departamento and MEASURES
+    """
+
+    df = df[df["latitud"].notna() & df["longitud"].notna()]
+    points = pd.DataFrame(
+        {
+            "latitud": df["latitud"].to_numpy(dtype=float),
+            "longitud": df["longitud"].to_numpy(dtype=float),
+            "id_departamento": df["id_departamento"].to_numpy(),
+        }
+    )
+    for measure in MEASURES:
+        points[measure] = 0
+    points["cnt_espacios"] = 1
+    if category in KINDS:
+        points[f"cnt_{KINDS[category]}"] = 1
+    for col in ["pantallas", "butacas"]:
+        if col in df:
+            points[f"sum_{col}"] = df[col].fillna(0).to_numpy(dtype="int64")
+
+    return points
+
+
+@logger.traced
+def aggregate(points, precision=SPATIAL_PRECISION, radius_km=SPATIAL_RADIUS_KM):
+    """Adds up the venues per geohash cell and per departamento, and within
+    radius_km of the center of each (see SpatialIndex.radius_sums)
+
+    Args:
+        points (pandas.DataFrame): venues (see get_points)
+        precision (int, optional): characters of the geohash cells. Defaults to SPATIAL_PRECISION.
+        radius_km (float, optional): radius of the <measure>_radio columns. Defaults to SPATIAL_RADIUS_KM.
+
+    Returns:
+        pandas.DataFrame: one row per cell (nivel "celda") and per departamento (nivel "departamento")
+    """
+
+    columns = (
+        ["nivel", "celda", "id_departamento", "latitud", "longitud"]
+        + MEASURES
+        + [f"{measure}_radio" for measure in MEASURES]
+        + ["radio_km"]
+    )
+    if points.empty:
+        return pd.DataFrame(columns=columns)
+
+    index = SpatialIndex(points["latitud"], points["longitud"], precision)
+    codes = geohash_codes(points["latitud"], points["longitud"], precision)
+
+    cells = points[MEASURES].groupby(codes).sum()
+    cells["latitud"], cells["longitud"] = geohash_centers(cells.index.to_numpy(), precision)
+    cells["celda"] = geohash_strings(cells.index.to_numpy(), precision)
+    cells["nivel"] = "celda"
+
+    # Center of the departamento: the mean of its venues
+    deptos = points.groupby("id_departamento").agg(
+        **{col: (col, "mean") for col in ["latitud", "longitud"]},
+        **{measure: (measure, "sum") for measure in MEASURES},
+    )
+    deptos["nivel"] = "departamento"
+    deptos = deptos.reset_index()
+
+    out_df = pd.concat([cells.reset_index(drop=True), deptos], ignore_index=True)
+
+    radio = index.radius_sums(
+        out_df["latitud"], out_df["longitud"], radius_km, points[MEASURES].to_numpy()
+    )
+    for pos, measure in enumerate(MEASURES):
+        out_df[f"{measure}_radio"] = radio[:, pos].round().astype("int64")
+    out_df["radio_km"] = radius_km
+    out_df["id_departamento"] = out_df["id_departamento"].astype("Int64")
+
+    log.info(
+        f"Spatial index: {len(points)} venues, {len(cells)} cells, {len(deptos)} departamentos"
+    )
+    return out_df.reindex(columns=columns)
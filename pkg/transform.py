@@ -1,43 +1,401 @@
 import datetime as dt
+import functools
+import importlib.util
+import os
 import re
+import time
 
+import decouple as d
+import numpy as np
 import pandas as pd
 import unidecode as un
 
-
-def transform(csvs_dic):
+import pkg.aggregates as ag
+import pkg.dag as dag
+import pkg.dedup as dd
+import pkg.logger as logger
+import pkg.metrics as metrics
+import pkg.profiling as profiling
+import pkg.spatial as sp
+
+# Set the logger for this file
+log = logger.set_logger(logger_name=logger.get_rel_path(__file__))
+
+# Parser used by pandas.read_csv: "c" (pandas' default) or "pyarrow"
+# (multithreaded, needs the pyarrow package installed)
+CSV_ENGINE = d.config("CSV_ENGINE", default="c")
+
+# Rows per chunk in streaming mode (see transform_streaming). 0 means the
+# whole files are loaded in memory.
+TRANSFORM_CHUNKSIZE = d.config("TRANSFORM_CHUNKSIZE", default=0, cast=int)
+
+# Workers of the transform task graph (see transform): sources are read and
+# standarized in parallel processes, and the output tables built in parallel
+# threads. 1 runs everything in the calling thread, one step after the other.
+TRANSFORM_WORKERS = d.config("TRANSFORM_WORKERS", default=1, cast=int)
+
+# Folder where streaming mode writes registros_unificados
+TRANSFORM_OUT_DIR = os.path.join(os.getcwd(), "data", "transform")
+
+# Missing values in the csv files written by streaming mode, so empty strings
+# stay empty strings. The same as load's COPY uses for DataFrames.
+NULL_REP = "\\N"
+
+# Groupings counted in registros_totales
+TOTALES_GROUPING_SETS = [["categoria"], ["fuente"], ["provincia", "categoria"]]
+
+# Aggregates of registros_totales and totales_cine (key: output column,
+# value: (input column, function), see aggregate_grouping_sets)
+TOTALES_AGGREGATES = {"totals_cnt": (None, "size")}
+CINE_GROUPING_SETS = [["provincia"]]
+CINE_AGGREGATES = {
+    "sum_pantallas": ("pantallas", "sum"),
+    "sum_butacas": ("butacas", "sum"),
+    "cnt_espacio_incaa": ("espacio_incaa", "count"),
+}
+
+# Max number of distinct values whose clean_up result is kept in memory
+NORMALIZE_CACHE_SIZE = 4096
+
+# Manual adjustments of the cleaned up values (key: column, value: dict of
+# value --> replacement)
+MANUAL_REPLACEMENTS = {
+    "provincia": {
+        "TIERRA DEL FUEGO, ANTARTIDA E ISLAS DEL ATLANTICO SUR": "TIERRA DEL FUEGO"
+    },
+    "fuente": {"GOB. PCIA.": "GOBIERNO DE LA PROVINCIA"},
+}
+
+# Columns used by any of the output tables, common to all the sources
+# (key: standarized column name, value: dtype). Columns with few distinct
+# values are read as categorical, ids as nullable integers and the rest as
+# plain text (e.g. phone numbers and postal codes must keep their format).
+COMMON_DTYPES = {
+    "cod_loc": "Int64",
+    "id_provincia": "Int64",
+    "id_departamento": "Int64",
+    "categoria": "category",
+    "provincia": "category",
+    "localidad": str,
+    "nombre": str,
+    "domicilio": str,
+    "cp": str,
+    "telefono": str,
+    "mail": str,
+    "web": str,
+    "fuente": "category",
+    # Parsed in standarize_data, some sources come with decimal commas
+    "latitud": str,
+    "longitud": str,
+}
+
+# dtypes of the output tables written to csv files, when they differ from
+# COMMON_DTYPES (see read_output)
+OUTPUT_DTYPES = {
+    **COMMON_DTYPES,
+    "latitud": "float64",
+    "longitud": "float64",
+    "geohash": str,
+}
+
+# Columns of registros_unificados (see set_t1_registros_unificados), before
+# cluster_id and dt_loaded
+REGISTROS_COLS = list(COMMON_DTYPES) + ["geohash"]
+
+# How to read each source (key: category). Only the columns listed in
+# "dtypes" are parsed, the rest of the file is skipped.
+SCHEMAS = {
+    "museos_datosabiertos": {
+        "encoding": "utf-8",
+        "dtypes": COMMON_DTYPES,
+    },
+    "cine": {
+        "encoding": "utf-8",
+        "dtypes": {
+            **COMMON_DTYPES,
+            "pantallas": "Int64",
+            "butacas": "Int64",
+            "espacio_incaa": str,
+        },
+    },
+    "biblioteca_popular": {
+        "encoding": "utf-8",
+        "dtypes": COMMON_DTYPES,
+    },
+}
+
+
+@logger.traced
+def transform(csvs_dic, chunksize=TRANSFORM_CHUNKSIZE, workers=TRANSFORM_WORKERS):
     """Main function to transform data
 
     Args:
         csvs_dic (dict): Dictionary with all csv files to be transformed (key: category, value: csv file path)
+        chunksize (int, optional): if set, the files are processed in chunks of this many rows (see transform_streaming). Defaults to TRANSFORM_CHUNKSIZE.
+        workers (int, optional): parallel workers (see TRANSFORM_WORKERS). The result doesn't depend on it. Defaults to TRANSFORM_WORKERS.
 
     Returns:
         dict: Dictionary with all csv files to be transformed (key: category, value: DataFrames to be upladed to the DB)
     """
 
-    dfs_dic = {}
-    for category, csv_file in csvs_dic.items():
-        df = pd.read_csv(csv_file)
-        df = df.rename(columns=lambda x: standarize_header(x))
-        dfs_dic[category] = df
+    if chunksize:
+        return transform_streaming(csvs_dic, chunksize)
+
+    # Task graph: every source is read and standarized on its own, and each
+    # output table is built as soon as the sources it needs are ready (e.g.
+    # totales_cine only waits for cine)
+    categories = list(csvs_dic.keys())
+    tasks = {
+        category: dag.Task(read_standarized, args=(category, csv_file), process=True)
+        for category, csv_file in csvs_dic.items()
+    }
+    tasks["registros_unificados"] = dag.Task(
+        lambda *dfs: deduplicate(set_t1_registros_unificados(list(dfs))),
+        deps=categories,
+    )
+    if dd.DEDUP == "drop":
+        # Only the first record of each venue is counted
+        tasks["registros_totales"] = dag.Task(
+            lambda df: set_t2_registros_totales([df]), deps=["registros_unificados"]
+        )
+    else:
+        tasks["registros_totales"] = dag.Task(
+            lambda *dfs: set_t2_registros_totales(list(dfs)), deps=categories
+        )
+    tasks["totales_cine"] = dag.Task(set_t3_totales_cine, deps=["cine"])
+    tasks["totales_geo"] = dag.Task(
+        lambda *dfs: set_t4_totales_geo(dict(zip(categories, dfs))), deps=categories
+    )
+
+    results = dag.run_dag(tasks, max_workers=workers)
 
-    dfs_dic = standarize_data(dfs_dic)
-    out_dfs_dic = {}
-    out_dfs_dic["registros_unificados"] = set_t1_registros_unificados(
-        list(dfs_dic.values())
+    profiling.record_frames(
+        "transform.standarized", {category: results[category] for category in categories}
     )
-    out_dfs_dic["registros_totales"] = set_t2_registros_totales(
-        list(dfs_dic.values()))
-    out_dfs_dic["totales_cine"] = set_t3_totales_cine(dfs_dic["cine"])
+
+    out_dfs_dic = {
+        tb: results[tb]
+        for tb in ["registros_unificados", "registros_totales", "totales_cine", "totales_geo"]
+    }
 
     now = dt.datetime.now()
 
     for cat in out_dfs_dic.keys():
         out_dfs_dic[cat]["dt_loaded"] = now
 
+    profiling.record_frames("transform.output", out_dfs_dic)
+
     return out_dfs_dic
 
 
+@logger.traced
+def transform_streaming(csvs_dic, chunksize, out_dir=TRANSFORM_OUT_DIR):
+    """Same as transform, but memory usage is bounded by chunksize instead of
+    the size of the files.
+
+    Each file is read chunksize rows at a time. Every chunk is standarized and
+    appended to registros_unificados, which is written to a csv file in
+    out_dir instead of being kept in memory. The aggregates of
+    registros_totales and totales_cine are accumulated chunk by chunk at
+    their finest grain (see aggregate_partial).
+
+    Args:
+        csvs_dic (dict): Dictionary with all csv files to be transformed (key: category, value: csv file path)
+        chunksize (int): rows per chunk
+        out_dir (str, optional): folder for registros_unificados' csv file. Defaults to TRANSFORM_OUT_DIR.
+
+    Returns:
+        dict: same keys as transform. registros_unificados' value is the path of its csv file (see read_output).
+    """
+
+    now = dt.datetime.now()
+
+    os.makedirs(out_dir, exist_ok=True)
+    out_fname = os.path.join(out_dir, "registros_unificados.csv")
+    tmp_fname = out_fname + ".tmp"
+
+    # Aggregates at the finest grain, rolled up at the end (see
+    # aggregate_grouping_sets), or maintained from the previous run's (see
+    # aggregates.MaintainedAggregate)
+    totales = None
+    cine = None
+    if ag.AGGREGATES_INCREMENTAL:
+        totales = get_maintained("registros_totales", TOTALES_GROUPING_SETS, TOTALES_AGGREGATES)
+        cine = get_maintained("totales_cine", CINE_GROUPING_SETS, CINE_AGGREGATES)
+    # Only the coordinates and the values added up, the spatial index needs
+    # all the venues at once (see set_t4_totales_geo)
+    points = []
+
+    # Matches every chunk against the records of the previous ones
+    dedup = dd.Deduplicator()
+
+    # The chunks are appended to the csv file by position: every one is
+    # written with the same columns, even if its source lacks some of them
+    out_cols = REGISTROS_COLS + (["cluster_id"] if dedup.mode != "off" else []) + ["dt_loaded"]
+
+    with open(tmp_fname, "w", encoding="utf-8", newline="") as f:
+        header = True
+
+        for category, csv_file in csvs_dic.items():
+            for chunk in read_source(category, csv_file, chunksize=chunksize):
+                chunk = standarize_data({category: chunk})[category]
+
+                t1_df = dedup.apply(set_t1_registros_unificados([chunk]))
+
+                # With DEDUP=drop, only the first record of each venue is
+                # counted
+                totales = aggregate_partial(
+                    t1_df if dedup.mode == "drop" else chunk,
+                    TOTALES_GROUPING_SETS,
+                    TOTALES_AGGREGATES,
+                    totales,
+                )
+
+                t1_df["dt_loaded"] = now
+                t1_df.reindex(columns=out_cols).to_csv(
+                    f, header=header, index=False, na_rep=NULL_REP
+                )
+                header = False
+
+                if category == "cine":
+                    cine = aggregate_partial(
+                        chunk, CINE_GROUPING_SETS, CINE_AGGREGATES, cine
+                    )
+
+                points.append(sp.get_points(category, chunk))
+
+    os.replace(tmp_fname, out_fname)
+    dedup.log_stats()
+
+    out_dfs_dic = {"registros_unificados": out_fname}
+
+    out_dfs_dic["registros_totales"] = rollup(
+        totales, TOTALES_GROUPING_SETS, TOTALES_AGGREGATES
+    ).reindex(columns=["categoria", "provincia", "fuente", "totals_cnt"])
+
+    out_dfs_dic["totales_cine"] = rollup(cine, CINE_GROUPING_SETS, CINE_AGGREGATES)
+
+    out_dfs_dic["totales_geo"] = sp.aggregate(pd.concat(points, ignore_index=True))
+
+    for cat in ["registros_totales", "totales_cine", "totales_geo"]:
+        out_dfs_dic[cat]["dt_loaded"] = now
+
+    return out_dfs_dic
+
+
+@logger.traced
+def read_standarized(category, csv_file):
+    """Reads a source (see read_source) and standarizes it (see
+    standarize_data). A module level function, so it can run in another
+    process.
+
+    Args:
+        category (str): source category. Example: cine
+        csv_file (str): csv file path
+
+    Returns:
+        pandas.DataFrame: standarized source data
+    """
+    start = time.perf_counter()
+    df = read_source(category, csv_file)
+    metrics.record(
+        "transform.read_source",
+        category,
+        time.perf_counter() - start,
+        rows_out=len(df),
+        bytes_read=os.path.getsize(csv_file),
+    )
+    return standarize_data({category: df})[category]
+
+
+def read_output(csv_file, chunksize=None):
+    """Reads back a table written by transform_streaming, with the same dtypes
+    it had in memory.
+
+    Args:
+        csv_file (str): csv file path
+        chunksize (int, optional): if set, returns an iterator of DataFrames of this many rows. Defaults to None.
+
+    Returns:
+        pandas.DataFrame or iterator of pandas.DataFrame: table data
+    """
+    header = pd.read_csv(csv_file, nrows=0).columns
+    return pd.read_csv(
+        csv_file,
+        dtype={col: OUTPUT_DTYPES[col] for col in header if col in OUTPUT_DTYPES},
+        parse_dates=["dt_loaded"] if "dt_loaded" in header else False,
+        # Only NULL_REP is a missing value, empty fields are empty strings
+        keep_default_na=False,
+        na_values=[NULL_REP],
+        chunksize=chunksize,
+    )
+
+
+def get_csv_engine():
+    """Returns the read_csv engine to use: CSV_ENGINE, unless it's pyarrow and
+    the package is not installed, in which case it falls back to "c"."""
+    if CSV_ENGINE == "pyarrow" and importlib.util.find_spec("pyarrow") is None:
+        log.warning("pyarrow is not installed, using the default CSV parser")
+        return "c"
+    return CSV_ENGINE
+
+
+@logger.traced
+def read_source(category, csv_file, chunksize=None):
+    """Reads a source's csv file into a DataFrame with standarized headers.
+
+    Only the columns declared in the category's schema (see SCHEMAS) are
+    parsed, each one with its dtype. Categories without a schema are fully
+    read and their dtypes inferred.
+
+    Args:
+        category (str): source category. Example: cine
+        csv_file (str): csv file path
+        chunksize (int, optional): if set, returns an iterator of DataFrames of this many rows. Defaults to None.
+
+    Returns:
+        pandas.DataFrame or iterator of pandas.DataFrame: source data
+    """
+
+    schema = SCHEMAS.get(category)
+
+    if schema is None:
+        if chunksize:
+            return (
+                df.rename(columns=lambda x: standarize_header(x))
+                for df in pd.read_csv(csv_file, chunksize=chunksize)
+            )
+        df = pd.read_csv(csv_file)
+        return df.rename(columns=lambda x: standarize_header(x))
+
+    # Read only the header row to map the raw column names (which may come
+    # with stray spaces, e.g. "IdProvincia ") to the standarized ones
+    header = pd.read_csv(csv_file, nrows=0, encoding=schema["encoding"]).columns
+    columns = {raw: standarize_header(raw) for raw in header}
+    columns = {raw: col for raw, col in columns.items() if col in schema["dtypes"]}
+
+    missing = set(schema["dtypes"]) - set(columns.values())
+    if missing:
+        log.warning(f"{category}: columns {sorted(missing)} not found in {csv_file}")
+
+    df = pd.read_csv(
+        csv_file,
+        usecols=list(columns.keys()),
+        dtype={raw: schema["dtypes"][col] for raw, col in columns.items()},
+        encoding=schema["encoding"],
+        # The pyarrow parser doesn't support reading in chunks
+        engine="c" if chunksize else get_csv_engine(),
+        chunksize=chunksize,
+    )
+
+    if chunksize:
+        return (chunk.rename(columns=columns) for chunk in df)
+
+    return df.rename(columns=columns)
+
+
+@logger.traced
+@metrics.measured
 def set_t1_registros_unificados(dfs_lst):
     """
     Normalizar toda la información de Museos, Salas de Cine y Bibliotecas
@@ -56,6 +414,10 @@ def set_t1_registros_unificados(dfs_lst):
     número de teléfono   --> telefono
     mail                 --> mail
     web                  --> web
+    fuente               --> fuente
+    latitud              --> latitud
+    longitud             --> longitud
+                         --> geohash (celda de latitud/longitud, ver spatial.encode_geohash)
 
     It takes a list of dataframes, drops all columns that are not in the list `wk_cols`, and then
     concatenates the dataframes into one
@@ -64,20 +426,7 @@ def set_t1_registros_unificados(dfs_lst):
     :return: A dataframe with the columns specified in the wk_cols list.
     """
 
-    wk_cols = [
-        "cod_loc",
-        "id_provincia",
-        "id_departamento",
-        "categoria",
-        "provincia",
-        "localidad",
-        "nombre",
-        "domicilio",
-        "cp",
-        "telefono",
-        "mail",
-        "web",
-    ]
+    wk_cols = REGISTROS_COLS
 
     # Drop non-relevant columns
     for idx, df in enumerate(dfs_lst):
@@ -88,6 +437,25 @@ def set_t1_registros_unificados(dfs_lst):
     return pd.concat(dfs_lst)
 
 
+@metrics.measured
+def deduplicate(df):
+    """Tags (or drops, see DEDUP) the records of registros_unificados that
+    are the same venue (see dedup.Deduplicator)
+
+    Args:
+        df (pandas.DataFrame): registros_unificados
+
+    Returns:
+        pandas.DataFrame: registros_unificados with a cluster_id column, unless DEDUP is off
+    """
+    dedup = dd.Deduplicator()
+    df = dedup.apply(df)
+    dedup.log_stats()
+    return df
+
+
+@logger.traced
+@metrics.measured
 def set_t2_registros_totales(dfs_lst):
     """
     ● Procesar los datos conjuntos para poder generar una tabla con la siguiente
@@ -101,10 +469,8 @@ def set_t2_registros_totales(dfs_lst):
     provincia            --> provincia
     fuente               --> fuente
 
-    It takes a list of dataframes, drops all columns except the ones you want to group by, concatenates
-    the dataframes, adds a column with a constant value, groups by the columns you want to group by,
-    adds a column with the count of rows, concatenates the dataframes with the grouped data, and
-    reorders the columns
+    It takes a list of dataframes, counts their rows by every grouping of TOTALES_GROUPING_SETS in a
+    single pass (see aggregate_grouping_sets), concatenates the groupings and reorders the columns
 
     :param dfs_lst: a list of dataframes to be processed
     :return: A dataframe with the following columns:
@@ -112,36 +478,14 @@ def set_t2_registros_totales(dfs_lst):
 
     wk_cols = ["categoria", "provincia", "fuente"]
 
-    # Drop non-relevant columns
-    for idx, df in enumerate(dfs_lst):
-        dfs_lst[idx] = df.drop(
-            columns=[col for col in df.columns if col not in wk_cols]
-        )
-
-    big_df = pd.concat(dfs_lst)
-
-    # Add auxiliary not null column to count rows
-    big_df["aux"] = 1
-
-    groupby_lst = [["categoria"], ["fuente"], ["provincia", "categoria"]]
-    grouped_dfs_lst = [None] * len(groupby_lst)
-
-    # Group records and add aggregated column
-    for idx, cat in enumerate(groupby_lst):
-        # as_index=False means you indicate to groupby() that you don't want to
-        # set the aggregated column as the index. It's equivalent to add at the
-        # end .reset_index()
-        grouped_dfs_lst[idx] = big_df.groupby(by=cat, as_index=False).agg(
-            totals_cnt=("aux", "count")
-        )
-
-    # Concat dataframes and reorder columns
-    out_df = pd.concat(grouped_dfs_lst).reindex(
-        columns=wk_cols + ["totals_cnt"])
-
-    return out_df
+    # Each source is aggregated on its own, without concatenating them
+    return aggregate_grouping_sets(
+        dfs_lst, TOTALES_GROUPING_SETS, TOTALES_AGGREGATES, name="registros_totales"
+    ).reindex(columns=wk_cols + ["totals_cnt"])
 
 
+@logger.traced
+@metrics.measured
 def set_t3_totales_cine(df_cine):
     """
 
@@ -152,8 +496,8 @@ def set_t3_totales_cine(df_cine):
     o Cantidad de butacas        --> butacas
     o Cantidad de espacios INCAA --> espacio_incaa
 
-    It takes a dataframe, drops all columns that are not in the list wk_cols, groups by provincia, and
-    then aggregates the sum of pantallas, sum of butacas, and count of espacio_incaa.
+    It takes a dataframe, groups by provincia (see aggregate_grouping_sets), and then aggregates the
+    sum of pantallas, sum of butacas, and count of espacio_incaa.
 
     :param df_cine: the dataframe that contains the information about the cinemas
     :return: A dataframe with the following columns:
@@ -163,21 +507,188 @@ def set_t3_totales_cine(df_cine):
         cnt_espacio_incaa
     """
 
-    wk_cols = ["provincia", "pantallas", "butacas", "espacio_incaa"]
-
-    # Drop non-relevant columns
-    df_cine.drop(
-        columns=[
-            col for col in df_cine.columns if col not in wk_cols])
-
-    df_cine = df_cine.groupby("provincia", as_index=False).agg(
-        sum_pantallas=("pantallas", "sum"),
-        sum_butacas=("butacas", "sum"),
-        cnt_espacio_incaa=("espacio_incaa", "count"),
+    return aggregate_grouping_sets(
+        [df_cine], CINE_GROUPING_SETS, CINE_AGGREGATES, name="totales_cine"
     )
-    return df_cine
 
 
+@logger.traced
+@metrics.measured
+def set_t4_totales_geo(dfs_dic):
+    """
+    Cantidad de espacios (cines, museos y bibliotecas), pantallas y butacas
+    por celda (geohash de SPATIAL_PRECISION caracteres) y por departamento,
+    y dentro de SPATIAL_RADIUS_KM del centro de cada uno.
+
+    It takes the standarized sources, keeps the venues with coordinates and adds them up with a
+    spatial index (see spatial.aggregate), instead of comparing every cell with every venue.
+
+    :param dfs_dic: standarized sources (key: category, value: dataframe)
+    :return: A dataframe with the following columns:
+        nivel (celda or departamento)
+        celda
+        id_departamento
+        latitud, longitud (center)
+        spatial.MEASURES, and the same within the radius (<measure>_radio)
+        radio_km
+    """
+
+    points = [sp.get_points(category, df) for category, df in dfs_dic.items()]
+    return sp.aggregate(pd.concat(points, ignore_index=True))
+
+
+def get_grain(grouping_sets):
+    """Returns the finest grain of some grouping sets: all their columns,
+    in order of appearance. Example: [["categoria"], ["provincia", "categoria"]]
+    --> ["categoria", "provincia"]"""
+    return list(dict.fromkeys(col for cols in grouping_sets for col in cols))
+
+
+def get_maintained(name, grouping_sets, aggregates):
+    """Returns the aggregates of a table maintained from the previous run's
+    (see aggregates.MaintainedAggregate), to be passed as the partial result
+    of aggregate_partial and rollup
+
+    Args:
+        name (str): table name. Example: totales_cine
+        grouping_sets (list of list of str): columns of each grouping
+        aggregates (dict): see aggregate_partial
+
+    Returns:
+        aggregates.MaintainedAggregate: maintained aggregates at the finest grain
+    """
+    return ag.MaintainedAggregate(name, get_grain(grouping_sets), aggregates)
+
+
+def aggregate_partial(df, grouping_sets, aggregates, partial=None):
+    """Aggregates df at the finest grain of grouping_sets (see get_grain),
+    the only pass over its rows. Every other grouping set is a roll up of
+    the result (see rollup), which has as many rows as distinct combinations
+    of the grain columns.
+
+    Args:
+        df (pandas.DataFrame): data to aggregate
+        grouping_sets (list of list of str): columns of each grouping
+        aggregates (dict): key: output column, value: (input column, function). function is "size" (rows, input column None), "sum" or "count" (not null values).
+        partial (pandas.DataFrame or aggregates.MaintainedAggregate, optional): result of a previous call (e.g. for the previous chunk) to add df to. Maintained aggregates (see get_maintained) only take the rows, they are aggregated by rollup. Defaults to None.
+
+    Returns:
+        pandas.DataFrame or aggregates.MaintainedAggregate: grain columns + output columns, or the maintained aggregates
+    """
+
+    if isinstance(partial, ag.MaintainedAggregate):
+        partial.add(df)
+        return partial
+
+    grain = get_grain(grouping_sets)
+    out_df = group_by(df, grain, aggregates)
+
+    if partial is not None:
+        # All the functions add up, so two partial results are merged by
+        # adding them up again
+        out_df = group_by(
+            pd.concat([partial, out_df], ignore_index=True),
+            grain,
+            {out: (out, "sum") for out in aggregates},
+        )
+
+    return out_df
+
+
+def group_by(df, cols, aggregates):
+    """Aggregates df by cols, keeping the groups with NaN (like groupby with
+    dropna=False).
+
+    Args:
+        df (pandas.DataFrame): data to aggregate
+        cols (list of str): columns to group by
+        aggregates (dict): see aggregate_partial
+
+    Returns:
+        pandas.DataFrame: cols + output columns, one row per group
+    """
+
+    # pandas < 2 leaves out the NaN groups of categorical columns even with
+    # dropna=False, so they are grouped by their codes (-1 for NaN) and
+    # turned back into categories afterwards. It also saves building every
+    # combination of categories (observed=False).
+    categorical = [col for col in cols if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    keys = [df[col].cat.codes.rename(col) if col in categorical else df[col] for col in cols]
+
+    grouped = df.groupby(keys, dropna=False, sort=False)
+    out_df = pd.DataFrame(
+        {
+            out: grouped.size() if func == "size" else grouped[col].agg(func)
+            for out, (col, func) in aggregates.items()
+        }
+    ).reset_index()
+
+    for col in categorical:
+        out_df[col] = pd.Categorical.from_codes(out_df[col], dtype=df[col].dtype)
+
+    return out_df
+
+
+def rollup(partial, grouping_sets, aggregates):
+    """Computes every grouping set from a partial result (see
+    aggregate_partial). Rows with NaN in a column of a grouping set are left
+    out of it, like pandas' groupby does.
+
+    Args:
+        partial (pandas.DataFrame, aggregates.MaintainedAggregate or None): finest grain aggregates (maintained ones are refreshed first), None if there was no data
+        grouping_sets (list of list of str): columns of each grouping
+        aggregates (dict): see aggregate_partial
+
+    Returns:
+        pandas.DataFrame: one block of rows per grouping set (sorted by its columns), with NaN in the columns it doesn't use
+    """
+
+    columns = get_grain(grouping_sets) + list(aggregates)
+
+    if isinstance(partial, ag.MaintainedAggregate):
+        partial = partial.refresh()
+
+    if partial is None:
+        return pd.DataFrame(columns=columns)
+
+    # observed=True returns the groups in order of appearance, hence the sort
+    return pd.concat(
+        [
+            partial.groupby(cols, as_index=False, observed=True)[list(aggregates)]
+            .sum()
+            .sort_values(cols, ignore_index=True)
+            for cols in grouping_sets
+        ],
+        ignore_index=True,
+    ).reindex(columns=columns)
+
+
+def aggregate_grouping_sets(dfs_lst, grouping_sets, aggregates, name=None):
+    """Aggregates data by several groupings at once, like SQL's GROUP BY
+    GROUPING SETS. Each DataFrame is aggregated once at the finest grain
+    (see aggregate_partial) and the grouping sets are rolled up from there
+    (see rollup), so adding grouping sets doesn't add passes over the rows.
+
+    Args:
+        dfs_lst (list of pandas.DataFrame): data to aggregate, as if they were concatenated
+        grouping_sets (list of list of str): columns of each grouping
+        aggregates (dict): see aggregate_partial
+        name (str, optional): table name. If set and AGGREGATES_INCREMENTAL is on, the aggregates are maintained from the previous run's (see get_maintained). Defaults to None.
+
+    Returns:
+        pandas.DataFrame: see rollup
+    """
+
+    partial = None
+    if name is not None and ag.AGGREGATES_INCREMENTAL:
+        partial = get_maintained(name, grouping_sets, aggregates)
+    for df in dfs_lst:
+        partial = aggregate_partial(df, grouping_sets, aggregates, partial)
+
+    return rollup(partial, grouping_sets, aggregates)
+
+
+@logger.traced
 def standarize_data(dfs_dic):
     """
     Perform some data cleanup and standarization
@@ -190,25 +701,35 @@ def standarize_data(dfs_dic):
     """
 
     for wk_cat, wk_df in dfs_dic.items():
+        start = time.perf_counter()
+
         # Fix data inconsistencies
-        # "Neuquén " --> "NEUQUEN"
+        # "Neuquén " --> "NEUQUEN"
         # "Santa Fé" --> "SANTA FE"
         # "Tierra del Fuego, Antártida e Islas del Atlántico Sur" --> "TIERRA DEL FUEGO"
-
-        # Apply clean_up to all cells in the column list
-        wk_df[["provincia", "fuente"]] = wk_df[[
-            "provincia", "fuente"]].applymap(clean_up)
+        for col in ["provincia", "fuente"]:
+            wk_df[col] = normalize(
+                wk_df[col], replacements=MANUAL_REPLACEMENTS.get(col))
+
+        # "-34,6037" --> -34.6037, invalid coordinates --> NaN, and their
+        # geohash cell
+        wk_df["latitud"], wk_df["longitud"] = sp.clean_coordinates(
+            wk_df["latitud"], wk_df["longitud"]
+        )
+        wk_df["geohash"] = sp.encode_geohash(wk_df["latitud"], wk_df["longitud"])
 
         if wk_cat == "cine":
-            wk_df["espacio_incaa"] = wk_df["espacio_incaa"].apply(
-                lambda x: "SI" if clean_up(str(x)) == "SI" else None
+            wk_df["espacio_incaa"] = normalize(
+                wk_df["espacio_incaa"],
+                func=lambda x: "SI" if clean_up_memo(str(x)) == "SI" else None,
             )
 
-        # Manual adjustments
-        wk_df["provincia"] = wk_df["provincia"].replace(
-            "TIERRA DEL FUEGO, ANTARTIDA E ISLAS DEL ATLANTICO SUR", "TIERRA DEL FUEGO")
-        wk_df["fuente"] = wk_df["fuente"].replace(
-            "GOB. PCIA.", "GOBIERNO DE LA PROVINCIA"
+        metrics.record(
+            "transform.standarize_data",
+            wk_cat,
+            time.perf_counter() - start,
+            rows_in=len(wk_df),
+            rows_out=len(wk_df),
         )
 
     return dfs_dic
@@ -275,22 +796,68 @@ def clean_up(x):
     return un.unidecode(str(x).upper().strip())
 
 
-if __name__ == "__main__":
+# clean_up remembering the last NORMALIZE_CACHE_SIZE distinct values, so the
+# same value is never cleaned up twice
+clean_up_memo = functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)(clean_up)
 
-    pass
 
-    ################# Test transform() #################
+@logger.traced
+def normalize(series, func=clean_up_memo, replacements=None):
+    """Applies func (and then replacements) to every value of a column.
+
+    The columns to clean up have a few dozen distinct values repeated over
+    thousands of rows, so instead of calling func once per row, the column is
+    factorized into integer codes + distinct values, func is called once per
+    distinct value, and the result is mapped back to the rows with a single
+    vectorized take. The cost grows with the number of distinct values, not
+    with the number of rows.
+
+    Categorical columns stay categorical (with the normalized values as
+    categories).
+
+    Args:
+        series (pandas.Series): column to normalize
+        func (function, optional): function to apply to each distinct value. Defaults to clean_up_memo.
+        replacements (dict, optional): value --> replacement, applied to func's results. Defaults to None.
+
+    Returns:
+        pandas.Series: normalized column (same index and name as series)
+    """
+
+    # codes: position of each row's value in uniques (-1 for NaN)
+    codes, uniques = pd.factorize(series)
+
+    values = [func(x) for x in uniques]
+    if replacements:
+        values = [replacements.get(x, x) for x in values]
+
+    # NaN goes through func like any other value. Putting it last makes the
+    # -1 codes pick it up in take.
+    values.append(func(np.nan))
+    values = np.array(values, dtype=object)
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Different values may end up being the same after the clean up, so
+        # they're factorized again to get unique categories. func(NaN) is
+        # dropped from them when no row is NaN.
+        new_codes, categories = pd.factorize(values, sort=True)
+        return pd.Series(
+            pd.Categorical.from_codes(
+                new_codes.take(codes), categories
+            ).remove_unused_categories(),
+            index=series.index,
+            name=series.name,
+        )
 
-    # prj =r"c:\Users\asd\Desktop\alkemy\Alkemy_Challenge_Data_Analytics_con_Python"
-    # prj = prj + r"\data"
-    # yyyy_mon = "2022-agosto"
-    # dd_mm_yyyy = "18-08-2022"
-    # cats = ['museos_datosabiertos', 'cine', 'biblioteca_popular']
-    # csvs_dic = {cat: f'{prj}\\{cat}\\{yyyy_mon}\\{cat}-{dd_mm_yyyy}.csv' for cat in cats}
-    # dfs_dic = transform(csvs_dic)
+    return pd.Series(values.take(codes), index=series.index, name=series.name)
+
+
+if __name__ == "__main__":
+
+    pass
 
-    # import load as l
-    # l.load(dfs_dic)
+    # transform() is exercised over synthetic sources by the benchmarks, see
+    # benchmarks/run.py
 
     ################# Test standarize_header() #################
     # in_headers = {
@@ -0,0 +1,101 @@
+"""
+Aggregates maintained from run to run (aggregates.MaintainedAggregate): only
+the rows inserted and deleted since the previous run are applied to the
+stored counts and sums.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import pkg.aggregates as ag
+import pkg.transform as t
+
+GRAIN = ["provincia"]
+
+
+def make_cine():
+    return pd.DataFrame(
+        {
+            "provincia": pd.Series(["CORDOBA", "CORDOBA", "SALTA", None, "SALTA"], dtype="category"),
+            "pantallas": pd.array([2, 3, None, 1, 4], dtype="Int64"),
+            "butacas": pd.array([200, 300, 100, 50, None], dtype="Int64"),
+            "espacio_incaa": ["SI", None, "SI", None, "SI"],
+        }
+    )
+
+
+def normalize(df):
+    return df.astype(object).where(df.notna(), None).sort_values(GRAIN, key=lambda s: s.astype(str)).reset_index(drop=True)
+
+
+def full(df):
+    partial = ag.weighted_partial(df, np.ones(len(df)), GRAIN, t.CINE_AGGREGATES)
+    return normalize(partial.drop(columns=ag.ROWS_COL))
+
+
+def versions():
+    v1 = make_cine()
+    # Update within a group, delete the last row of a group (None), insert
+    v2 = v1.copy()
+    v2.loc[0, "pantallas"] = 5
+    v2 = pd.concat(
+        [v2.drop(index=3), v2.iloc[[1]].assign(provincia="JUJUY")], ignore_index=True
+    )
+    # Duplicated rows count twice
+    v3 = pd.concat([v2, v2.iloc[[0]]], ignore_index=True)
+    return [v1, v2, v3, v1]
+
+
+def test_apply_deltas():
+    v1, v2 = make_cine(), make_cine()
+    v2.loc[0, "pantallas"] = 5
+    partial = ag.weighted_partial(v1, np.ones(len(v1)), GRAIN, t.CINE_AGGREGATES)
+
+    out_df = ag.apply_deltas(partial, v2.iloc[[0]], v1.iloc[[0]], GRAIN, t.CINE_AGGREGATES)
+
+    assert normalize(out_df.drop(columns=ag.ROWS_COL)).equals(full(v2))
+
+
+def test_maintained(tmp_path):
+    for df in versions():
+        aggregate = ag.MaintainedAggregate("totales_cine", GRAIN, t.CINE_AGGREGATES, str(tmp_path))
+        # Chunks
+        aggregate.add(df.iloc[:2])
+        aggregate.add(df.iloc[2:])
+        assert normalize(aggregate.refresh()).equals(full(df))
+
+    assert aggregate.stats == {"rows": 5, "inserted": 2, "deleted": 3, "groups": 3}
+
+
+def test_same_as_transform(tmp_path, monkeypatch):
+    df = make_cine()
+    expected = t.set_t3_totales_cine(df)
+
+    monkeypatch.setattr(ag, "AGGREGATES_INCREMENTAL", True)
+    monkeypatch.setattr(ag, "AGGREGATES_STATE_DIR", str(tmp_path))
+    t.set_t3_totales_cine(df.iloc[1:])
+    out_df = t.set_t3_totales_cine(df)
+
+    pd.testing.assert_frame_equal(out_df, expected, check_dtype=False, check_categorical=False)
+
+
+def test_check(tmp_path, monkeypatch):
+    monkeypatch.setattr(ag, "AGGREGATES_CHECK_EVERY", 1)
+    df = make_cine()
+    aggregate = ag.MaintainedAggregate("totales_cine", GRAIN, t.CINE_AGGREGATES, str(tmp_path))
+    aggregate.add(df)
+    aggregate.refresh()
+
+    # The stored aggregates go wrong
+    state = aggregate.read_state()
+    state["partial"]["sum_butacas"] += 1
+    aggregate.write_state(state)
+
+    aggregate = ag.MaintainedAggregate("totales_cine", GRAIN, t.CINE_AGGREGATES, str(tmp_path))
+    aggregate.add(df)
+    assert normalize(aggregate.refresh()).equals(full(df))
+
+
+def test_unsupported():
+    with pytest.raises(ValueError):
+        ag.weighted_partial(make_cine(), np.ones(5), GRAIN, {"max_butacas": ("butacas", "max")})
@@ -0,0 +1,98 @@
+"""
+Archive of the downloaded files (archive.compact): identical downloads stored
+once, snapshots as of a date and removal of the old raw files.
+"""
+import datetime as dt
+import os
+
+import pytest
+
+import pkg.archive as a
+import pkg.extract as e
+
+pytest.importorskip("pyarrow")
+
+CONTENT = {
+    "v1": "Cod_Loc,Nombre\n1,Cine A\n2,Cine B\n",
+    "v2": "Cod_Loc,Nombre\n1,Cine A\n2,Cine B\n3,\n",
+}
+
+
+def write_raw(raw_dir, date, content):
+    folder = raw_dir / "cine" / f"{date:%Y-%m}"
+    folder.mkdir(parents=True, exist_ok=True)
+    fname = folder / f"cine-{date:%d-%m-%Y}.csv"
+    fname.write_text(content)
+    return str(fname)
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(e, "MANIFEST_FILE", str(tmp_path / "download_manifest.json"))
+    return tmp_path / "data", str(tmp_path / "archive")
+
+
+def test_compact(dirs):
+    raw_dir, root = dirs
+    today = dt.date.today()
+    days = [today - dt.timedelta(days=n) for n in (20, 10, 1, 0)]
+    fnames = [
+        write_raw(raw_dir, date, CONTENT[version])
+        for date, version in zip(days, ["v1", "v1", "v2", "v1"])
+    ]
+    # The last download of the source is kept even if it's old
+    e.write_manifest({"https://cine": {"path": fnames[1]}})
+
+    counts = a.compact(["cine"], keep_days=7, raw_dir=str(raw_dir), root=root)
+
+    assert counts == {"archived": 2, "deduplicated": 2, "removed": 1}
+    assert not os.path.exists(fnames[0])
+    assert all(os.path.exists(fname) for fname in fnames[1:])
+
+    snapshots = a.read_index(os.path.join(root, "manifest.json"))["cine"]
+    assert [s["date"] for s in snapshots] == [d.isoformat() for d in days]
+    # Only the distinct contents are stored
+    assert len({s["path"] for s in snapshots}) == 2
+    assert snapshots[0]["path"] == snapshots[3]["path"]
+
+    # Nothing new to archive
+    assert a.compact(["cine"], keep_days=7, raw_dir=str(raw_dir), root=root) == {
+        "archived": 0,
+        "deduplicated": 0,
+        "removed": 0,
+    }
+
+
+def test_read_snapshot(dirs):
+    raw_dir, root = dirs
+    write_raw(raw_dir, dt.date(2022, 3, 1), CONTENT["v1"])
+    write_raw(raw_dir, dt.date(2022, 3, 10), CONTENT["v2"])
+    a.compact(["cine"], keep_days=-1, raw_dir=str(raw_dir), root=root)
+
+    assert len(a.read_snapshot("cine", "2022-03-05", root=root)) == 2
+    df = a.read_snapshot("cine", dt.date(2022, 3, 10), root=root)
+    assert len(df) == 3
+    # Kept as downloaded
+    assert df["Nombre"].tolist() == ["Cine A", "Cine B", ""]
+    assert len(a.read_snapshot("cine", root=root)) == 3
+
+    with pytest.raises(ValueError):
+        a.read_snapshot("cine", "2022-02-28", root=root)
+
+
+def test_same_day_download_replaced(dirs):
+    raw_dir, root = dirs
+    date = dt.date(2022, 3, 1)
+    write_raw(raw_dir, date, CONTENT["v1"])
+    a.compact(["cine"], keep_days=-1, raw_dir=str(raw_dir), root=root)
+
+    # Downloaded again the same day, with a new content
+    write_raw(raw_dir, date, CONTENT["v2"])
+    a.compact(["cine"], keep_days=-1, raw_dir=str(raw_dir), root=root)
+
+    snapshots = a.read_index(os.path.join(root, "manifest.json"))["cine"]
+    assert len(snapshots) == 1
+    assert snapshots[0]["rows"] == 3
+    # The replaced snapshot is removed
+    parquets = [f for _, _, fs in os.walk(root) for f in fs if f.endswith(".parquet")]
+    assert len(parquets) == 1
@@ -0,0 +1,98 @@
+"""
+Transform cache (pkg/cache.py): entries keyed by the input files and the
+transform settings, dt_loaded on a hit and eviction of the least recently
+used entries.
+"""
+import datetime as dt
+import os
+
+import pandas as pd
+import pytest
+
+import pkg.cache as cache
+import pkg.dedup as dd
+import pkg.transform as t
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "TRANSFORM_CACHE", True)
+    monkeypatch.setattr(cache, "TRANSFORM_CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def make_sources(path, rows=3):
+    path.mkdir(exist_ok=True)
+    fname = path / "cine.csv"
+    pd.DataFrame({"Cod_Loc": range(rows), "Nombre": ["Cine"] * rows}).to_csv(fname, index=False)
+    return {"cine": str(fname)}
+
+
+def make_output(path, when):
+    """A transform output with a table in memory and another one as a csv
+    file, as transform_streaming returns"""
+    fname = str(path / "registros_unificados.csv")
+    pd.DataFrame(
+        {"nombre": ["Cine", "", None], "cp": ["0100", "X", None], "dt_loaded": [when] * 3}
+    ).to_csv(fname, index=False)
+    totales = pd.DataFrame({"categoria": ["Salas de cine"], "totals_cnt": [3], "dt_loaded": [when]})
+    return {"registros_unificados": fname, "registros_totales": totales}
+
+
+def test_get_put(tmp_path, cache_dir):
+    csvs_dic = make_sources(tmp_path / "src")
+    cached = dt.datetime(2022, 1, 1)
+    assert cache.get(csvs_dic) is None
+
+    cache.put(csvs_dic, make_output(tmp_path, cached))
+    dfs_dic = cache.get(csvs_dic)
+
+    # Both kinds of tables get the dt_loaded of the run loading them
+    assert (dfs_dic["registros_totales"]["dt_loaded"] > cached).all()
+    out_df = t.read_output(dfs_dic["registros_unificados"])
+    assert (out_df["dt_loaded"] > cached).all()
+    assert out_df["dt_loaded"].iloc[0] == dfs_dic["registros_totales"]["dt_loaded"].iloc[0]
+    # The rest of the values are kept as they were written
+    with open(dfs_dic["registros_unificados"]) as f:
+        rows = [line.rsplit(",", 1)[0] for line in f.read().splitlines()]
+    assert rows == ["nombre,cp", "Cine,0100", ",X", ","]
+
+
+def test_key(tmp_path, cache_dir, monkeypatch):
+    csvs_dic = make_sources(tmp_path / "src")
+    cache.put(csvs_dic, make_output(tmp_path, dt.datetime(2022, 1, 1)))
+    key = cache.get_key(csvs_dic)
+
+    assert cache.get_key(csvs_dic) == key
+    assert cache.get_key(csvs_dic, chunksize=1000) != key
+
+    dedup = dd.DEDUP
+    monkeypatch.setattr(dd, "DEDUP", "drop" if dedup != "drop" else "tag")
+    assert cache.get(csvs_dic) is None
+    monkeypatch.setattr(dd, "DEDUP", dedup)
+    assert cache.get(csvs_dic) is not None
+
+    # Other input files
+    assert cache.get(make_sources(tmp_path / "other", rows=4)) is None
+
+    monkeypatch.setattr(cache, "CODE_FILES", cache.CODE_FILES + [__file__])
+    assert cache.get_key(csvs_dic) != key
+
+
+def test_evict(tmp_path, cache_dir):
+    keys = []
+    for rows in range(1, 4):
+        csvs_dic = make_sources(tmp_path / f"src{rows}", rows)
+        cache.put(csvs_dic, make_output(tmp_path, dt.datetime(2022, 1, 1)))
+        key = cache.get_key(csvs_dic)
+        # Distinct modification times, older first
+        os.utime(cache_dir / key / "meta.json", (rows, rows))
+        keys.append(key)
+
+    # The first one is used again
+    cache.get(make_sources(tmp_path / "src1", 1))
+    size = cache.get_size(cache_dir / keys[0])
+
+    cache.evict(keep=keys[1], max_mb=(2 * size + 1) / 2**20)
+
+    assert sorted(os.listdir(cache_dir)) == sorted([keys[0], keys[1]])
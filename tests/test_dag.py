@@ -0,0 +1,50 @@
+"""
+Task graph executor (dag.run_dag): same results in sequential and parallel
+mode, dependencies, errors.
+"""
+import operator
+
+import pytest
+
+import pkg.dag as dag
+
+
+def get_tasks():
+    return {
+        "a": dag.Task(operator.mul, args=(2, 3), process=True),
+        "b": dag.Task(operator.add, args=(1, 1), process=True),
+        # a + b
+        "sum": dag.Task(operator.add, deps=["a", "b"]),
+        # (a + b) - a
+        "diff": dag.Task(operator.sub, deps=["sum", "a"]),
+    }
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_results(max_workers):
+    results = dag.run_dag(get_tasks(), max_workers=max_workers)
+
+    assert results == {"a": 6, "b": 2, "sum": 8, "diff": 2}
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError, match="unknown"):
+        dag.run_dag({"a": dag.Task(len, deps=["missing"])})
+
+
+def test_cycle():
+    tasks = {"a": dag.Task(len, deps=["b"]), "b": dag.Task(len, deps=["a"])}
+
+    with pytest.raises(ValueError, match="Cycle"):
+        dag.run_dag(tasks)
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_error(max_workers):
+    tasks = {
+        "a": dag.Task(operator.truediv, args=(1, 0), process=True),
+        "b": dag.Task(abs, deps=["a"]),
+    }
+
+    with pytest.raises(ZeroDivisionError):
+        dag.run_dag(tasks, max_workers=max_workers)
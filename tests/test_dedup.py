@@ -0,0 +1,86 @@
+"""
+Duplicate venues of registros_unificados (dedup.Deduplicator): normalized
+fields, blocking by (id_provincia, cod_loc) and matching chunk by chunk.
+"""
+import pandas as pd
+import pytest
+
+import pkg.dedup as dd
+
+
+def make_df():
+    return pd.DataFrame(
+        {
+            "id_provincia": pd.array([14, 14, 14, 14, 14, 14, 6], dtype="Int64"),
+            "cod_loc": pd.array([1, 1, 1, 2, None, 1, 1], dtype="Int64"),
+            "categoria": ["Museos", "Museos", "Museos", "Museos", "Museos", "Bibliotecas Populares", "Museos"],
+            "nombre": [
+                "Museo Histórico Municipal",
+                " MUNICIPAL museo historico",
+                "Casa de la Cultura",
+                "Museo Histórico Municipal",
+                "Museo Histórico Municipal",
+                "Biblioteca Popular Sarmiento",
+                "Museo Histórico Municipal",
+            ],
+            "domicilio": ["Av. Gral. Paz 12", None, "Avenida General Paz N° 12", None, None, "Avenida General Paz 12", None],
+            "telefono": ["(0351) 422-1234", None, "4221234", None, None, "4221234", None],
+        },
+        # As set_t1_registros_unificados leaves it: the index of each source
+        index=[0, 1, 2, 0, 1, 2, 3],
+    )
+
+
+def test_normalization():
+    assert dd.nombre_key("Biblioteca Popular del Pueblo") == dd.nombre_key("Pueblo, biblioteca")
+    assert dd.domicilio_key("Calle San Martín N° 120") == dd.domicilio_key("SAN MARTIN 120")
+    assert dd.domicilio_key("Av. Gral. Paz s/n") == "AVENIDA GENERAL PAZ"
+    assert dd.telefono_key("+54 (0351) 422-1234") == dd.telefono_key("422 1234")
+    assert dd.telefono_key("1234") is None
+
+
+def test_clusters():
+    dedup = dd.Deduplicator("tag")
+    out_df = dedup.apply(make_df())
+    ids = out_df["cluster_id"].tolist()
+
+    # Same nombre, and same telefono and domicilio as the first one
+    assert ids[0] == ids[1] == ids[2]
+    # Another block, no block, another categoria, another provincia
+    assert len(set(ids[2:])) == 5
+    assert dedup.get_stats() == {
+        "rows": 7,
+        "blocks": 3,
+        "candidate_pairs": 6,
+        "all_pairs": 21,
+        "clusters": 5,
+        "duplicates": 2,
+        "largest_cluster": 3,
+    }
+
+
+def test_ids_do_not_depend_on_other_rows():
+    ids = dd.Deduplicator("tag").apply(make_df())["cluster_id"]
+    ids_reversed = dd.Deduplicator("tag").apply(make_df().iloc[::-1])["cluster_id"]
+
+    assert ids.iloc[3:].tolist() == ids_reversed.iloc[::-1].iloc[3:].tolist()
+
+
+@pytest.mark.parametrize("mode", ["tag", "drop"])
+def test_chunks(mode):
+    df = make_df()
+    whole_df = dd.Deduplicator(mode).apply(df)
+
+    dedup = dd.Deduplicator(mode)
+    chunked_df = pd.concat([dedup.apply(df.iloc[start : start + 2]) for start in range(0, len(df), 2)])
+
+    pd.testing.assert_frame_equal(chunked_df, whole_df)
+    assert len(whole_df) == (7 if mode == "tag" else 5)
+
+
+def test_off():
+    df = make_df()
+    assert dd.Deduplicator("off").apply(df) is df
+
+    with pytest.raises(ValueError):
+        dd.Deduplicator("merge")
@@ -0,0 +1,138 @@
+"""
+Downloads (extract.download_file) against a local stand-in of the sources'
+server (http.server) that can fail on purpose: error statuses, connections
+cut in the middle of the body and broken range responses.
+"""
+import base64
+import hashlib
+import http.server
+import threading
+
+import pytest
+import requests
+
+import pkg.extract as e
+
+CONTENT = b"cod_loc,nombre\n" + b"".join(f"{i},Lugar {i}\n".encode() for i in range(20000))
+ETAG = '"%s"' % hashlib.md5(CONTENT).hexdigest()
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves CONTENT with an ETag, a Digest and support for Range / If-Range /
+    If-None-Match. The failures to inject are taken from the server's queue
+    (one per request): a status code to answer with, "cut" to close the
+    connection after a third of the body, or "no_content_range" to answer a
+    range request with a 206 without Content-Range.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        failure = self.server.failures.pop(0) if self.server.failures else None
+
+        if isinstance(failure, int):
+            self.send_response(failure)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") == ETAG:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            if failure != "no_content_range":
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}"
+                )
+        else:
+            self.send_response(200)
+
+        body = CONTENT[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", ETAG)
+        self.send_header(
+            "Digest", "SHA-256=" + base64.b64encode(hashlib.sha256(CONTENT).digest()).decode()
+        )
+        self.end_headers()
+
+        if failure == "cut":
+            self.wfile.write(body[: len(body) // 3])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    srv.failures = []
+    srv.requests = []
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    srv.url = f"http://127.0.0.1:{srv.server_address[1]}/source.csv"
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(e, "EXTRACT_BACKOFF", 0)
+
+
+def test_retries_and_resumes(server, tmp_path):
+    server.failures = [503, "cut"]
+    fname = str(tmp_path / "source.csv")
+
+    entry = e.download_file(e.get_session(1), server.url, fname)
+
+    assert entry["status"] == "downloaded"
+    assert open(fname, "rb").read() == CONTENT
+    assert entry["sha256"] == hashlib.sha256(CONTENT).hexdigest()
+    # 503, cut download, then only the missing bytes
+    assert len(server.requests) == 3
+    assert server.requests[2]["Range"].startswith("bytes=")
+    assert server.requests[2]["Range"] != "bytes=0-"
+    assert server.requests[2]["If-Range"] == ETAG
+
+
+def test_not_modified(server, tmp_path):
+    fname = str(tmp_path / "source.csv")
+    session = e.get_session(1)
+    entry = e.download_file(session, server.url, fname)
+
+    again = e.download_file(session, server.url, fname, cached=entry)
+
+    assert again["status"] == "not_modified"
+    assert server.requests[1]["If-None-Match"] == ETAG
+    assert open(fname, "rb").read() == CONTENT
+
+
+def test_missing_content_range(server, tmp_path):
+    # The broken 206 discards the partial file, the retry downloads it all
+    server.failures = ["cut", "no_content_range"]
+    fname = str(tmp_path / "source.csv")
+
+    entry = e.download_file(e.get_session(1), server.url, fname)
+
+    assert entry["status"] == "downloaded"
+    assert open(fname, "rb").read() == CONTENT
+    assert "Range" not in server.requests[2]
+
+
+def test_not_retryable(server, tmp_path):
+    server.failures = [404]
+
+    with pytest.raises(requests.HTTPError):
+        e.download_file(e.get_session(1), server.url, str(tmp_path / "source.csv"))
+    assert len(server.requests) == 1
@@ -0,0 +1,141 @@
+"""
+COPY helpers of load (copy_df, copy_csv) against a real PostgreSQL, the one
+set in .env (POSTGRES_*). Skipped when it's not set or not reachable. The
+data they send is also checked without a server.
+"""
+import datetime as dt
+import io
+
+import decouple as d
+import pandas as pd
+import pytest
+import sqlalchemy as s
+
+import pkg.load as l
+import pkg.transform as t
+
+TABLE = "alk_test_copy"
+
+DF = pd.DataFrame(
+    {
+        "cod_loc": pd.array([1, None, 3], dtype="Int64"),
+        "nombre": ['Comma, "quoted"', "", None],
+        "domicilio": ["Multi\nline", "Tab\there", "Back\\slash \\N"],
+        "dt_loaded": [dt.datetime(2022, 8, 30, 12, 0, 0)] * 3,
+    }
+)
+
+
+@pytest.fixture
+def engine():
+    try:
+        engine = l.get_engine()
+        with engine.connect():
+            pass
+    except (d.UndefinedValueError, s.exc.OperationalError) as exc:
+        pytest.skip(f"No PostgreSQL available: {exc}")
+
+    with engine.begin() as conn:
+        conn.execute(s.text(f"DROP TABLE IF EXISTS {l.get_table_name(TABLE)}"))
+        conn.execute(
+            s.text(
+                f"CREATE TABLE {l.get_table_name(TABLE)} "
+                "(cod_loc integer, nombre text, domicilio text, dt_loaded timestamp)"
+            )
+        )
+    yield engine
+
+    with engine.begin() as conn:
+        conn.execute(s.text(f"DROP TABLE IF EXISTS {l.get_table_name(TABLE)}"))
+    engine.dispose()
+
+
+class FakeCursor:
+    """Keeps what COPY would send to the server"""
+
+    def __init__(self):
+        self.copies = []
+        self.rowcount = -1
+
+    def copy_expert(self, sql, f, size=8192):
+        self.copies.append((sql, f.read()))
+
+
+def read_back(engine):
+    return pd.read_sql(
+        f"SELECT * FROM {l.get_table_name(TABLE)} ORDER BY dt_loaded, domicilio", engine
+    )
+
+
+def test_copy_df(engine):
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            # Batches smaller than the DataFrame
+            rows, size = l.copy_df(cursor, TABLE, DF, batch_size=2)
+        conn.commit()
+    finally:
+        conn.close()
+
+    df = read_back(engine).set_index("domicilio")
+    expected = DF.set_index("domicilio")
+
+    assert rows == len(DF)
+    assert size > 0
+    # NULL and empty strings are kept apart
+    assert df.loc["Multi\nline", "nombre"] == 'Comma, "quoted"'
+    assert df.loc["Tab\there", "nombre"] == ""
+    assert df.loc["Back\\slash \\N", "nombre"] is None
+    assert df.loc[expected.index, "cod_loc"].isna().tolist() == [False, True, False]
+    assert (df["dt_loaded"] == DF["dt_loaded"][0]).all()
+
+
+def test_copy_csv(engine, tmp_path):
+    # As written by transform's streaming mode
+    csv_file = str(tmp_path / "table.csv")
+    DF.to_csv(csv_file, index=False, na_rep=t.NULL_REP)
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            rows, size = l.copy_csv(cursor, TABLE, csv_file)
+        conn.commit()
+    finally:
+        conn.close()
+
+    df = read_back(engine).set_index("domicilio")
+
+    assert rows == len(DF)
+    assert size > 0
+    assert df.loc["Multi\nline", "nombre"] == 'Comma, "quoted"'
+    # The same as copy_df
+    assert df.loc["Tab\there", "nombre"] == ""
+    assert df.loc["Back\\slash \\N", "nombre"] is None
+    assert df.loc[DF["domicilio"], "cod_loc"].isna().tolist() == [False, True, False]
+
+
+def test_copy_buffers(tmp_path):
+    cursor = FakeCursor()
+    rows, size = l.copy_df(cursor, TABLE, DF, batch_size=2)
+
+    assert rows == len(DF)
+    assert [len(pd.read_csv(io.StringIO(data), header=None)) for _, data in cursor.copies] == [2, 1]
+    sent = "".join(data for _, data in cursor.copies)
+    assert size == len(sent)
+    # NULL is \N, empty strings are empty fields, the rest is quoted as csv
+    assert sent == (
+        '1,"Comma, ""quoted""","Multi\nline",2022-08-30 12:00:00\n'
+        "\\N,,Tab\there,2022-08-30 12:00:00\n"
+        "3,\\N,Back\\slash \\N,2022-08-30 12:00:00\n"
+    )
+
+    # A csv file of streaming mode is sent as it is, with the same NULL
+    csv_file = str(tmp_path / "table.csv")
+    DF.to_csv(csv_file, index=False, na_rep=t.NULL_REP)
+    csv_cursor = FakeCursor()
+    l.copy_csv(csv_cursor, TABLE, csv_file)
+
+    (df_sql, _), (csv_sql, csv_sent) = cursor.copies[0], csv_cursor.copies[0]
+    assert df_sql.endswith("WITH (FORMAT csv, NULL '\\N')")
+    assert csv_sql == df_sql
+    assert csv_sent == sent
@@ -0,0 +1,112 @@
+"""
+Run metrics (pkg/metrics.py): counters, gauges and histograms with labels,
+exported as an OpenMetrics textfile and a JSON summary per run.
+"""
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import pkg.metrics as metrics
+
+
+@pytest.fixture
+def folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS", True)
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "registry", {})
+    monkeypatch.setattr(metrics, "run", None)
+    monkeypatch.setattr(metrics, "loaded", False)
+    return tmp_path
+
+
+def test_openmetrics(folder):
+    metrics.inc("retries", stage="extract.download", category='say "hi"')
+    metrics.inc("retries", 2, stage="extract.download", category='say "hi"')
+    metrics.observe("stage_duration_seconds", 0.2, stage="load", category="all")
+    metrics.observe("stage_duration_seconds", 7, stage="load", category="all")
+
+    text = metrics.get_openmetrics()
+    lines = text.splitlines()
+
+    assert "# TYPE alkemy_retries counter" in lines
+    assert 'alkemy_retries_total{category="say \\"hi\\"",stage="extract.download"} 3' in lines
+    assert "# TYPE alkemy_stage_duration_seconds histogram" in lines
+    # Buckets are cumulative
+    assert 'alkemy_stage_duration_seconds_bucket{category="all",stage="load",le="0.1"} 0' in lines
+    assert 'alkemy_stage_duration_seconds_bucket{category="all",stage="load",le="0.5"} 1' in lines
+    assert 'alkemy_stage_duration_seconds_bucket{category="all",stage="load",le="+Inf"} 2' in lines
+    assert 'alkemy_stage_duration_seconds_count{category="all",stage="load"} 2' in lines
+    assert 'alkemy_stage_duration_seconds_sum{category="all",stage="load"} 7.2' in lines
+    assert text.endswith("# EOF\n")
+
+
+def test_measured(folder):
+    @metrics.measured
+    def builder(dfs_lst):
+        return pd.concat(dfs_lst).iloc[:3]
+
+    metrics.start_run()
+    builder([pd.DataFrame({"a": range(4)}), pd.DataFrame({"a": range(6)})])
+    builder([pd.DataFrame({"a": range(5)})])
+
+    labels = metrics.get_key({"stage": "test_metrics.builder", "category": "all"})
+    assert metrics.registry["stage_rows_in"][labels] == 15
+    assert metrics.registry["stage_rows_out"][labels] == 6
+    assert metrics.registry["stage_duration_seconds"][labels]["count"] == 2
+
+    summary = metrics.run["stages"]["test_metrics.builder|all"]
+    assert (summary["calls"], summary["rows_in"], summary["rows_out"]) == (2, 15, 6)
+
+
+def test_runs(folder):
+    metrics.start_run()
+    metrics.record("pipeline.load", seconds=2.0, rows_out=100, bytes_written=1000)
+    fname = metrics.end_run("ok")
+
+    with open(fname) as f:
+        summary = json.load(f)
+    assert summary["result"] == "ok"
+    assert summary["stages"][0]["rows_out"] == 100
+    text = (folder / "alkemy.prom").read_text()
+    assert 'alkemy_runs_total{result="ok"} 1' in text
+    assert 'alkemy_stage_rows_per_second{category="all",stage="pipeline.load"} 50.0' in text
+
+    # Another process: the counters go on, the gauges start over
+    metrics.registry, metrics.loaded = {}, False
+    metrics.start_run()
+    metrics.end_run("failed")
+
+    text = (folder / "alkemy.prom").read_text()
+    assert 'alkemy_runs_total{result="ok"} 1' in text
+    assert 'alkemy_runs_total{result="failed"} 1' in text
+    assert "alkemy_stage_rows_per_second" not in text
+    assert len(os.listdir(folder / "runs")) == 2
+
+
+def test_off(folder, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS", False)
+    metrics.start_run()
+    metrics.record("pipeline.load", seconds=1.0)
+    assert metrics.end_run("ok") is None
+    assert metrics.registry == {}
+    assert not os.listdir(folder)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_worker_processes(folder, workers):
+    import benchmarks.generate as g
+    import pkg.transform as t
+
+    csvs_dic = g.generate(str(folder / "sources"), 1)
+
+    metrics.start_run()
+    t.transform(csvs_dic, chunksize=0, workers=workers)
+    summary = metrics.run["stages"]
+
+    for category in csvs_dic:
+        for stage in ["transform.read_source", "transform.standarize_data"]:
+            assert summary[f"{stage}|{category}"]["calls"] == 1
+    assert summary["transform.read_source|cine"]["read_bytes"] == os.path.getsize(csvs_dic["cine"])
+    assert "transform.set_t1_registros_unificados|all" in summary
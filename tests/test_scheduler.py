@@ -0,0 +1,103 @@
+"""
+Daemon mode (scheduler.run_forever): runs on an interval, never two at a
+time, and the status file.
+"""
+import os
+import threading
+import time
+import types
+
+import pkg.scheduler as sch
+
+
+class FakeClock:
+    """time.monotonic and stop.wait of run_forever: waiting moves the clock
+    forward instead of sleeping, so the test doesn't depend on timing"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.waits = []
+
+    def monotonic(self):
+        return self.now
+
+    def Event(self):
+        clock = self
+
+        class Event(threading.Event):
+            def wait(self, timeout=None):
+                clock.waits.append(timeout)
+                clock.now += timeout
+                return self.is_set()
+
+        return Event()
+
+
+def test_run_forever(tmp_path, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(
+        sch, "time", types.SimpleNamespace(monotonic=clock.monotonic, perf_counter=time.perf_counter)
+    )
+    monkeypatch.setattr(sch, "threading", types.SimpleNamespace(Event=clock.Event))
+    status_file = str(tmp_path / "status.json")
+    calls = []
+
+    def job():
+        calls.append(clock.now)
+        if len(calls) == 2:
+            # Longer than two intervals
+            clock.now += 25
+            raise RuntimeError("boom")
+        clock.now += 2
+        return {"seconds": {"extract": 0.1}}
+
+    sch.run_forever(
+        job,
+        interval=10,
+        max_runs=3,
+        status_file=status_file,
+        lock_file=str(tmp_path / "app.lock"),
+    )
+
+    status = sch.read_status(status_file)
+
+    # A failed run doesn't stop the daemon
+    assert status["runs"] == {"ok": 2, "error": 1}
+    assert status["state"] == "stopped"
+    assert status["last_run"]["outcome"] == "ok"
+    assert status["last_run"]["elapsed"] >= 0
+    assert status["last_run"]["seconds"] == {"extract": 0.1}
+    # Fixed rate: the starts missed during the long run are skipped
+    assert calls == [0, 10, 40]
+    assert clock.waits == [8, 5]
+
+
+def test_no_overlap(tmp_path):
+    lock_file = str(tmp_path / "app.lock")
+    status = {"runs": {}}
+
+    with sch.run_lock(lock_file) as locked:
+        assert locked
+        # Another run (e.g. started by cron) holds the lock
+        outcome = sch.run_once(
+            lambda: None, status, str(tmp_path / "status.json"), lock_file
+        )
+
+    assert outcome == "skipped"
+    assert status["runs"] == {"skipped": 1}
+
+    # Released at the end of the block
+    with sch.run_lock(lock_file) as locked:
+        assert locked
+
+
+def test_get_running_pid(tmp_path):
+    lock_file = str(tmp_path / "app.lock")
+
+    assert sch.get_running_pid(lock_file) is None
+    # Only looking doesn't leave a lock file behind
+    assert not (tmp_path / "app.lock").exists()
+
+    with sch.run_lock(lock_file):
+        assert sch.get_running_pid(lock_file) == os.getpid()
+    assert sch.get_running_pid(lock_file) is None
@@ -0,0 +1,87 @@
+"""
+Storage backends of load (pkg/sinks.py): the tables of transform, in memory
+and written to csv files by the streaming mode, are stored and read back
+unchanged.
+"""
+import functools
+import importlib.util
+
+import pandas as pd
+import pytest
+import sqlalchemy as s
+
+import benchmarks.generate as g
+import pkg.load as l
+import pkg.sinks as sk
+import pkg.transform as t
+
+
+@pytest.fixture(scope="module")
+def dfs_dic(tmp_path_factory):
+    path = tmp_path_factory.mktemp("sinks")
+    return t.transform_streaming(g.generate(str(path / "sources"), 1), 1000, out_dir=str(path))
+
+
+def normalize(df, expected):
+    """Same columns, row order and value types as expected, whatever the
+    backend returns (e.g. partition columns last and categorical, or nullable
+    integers as floats)"""
+    df = df.reindex(columns=expected.columns)
+    for col in expected.columns:
+        if pd.api.types.is_numeric_dtype(expected[col]):
+            df[col] = pd.to_numeric(df[col]).astype("float64")
+        elif pd.api.types.is_datetime64_any_dtype(expected[col]):
+            df[col] = pd.to_datetime(df[col])
+        else:
+            df[col] = df[col].astype(object).where(df[col].notna(), None)
+    return df.sort_values(list(df.columns), key=lambda c: c.astype(str)).reset_index(drop=True)
+
+
+def read_sqlite(path, tb):
+    engine = s.create_engine(f"sqlite:///{path}")
+    try:
+        return pd.read_sql_table(tb, engine)
+    finally:
+        engine.dispose()
+
+
+def read_duckdb(path, tb):
+    import duckdb
+
+    with duckdb.connect(str(path)) as conn:
+        return conn.execute(f'SELECT * FROM "{tb}"').df()
+
+
+SINKS = {
+    "sqlite": (sk.SQLiteSink, "alkemy.sqlite", read_sqlite, None),
+    "duckdb": (sk.DuckDBSink, "alkemy.duckdb", read_duckdb, "duckdb"),
+    "parquet": (sk.ParquetSink, "parquet", lambda path, tb: pd.read_parquet(path / tb), "pyarrow"),
+}
+
+
+@pytest.mark.parametrize("sink", list(SINKS))
+def test_round_trip(sink, dfs_dic, tmp_path, monkeypatch):
+    cls, fname, read, package = SINKS[sink]
+    if package and importlib.util.find_spec(package) is None:
+        pytest.skip(f"{package} is not installed")
+
+    path = tmp_path / fname
+    monkeypatch.setitem(l.SINKS, sink, functools.partial(cls, path=str(path)))
+    monkeypatch.setattr(l, "sinks_cache", {})
+    # Several chunks of the csv file (see sinks.iter_chunks)
+    monkeypatch.setattr(l, "LOAD_CHUNKSIZE", 1500)
+
+    # Twice: the second load replaces the tables of the first one
+    l.load(dfs_dic, sink=sink)
+    stats = l.load(dfs_dic, sink=sink)
+
+    assert isinstance(dfs_dic["registros_unificados"], str)
+    for cat, df in dfs_dic.items():
+        expected = t.read_output(df) if isinstance(df, str) else df
+        out_df = read(path, f"alk_{cat}")
+
+        assert stats[f"alk_{cat}"]["rows"] == len(expected) == len(out_df)
+        pd.testing.assert_frame_equal(
+            normalize(out_df, expected),
+            normalize(expected, expected),
+        )
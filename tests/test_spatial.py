@@ -0,0 +1,101 @@
+"""
+Spatial index of the venues (spatial.SpatialIndex): geohash cells, nearest
+and radius queries, and the proximity aggregates of totales_geo.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import pkg.spatial as sp
+
+
+def make_points(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-55, -22, n), rng.uniform(-73, -53, n)
+
+
+def haversine(lat, lon, lat0, lon0):
+    lat, lon, lat0, lon0 = map(np.radians, (lat, lon, lat0, lon0))
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat) * np.cos(lat0) * np.sin((lon - lon0) / 2) ** 2
+    return 2 * sp.EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def test_geohash():
+    lat = pd.Series([-34.6037, 57.64911, None])
+    lon = pd.Series([-58.3816, 10.40744, -58.0])
+
+    assert sp.encode_geohash(lat, lon, 5).tolist() == ["69y7p", "u4pru", None]
+    assert sp.encode_geohash(lat[1:2], lon[1:2], 11).tolist() == ["u4pruydqqvj"]
+
+    codes = sp.geohash_codes(lat[:1], lon[:1], 5)
+    center = sp.geohash_centers(codes, 5)
+    assert abs(center[0][0] - -34.6037) < 0.03 and abs(center[1][0] - -58.3816) < 0.03
+
+
+def test_clean_coordinates():
+    lat, lon = sp.clean_coordinates(
+        pd.Series(["-34,6037", "0", "abc", "-95", " -31.4 "]),
+        pd.Series(["-58.3816", "0", "-58", "-58", "-64.18"]),
+    )
+    assert lat.tolist()[0] == -34.6037 and lat.tolist()[4] == -31.4
+    assert lat.iloc[1:4].isna().all() and lon.iloc[1:4].isna().all()
+
+
+def test_queries_match_brute_force():
+    lat, lon = make_points()
+    index = sp.SpatialIndex(lat, lon)
+    dist = haversine(lat, lon, -34.6, -58.4)
+
+    pos, km = index.nearest(-34.6, -58.4, k=5)
+    assert pos.tolist() == np.argsort(dist)[:5].tolist()
+    assert np.allclose(km, np.sort(dist)[:5])
+
+    pos, km = index.within(-34.6, -58.4, 150)
+    assert sorted(pos.tolist()) == np.flatnonzero(dist <= 150).tolist()
+    assert (np.diff(km) >= 0).all()
+
+    weights = np.ones((len(lat), 1))
+    sums = index.radius_sums([-34.6, -40.0], [-58.4, -65.0], 150, weights)
+    assert sums[0, 0] == (dist <= 150).sum()
+    assert sums[1, 0] == (haversine(lat, lon, -40.0, -65.0) <= 150).sum()
+
+    cell = sp.encode_geohash(pd.Series(lat), pd.Series(lon), 2)
+    assert sorted(index.in_cell("6").tolist()) == np.flatnonzero(cell.str[0] == "6").tolist()
+    assert sorted(index.in_cell(cell[0]).tolist()) == np.flatnonzero(cell == cell[0]).tolist()
+    with pytest.raises(ValueError):
+        index.in_cell("6" * (sp.SPATIAL_PRECISION + 1))
+
+
+def test_aggregate():
+    cine = pd.DataFrame(
+        {
+            "latitud": [-34.6037, -34.6040, None],
+            "longitud": [-58.3816, -58.3820, -58.0],
+            "id_departamento": pd.array([2001, 2001, 2001], dtype="Int64"),
+            "pantallas": [3, 5, 7],
+            "butacas": [300, 500, 700],
+        }
+    )
+    museos = pd.DataFrame(
+        {
+            "latitud": [-34.6100, -31.4],
+            "longitud": [-58.3900, -64.18],
+            "id_departamento": pd.array([2001, 14014], dtype="Int64"),
+        }
+    )
+    points = pd.concat(
+        [sp.get_points("cine", cine), sp.get_points("museos_datosabiertos", museos)],
+        ignore_index=True,
+    )
+    out_df = sp.aggregate(points, precision=5, radius_km=5)
+
+    deptos = out_df[out_df["nivel"] == "departamento"].set_index("id_departamento")
+    assert deptos.loc[2001, ["cnt_cines", "sum_pantallas", "sum_butacas", "cnt_museos"]].tolist() == [2, 8, 800, 1]
+    # Córdoba is far from the rest
+    assert deptos.loc[14014, "cnt_espacios_radio"] == 1
+    assert deptos.loc[2001, "cnt_espacios_radio"] == 3
+
+    cells = out_df[out_df["nivel"] == "celda"].set_index("celda")
+    assert cells["cnt_espacios"].to_dict() == {"69y7p": 3, "6d6m7": 1}
+
+    assert sp.aggregate(points.iloc[:0]).columns.tolist() == out_df.columns.tolist()
@@ -0,0 +1,102 @@
+"""
+Grouping sets aggregation of transform (aggregate_grouping_sets), compared
+with one plain pandas groupby per grouping set.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import pkg.transform as t
+
+GROUPING_SETS = [["categoria"], ["fuente"], ["provincia", "categoria"]]
+AGGREGATES = {"cnt": (None, "size"), "sum_x": ("x", "sum"), "cnt_y": ("y", "count")}
+
+
+def make_df(seed, rows=500):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "categoria": rng.choice(["Cine", "Museo"], rows),
+            "provincia": rng.choice(["CORDOBA", "SALTA", "JUJUY", None], rows),
+            "fuente": rng.choice(["INCAA", "CONABIP", None], rows),
+            "x": pd.array(rng.integers(0, 10, rows), dtype="Int64"),
+            "y": rng.choice(["SI", None], rows),
+        }
+    )
+    return df.astype({"categoria": "category", "provincia": "category", "fuente": "category"})
+
+
+def expected(dfs_lst):
+    big_df = pd.concat(dfs_lst).astype({"categoria": object, "provincia": object, "fuente": object})
+    return pd.concat(
+        [
+            big_df.groupby(cols, as_index=False)
+            .agg(cnt=("x", "size"), sum_x=("x", "sum"), cnt_y=("y", "count"))
+            .sort_values(cols)
+            for cols in GROUPING_SETS
+        ],
+        ignore_index=True,
+    ).reindex(columns=["categoria", "fuente", "provincia", "cnt", "sum_x", "cnt_y"])
+
+
+@pytest.mark.parametrize("sources", [1, 3])
+def test_aggregate_grouping_sets(sources):
+    dfs_lst = [make_df(seed) for seed in range(sources)]
+
+    out_df = t.aggregate_grouping_sets(dfs_lst, GROUPING_SETS, AGGREGATES)
+
+    # NaN keys are left out of the grouping sets using them, but still
+    # counted in the others
+    pd.testing.assert_frame_equal(
+        out_df.astype({"categoria": object, "provincia": object, "fuente": object}),
+        expected(dfs_lst),
+        check_dtype=False,
+    )
+
+
+def test_partials_add_up():
+    # As transform_streaming does, chunk by chunk
+    df = make_df(0, rows=1000)
+    partial = None
+    for start in range(0, len(df), 300):
+        partial = t.aggregate_partial(df.iloc[start : start + 300], GROUPING_SETS, AGGREGATES, partial)
+
+    pd.testing.assert_frame_equal(
+        t.rollup(partial, GROUPING_SETS, AGGREGATES),
+        t.aggregate_grouping_sets([df], GROUPING_SETS, AGGREGATES),
+    )
+
+
+def test_no_data():
+    out_df = t.rollup(None, GROUPING_SETS, AGGREGATES)
+
+    assert out_df.empty
+    assert list(out_df.columns) == ["categoria", "fuente", "provincia", "cnt", "sum_x", "cnt_y"]
+
+
+def test_streaming_same_as_in_memory(tmp_path):
+    import benchmarks.generate as g
+
+    csvs_dic = g.generate(str(tmp_path), 1)
+    # A source without one of its columns
+    fname = csvs_dic["museos_datosabiertos"]
+    pd.read_csv(fname, dtype=str).drop(columns=["Web"]).to_csv(fname, index=False)
+
+    expected = t.transform(csvs_dic, chunksize=0, workers=1)
+    out_dfs_dic = t.transform_streaming(csvs_dic, 1000, out_dir=str(tmp_path / "out"))
+
+    out_df = t.read_output(out_dfs_dic["registros_unificados"])
+    assert out_df["web"].notna().any()
+    pd.testing.assert_frame_equal(
+        out_df.drop(columns="dt_loaded"),
+        expected["registros_unificados"][out_df.columns].drop(columns="dt_loaded").reset_index(drop=True),
+        check_dtype=False,
+        check_categorical=False,
+    )
+    for tb in ["registros_totales", "totales_cine"]:
+        pd.testing.assert_frame_equal(
+            out_dfs_dic[tb].drop(columns="dt_loaded"),
+            expected[tb].drop(columns="dt_loaded"),
+            check_dtype=False,
+            check_categorical=False,
+        )